@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import constants
+import fundtable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# cheaper equivalents of the favorite funds: nearest neighbours by cosine similarity over a feature vector per fund
+# the vector is made of blocks: the metrics of constants.alternatives (z-scores, 0 when unknown) and the weights of every breakdown category
+# every block is normalized to a unit length then scaled by the square root of its weight, so that the similarity of two funds is
+# a weighted mean of the similarities of their blocks and a fund is not pulled towards others by the block with the most labels
+# candidates of a favorite have the same SRI and lower ongoing charges, the k most similar ones are ranked by saving
+# all the funds are compared at once: one (favorites, funds) matrix product
+
+
+def features(data):
+    # reads the records once, returns (isins, names, favorites, fees, risks, matrix (funds, features) of float32)
+    isins = []
+    names = []
+    favorites = []
+    metrics = {field: [] for field in constants.alternatives["metrics"]}
+    breakdowns = []
+    for record in data:
+        isins.append(record["isin"])
+        names.append(record.get("legal_name") or "")
+        favorites.append(record.get("favorite") or "")
+        for field, values in metrics.items():
+            values.append(fundtable.number(record.get(field)))
+        weights = record.get("portfolio_weights")
+        breakdowns.append(weights if isinstance(weights, dict) else {})
+
+    blocks = []
+    columns = numpy.array([metrics[field] for field in constants.alternatives["metrics"]], dtype=float).reshape(len(metrics), len(isins)).T
+    known = numpy.maximum((~numpy.isnan(columns)).sum(axis=0), 1)  # metrics unknown for every fund are left at 0
+    centered = columns - numpy.nansum(columns, axis=0) / known
+    deviations = numpy.sqrt(numpy.nansum(centered ** 2, axis=0) / known)
+    blocks.append((numpy.nan_to_num(centered / numpy.where(deviations > 0, deviations, 1)), constants.alternatives["weights"]["metrics"]))
+    for category in constants.alternatives["breakdowns"]:
+        labels = {}
+        rows, cols, values = [], [], []
+        for k, weights in enumerate(breakdowns):
+            for label, weight in weights.get(category, {}).items():
+                rows.append(k)
+                cols.append(labels.setdefault(label, len(labels)))
+                values.append(weight)
+        block = numpy.zeros((len(isins), len(labels)))
+        block[rows, cols] = values
+        blocks.append((block, constants.alternatives["weights"][category]))
+
+    matrix = numpy.hstack([unit_rows(block) * numpy.sqrt(weight) for block, weight in blocks]).astype(numpy.float32)
+    return isins, names, favorites, columns[:, list(metrics).index("fee_ongoing_charges")], columns[:, list(metrics).index("sri_risk")], matrix
+
+
+def unit_rows(block):
+    norms = numpy.linalg.norm(block, axis=1, keepdims=True)
+    return block / numpy.where(norms > 0, norms, 1)
+
+
+def nearest(matrix, fees, risks, queries, k, min_similarity=0.0):
+    # for every query row: up to k (row, similarity) of the same risk and lower fees, the most similar ones, largest saving first
+    norms = numpy.linalg.norm(matrix, axis=1)
+    similarities = (matrix[queries] @ matrix.T) / numpy.maximum(numpy.outer(norms[queries], norms), numpy.finfo(numpy.float32).tiny)
+    eligible = (risks[None, :] == risks[queries, None]) & (fees[None, :] < fees[queries, None]) & (similarities >= min_similarity)
+    similarities = numpy.where(eligible, similarities, -numpy.inf)
+    results = []
+    for query, row in zip(queries, similarities):
+        count = min(k, int(numpy.isfinite(row).sum()))
+        if not count:
+            results.append([])
+            continue
+        closest = numpy.argpartition(-row, count - 1)[:count]
+        closest = closest[numpy.lexsort((-row[closest], fees[closest]))]  # largest saving first, then the most similar
+        results.append([(int(j), float(row[j])) for j in closest])
+    return results
+
+
+def sheet(data, k, min_similarity=0.0, logger=None):
+    # sheet of the k cheaper equivalents of every favorite
+    isins, names, favorites, fees, risks, matrix = features(data)
+    queries = numpy.array([j for j, favorite in enumerate(favorites) if favorite], dtype=int)
+    rows = []
+    if len(queries):
+        for query, neighbours in zip(queries, nearest(matrix, fees, risks, queries, k, min_similarity)):
+            favorite = [favorites[query], isins[query], names[query], round(float(fees[query]), 2) if not numpy.isnan(fees[query]) else None]
+            if not neighbours:
+                rows.append(favorite + [None] * 6)
+            for rank, (j, similarity) in enumerate(neighbours, 1):
+                rows.append(favorite + [rank, isins[j], names[j], round(float(fees[j]), 2), round(float(fees[query] - fees[j]), 2), round(similarity * 100, 1)])
+    if logger is not None:
+        found = sum(1 for row in rows if row[4] is not None)
+        logger.info(f"Alternatives: {found} cheaper equivalents of {len(queries)} favorites among {len(isins)} funds over {matrix.shape[1]} features")
+    return {
+        "title": constants.alternatives["sheet"]["title"],
+        "header": constants.alternatives["sheet"]["header"],
+        "rows": rows
+    }
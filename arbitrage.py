@@ -1,22 +1,52 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import multiprocessing
+import array
+import math
 import openpyxl
-import textwrap
+import os
 import re
+import tempfile
+import textwrap
+from openpyxl.comments import Comment
+from openpyxl.formatting.formatting import ConditionalFormattingList
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
 from openpyxl.formatting.rule import ColorScaleRule, FormulaRule
 from pylogger_unified import logger as pylogger_unified
+import alternatives
+import backtest
 import constants
+import enrichment
+import executor
+import fundtable
+import history
+import holdings
+import kid
+import lookthrough
+import profiling
+import progress
+import projection
+import ranking
+import requestcache
+import scenarios
+import schema
+import service
+import spool
+import transport
 import utils
+import workqueue
+import xlsx_fast
 
 args = utils.parse_args()
 utils.check_args(args)
 
 logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=args.debug, logger_name="arbitrage")
 
+if args.projection_amount or args.projection_contribution:
+    # projection columns after the fee columns, in every workbook written by this run
+    constants.column_mapping.append(projection.column_group(args.projection_amount, args.projection_contribution, args.projection_frequency, args.projection_horizon, paths=args.projection_paths))
+
 
 def check_fees(data):
     # this function takes fund data from API call and a list of keys of well known fees
@@ -32,11 +62,7 @@ def check_fees(data):
             continue
         if "value" not in fee:
             continue
-        if fee["value"] == None:
-            continue
-        if isinstance(fee["value"], str) and (fee["value"] == "" or fee["value"] == "0"):
-            continue
-        if isinstance(fee["value"], int) and fee["value"] == 0:
+        if schema.empty_fee(fee["value"]):
             continue
         logger.error(f"{fee_key} is unknown and its value is {fee['value']}")
         return False
@@ -59,11 +85,16 @@ def get_fund_data(fund):
     output_item = dict()
 
     logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=args.debug, logger_name=fund)
-    logger.info("Getting fund...")
+    if progress.state is None:
+        logger.info("Getting fund...")  # the progress reports the funds fetched otherwise
 
-    api_response = utils.request_data(
-        url=f"{constants.api_endpoint}/push/fundsheet/{constants.type_to_api_prefix[args.type]}/{args.language}/{args.country}/{fund.lower()}"
-    )
+    try:
+        api_response = utils.request_data(
+            url=f"{constants.api_endpoint}/push/fundsheet/{constants.type_to_api_prefix[args.type]}/{args.language}/{args.country}/{fund.lower()}"
+        )
+    except utils.late_errors as e:
+        logger.warning(f"Fund sheet not received in time, all fields are marked: {e}")
+        return late_record(fund)
 
     if not api_response:
         logger.error("Failed to retrieve data from the API")
@@ -191,19 +222,25 @@ def get_fund_data(fund):
             }
         # Document d'informations clés
 
-        res = get_more_details_data(fund)
-
-        output_item["q_notation"] = res["notation"]
-
-        output_item["more_details"] = {
-            "url": res["url"],
-            "title": "FR"
-        }
+        if args.lazy_enrichment:
+            # filled in by the enrichment backfill
+            output_item["q_notation"] = ""
+            output_item["more_details"] = ""
+        else:
+            try:
+                output_item.update(get_enrichment(fund))
+            except utils.late_errors as e:
+                logger.warning(f"Third part details not received in time: {e}")
+                output_item.update({"q_notation": constants.late_mark, "more_details": constants.late_mark})
         # Détails
 
         ### SCENARIOS ###
 
-        output_item.update(get_scenarios(fund))
+        try:
+            output_item.update(get_scenarios(fund))
+        except utils.late_errors as e:
+            logger.warning(f"Scenarios not received in time: {e}")
+            output_item.update({field: constants.late_mark for field in constants.scenario_fields})
         # Rendement de tous les scénarios à 5 ans
 
         ### FRAIS ###
@@ -254,9 +291,14 @@ def get_fund_data(fund):
 
     ### PORTEFEUILLE ###
 
-    api_response = utils.request_data(
-        url=f"{constants.api_endpoint}/push/holdings/{args.language}/{str(output_item['fundshare_id'])}"
-    )
+    try:
+        api_response = utils.request_data(
+            url=f"{constants.api_endpoint}/push/holdings/{args.language}/{str(output_item['fundshare_id'])}"
+        )
+    except utils.late_errors as e:
+        logger.warning(f"Holdings not received in time: {e}")
+        output_item.update({"portfolio_" + breakdown_category: constants.late_mark for breakdown_category in constants.breakdowns_mapping})
+        return output_item
 
     if not api_response:
         logger.error("Failed to retrieve data from the API for holding " + str(output_item["fundshare_id"]))
@@ -266,6 +308,8 @@ def get_fund_data(fund):
         if "breakdowns" not in api_response or not api_response["breakdowns"]:
             logger.warning("Missing breakdowns for " + str(output_item["fundshare_id"]))
             api_response["breakdowns"] = []
+        output_item["portfolio_weights"] = {}
+        # numeric weights in percent per breakdown category, kept for the holdings index (see holdings.py)
         for breakdown_item in api_response["breakdowns"]:
             res = [b["label"] + " (" + str(round((b["ptf_value"] if b["ptf_value"] else b["bench_value"]) * 100, 2)) + "%)" for b in sorted(breakdown_item["level_1_breakdowns"], key=lambda x: (x["rank"], -x["ptf_value"] if x["ptf_value"] else -x["bench_value"]))]
             if breakdown_item["labels"]["header"] in [subitem for item in constants.breakdowns_mapping.values() for subitem in item]:
@@ -275,6 +319,11 @@ def get_fund_data(fund):
                         if "portfolio_" + breakdown_category in output_item:
                             raise ValueError(f"{utils.join_h(constants.breakdowns_mapping[breakdown_category])} override for {breakdown_category} {str(output_item['fundshare_id'])}")
                         output_item["portfolio_" + breakdown_category] = res
+                        weights = output_item["portfolio_weights"][breakdown_category] = {}
+                        for b in breakdown_item["level_1_breakdowns"]:
+                            # the fund weight only, the benchmark weight shown in the sheet when it is missing is not an exposure of the fund
+                            if b.get("ptf_value") is not None:
+                                weights[b["label"]] = round(weights.get(b["label"], 0) + b["ptf_value"] * 100, 4)
             elif breakdown_item["labels"]["header"] not in constants.breakdowns_exclude:
                 logger.warning(f"Unknown portfolio breakdown header {breakdown_item['labels']['header']} for {str(output_item['fundshare_id'])}")
 
@@ -285,7 +334,16 @@ def get_fund_data(fund):
     return output_item
 
 
-def gather_data():
+def late_record(fund):
+    # record of a fund whose fund sheet did not arrive before the deadline, only its ISIN is known
+    output_item = {subitem["ref"]: constants.late_mark for item in constants.column_mapping for subitem in item["items"]}
+    output_item["isin"] = fund
+    output_item["favorite"] = args.favorites[fund]["label"] if fund in args.favorites else ""
+    progress.mark_failed()
+    return output_item
+
+
+def list_funds():
 
     funds = args.isin
     if funds is None:
@@ -306,33 +364,149 @@ def gather_data():
             logger.error(f"KeyError: Key '{e}' not found in the API response")
             exit(1)
 
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        output_data = pool.map(get_fund_data, funds)
+    return funds
+
+
+def replay_data():
+    # records of a stored run, in the order the funds would have been fetched
+    connection = history.open_store(args.history_db)
+    run_id = history.resolve_run(connection, args.replay)
+    records = history.load_run(connection, run_id)
+    funds = [isin for isin in args.isin if isin in records] if args.isin else sorted(records)
+    logger.info(f"Replaying {len(funds)} funds from run {run_id} of {args.history_db}")
+    if args.low_memory:
+        output_data = spool.RecordSpool()
+        for isin in funds:
+            output_data.append(records[isin])
+        return output_data
+    return [records[isin] for isin in funds]
+
+
+def get_payloads(fund):
+    # raw API payloads of a fund, as read by get_fund_data, for the schema preflight
+    fundsheet = utils.request_data(
+        url=f"{constants.api_endpoint}/push/fundsheet/{constants.type_to_api_prefix[args.type]}/{args.language}/{args.country}/{fund.lower()}"
+    )
+    payloads = {
+        "fundsheet": fundsheet,
+        "scenarios": utils.request_data(url=f"{constants.api_endpoint}/push-raw/all_perf_scenarios?isin={fund.lower()}")
+    }
+    if isinstance(fundsheet, dict) and "fundshare_id" in fundsheet:
+        payloads["holdings"] = utils.request_data(url=f"{constants.api_endpoint}/push/holdings/{args.language}/{str(fundsheet['fundshare_id'])}")
+    return payloads
+
+
+def gather_data():
+
+    if args.replay:
+        return replay_data()
+
+    funds = list_funds()
+
+    if args.preflight and not schema.preflight(funds, args.preflight, get_payloads, constants.preflight_workers, debug=args.debug):
+        logger.error("Schema drift found by the preflight, the full run is not started")
+        exit(1)
+
+    if args.queue:
+        records = workqueue.coordinate(workqueue.open_queue(args.queue, args.lease), funds, get_fund_data, local_workers=args.local_workers, debug=args.debug)
+        return spool.RecordSpool.from_records(records) if args.low_memory else list(records)
+
+    # favorites are fetched first, the other funds keep their order
+    # favorite records are kept apart and merged back in place, the workbook order does not change
+    favorites = [isin for isin in funds if isin in args.favorites]
+    others = [isin for isin in funds if isin not in args.favorites]
+    progress.start(len(funds), args.progress, logger)
+    records = executor.map_records(progress.Tracked(profiling.wrap(get_fund_data)), favorites + others, backend=args.executor, workers=args.workers, debug=args.debug)
+    favorite_records = {}
+    # records are spilled to disk as they arrive instead of being gathered in one list
+    other_records = spool.RecordSpool() if args.low_memory else []
+    try:
+        for count, record in enumerate(records, start=1):
+            if count <= len(favorites):
+                favorite_records[record["isin"]] = record
+            else:
+                other_records.append(record)
+            if args.checkpoint_every and count < len(funds) and (count == len(favorites) or (count - len(favorites)) % args.checkpoint_every == 0):
+                fetched = set(favorites[:count]) | set(others[:count - len(favorites)])
+                with profiling.stage("checkpoint"):
+                    write_checkpoint(spool.MergedRecords([isin for isin in funds if isin in fetched], favorite_records, other_records), len(funds))
+    finally:
+        progress.stop()
+
+    output_data = spool.MergedRecords(funds, favorite_records, other_records)
+    if args.low_memory:
+        output_data = spool.RecordSpool.from_records(output_data)
+        other_records.close()
+    else:
+        output_data = list(output_data)
 
     return output_data
 
 
+def write_checkpoint(data, total):
+    # partial workbook of the funds fetched so far, replacing the output file atomically
+    fd, tmp_path = tempfile.mkstemp(prefix=".checkpoint-", suffix=".xlsx", dir=os.path.dirname(args.file))
+    os.close(fd)
+    try:
+        export_to_file(data=data, file=tmp_path)
+        os.replace(tmp_path, args.file)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info(f"Checkpoint: {len(data)}/{total} funds written to {args.file}")
+
+
+def apply_updates(data, updates):
+    # merges per ISIN field updates into the records, spooled records are rewritten into a new spool
+    if isinstance(data, spool.RecordSpool):
+        updated_data = spool.RecordSpool()
+        for record in data:
+            record.update(updates.get(record["isin"], {}))
+            updated_data.append(record)
+        data.close()
+        return updated_data
+    for record in data:
+        record.update(updates.get(record["isin"], {}))
+    return data
+
+
+def compute_projection(data):
+    # projection fields of every record (see projection.py)
+    return projection.compute(data, args.projection_amount, args.projection_contribution, args.projection_frequency, args.projection_horizon, paths=args.projection_paths, gross_scenarios=args.projection_gross_scenarios)
+
+
 def get_scenarios(fund):
-    api_response = utils.request_data(
+    # the scenarios are parsed one record at a time, only the fields of constants.scenario_fields are kept
+    # the latest record gives the scenarios, the whole history is optionally stored as compact arrays
+    series = None
+    if args.scenario_history:
+        series = {field: array.array("d") for field in constants.scenario_fields}
+
+    latest_scenario = None
+    for scenario in utils.request_json_stream(
         url=f"{constants.api_endpoint}/push-raw/all_perf_scenarios?isin={fund.lower()}"
-    )
+    ):
+        latest_scenario = {field: scenario[key] for field, key in constants.scenario_fields.items() if key in scenario}
+        if series is not None:
+            for field in constants.scenario_fields:
+                series[field].append(float(latest_scenario[field]) if latest_scenario.get(field) is not None else math.nan)
 
-    if not api_response:
+    if latest_scenario is None:
         logger.error("Failed to retrieve data from the API")
 
     try:
-        if (len(api_response) == 0):
+        if latest_scenario is None:
             raise ValueError("No scenarios found for fund" + fund)
         output_data = {
-            "scenario_stressed": str(round(float(api_response[-1]["num02120_portfolio_return_stress_scenario_rhp_or_first_call_dat"] * 100), 2)) + " %",
-            "scenario_unfavorable": str(round(float(api_response[-1]["num02030_portfolio_return_unfavourable_scenario_rhp_or_first_ca"] * 100), 2)) + " %",
-            "scenario_moderate": str(round(float(api_response[-1]["num02060_portfolio_return_moderate_scenario_rhp_or_first_call_d"] * 100), 2)) + " %",
-            "scenario_favorable": str(round(float(api_response[-1]["num02090_portfolio_return_favourable_scenario_rhp_or_first_call"] * 100), 2)) + " %",
+            field: str(round(float(latest_scenario[field] * 100), 2)) + " %" for field in constants.scenario_fields
         }
     except KeyError as e:
-        logger.error(f"KeyError: Key '{e}' not found in the API response")
+        logger.error(f"KeyError: Key '{constants.scenario_fields[e.args[0]]}' not found in the API response")
         raise
 
+    if series is not None:
+        scenarios.save_history(args.scenario_history, fund, series)
+
     return output_data
 
 
@@ -380,14 +554,18 @@ def get_more_details_data(fund):
     }
 
 
-def export_to_file(data):
-    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=args.debug, logger_name="export")
+def get_enrichment(fund):
+    res = get_more_details_data(fund)
+    return {
+        "q_notation": res["notation"],
+        "more_details": {
+            "url": res["url"],
+            "title": "FR"
+        }
+    }
 
-    workbook = openpyxl.workbook.Workbook()
-    worksheet = workbook.active
-    worksheet.title = constants.worksheet["title"]
-    worksheet.sheet_properties.tabColor = constants.worksheet["color"]
 
+def get_styles():
     header_fill = PatternFill(
         start_color="222222",
         end_color="222222",
@@ -424,6 +602,144 @@ def export_to_file(data):
         top=standard_side,
         vertical=standard_side
     )
+    return {
+        "header_fill": header_fill,
+        "header_border": header_border,
+        "standard_fill": standard_fill,
+        "standard_border": standard_border
+    }
+
+
+def write_cell(worksheet, row, column, val, cell_height, hyperlink, first_column, styles):
+    cell = worksheet.cell(
+        row=row,
+        column=column,
+        value=val,
+    )
+    cell.number_format = "@"
+    if hyperlink is not None:
+        cell.hyperlink = hyperlink
+    cell.alignment = Alignment(
+        horizontal="center" if cell_height == 1 else "left",
+        vertical="center"
+    )
+    cell.font = Font(
+        size=12,
+        color="FFFFFF"
+    )
+    if first_column:  # header column since first column mapping group
+        cell.font = Font(
+            bold=True
+        )
+        cell.border = styles["header_border"]
+        cell.fill = styles["header_fill"]
+    else:
+        cell.border = styles["standard_border"]
+        cell.fill = styles["standard_fill"]
+    return cell
+
+
+def add_conditional_formatting(worksheet, columns, last_row):
+    # columns are (column index, column mapping subitem), rules cover the column from the header to last_row
+    for i, subitem in columns:
+        conditional_formatting_item = subitem["conditional-formatting"] if "conditional-formatting" in subitem else {}
+        column_letter = openpyxl.utils.get_column_letter(i)
+        if "fill-mapping" in conditional_formatting_item:
+            for filter_equality, filling_color in conditional_formatting_item["fill-mapping"].items():
+                worksheet.conditional_formatting.add(
+                    f"{column_letter}1:{column_letter}{last_row}",
+                    FormulaRule(
+                        formula=[f"${column_letter}1=\"{filter_equality}\""],
+                        fill=PatternFill(
+                            start_color=filling_color,
+                            end_color=filling_color,
+                            fill_type="solid"
+                        )
+                    )
+                )
+        if "fill-percentile" in conditional_formatting_item:
+            worksheet.conditional_formatting.add(f"{column_letter}1:{column_letter}{last_row}", ColorScaleRule(
+                start_type="percentile",
+                start_value=0,
+                start_color=conditional_formatting_item["fill-percentile"]["start_color"],
+                mid_type="percentile",
+                mid_value=50,
+                mid_color=conditional_formatting_item["fill-percentile"]["mid_color"],
+                end_type="percentile",
+                end_value=100,
+                end_color=conditional_formatting_item["fill-percentile"]["end_color"]
+            ))
+
+
+def add_table_sheet(workbook, sheet, header_fill, header_border):
+    # plain table sheet (title, header, rows) appended after the main sheet
+    worksheet = workbook.create_sheet(title=sheet["title"])
+    worksheet.append(sheet["header"])
+    for cell in worksheet[1]:
+        cell.alignment = Alignment(
+            horizontal="center",
+            vertical="center"
+        )
+        cell.font = Font(
+            bold=True,
+            color="FFFFFF"
+        )
+        cell.border = header_border
+        cell.fill = header_fill
+    for row in sheet["rows"]:
+        worksheet.append([utils.remove_invalid_xml_chars(val) for val in row])
+    worksheet.freeze_panes = "A2"
+    worksheet.auto_filter.ref = f"A1:{get_column_letter(len(sheet['header']))}1"
+    for i, column_cells in enumerate(worksheet.columns):
+        width_value = max(len(str(cell.value)) for cell in column_cells)
+        worksheet.column_dimensions[get_column_letter(i + 1)].width = min(width_value, 80) + 4
+
+
+def select_records(data, extra_sheets=None):
+    # subset and order of the funds written (--query and --sort) and sheet of aggregates (--group-by), see fundtable.py
+    if not args.query and not args.sort and not args.group_by:
+        return data, extra_sheets
+    records = data if isinstance(data, list) else list(data)
+    table = fundtable.FundTable(records)
+    rows = table.select(args.query, args.sort)
+    if args.query:
+        logger.info(f"{len(rows)} funds out of {len(records)} selected by --query")
+    if args.group_by:
+        extra_sheets = (extra_sheets or []) + [table.group_sheet(args.group_by, args.aggregate, rows)]
+    return [records[i] for i in rows], extra_sheets
+
+
+def export_to_file(data, file=None, extra_sheets=None):
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=args.debug, logger_name="export")
+
+    if file is None:
+        file = args.file
+
+    data, extra_sheets = select_records(data, extra_sheets)
+
+    fills = None
+    if args.static_fills:
+        fills = ranking.compute(data, [subitem for item in constants.column_mapping for subitem in item["items"]])
+        extra_sheets = [fills.rankings] + (extra_sheets or [])
+
+    if args.xlsx_engine == "fast":
+        # rows are streamed into the file, there is no separate save
+        with profiling.stage("write"):
+            if args.shard_by:
+                xlsx_fast.write_sharded_workbook(file, data, args.shard_by, extra_sheets=extra_sheets, workers=args.shard_workers)
+            else:
+                xlsx_fast.write_workbook(file, data, extra_sheets=extra_sheets, fills=fills)
+        logger.info(f"excel file {file if isinstance(file, str) else 'stream'} created successfully!")
+        return
+
+    workbook = openpyxl.workbook.Workbook()
+    worksheet = workbook.active
+    worksheet.title = constants.worksheet["title"]
+    worksheet.sheet_properties.tabColor = constants.worksheet["color"]
+
+    styles = get_styles()
+    header_fill = styles["header_fill"]
+    header_border = styles["header_border"]
 
     i = 1
     for column_group in constants.column_mapping:
@@ -469,90 +785,27 @@ def export_to_file(data):
     worksheet.freeze_panes = f"{get_column_letter(len(constants.column_mapping[0]['items'])+1)}3"
     worksheet.auto_filter.ref = f"A2:{get_column_letter(worksheet.max_column)}2"
 
+    static_fills = {}
     j = 3
     for row_data in data:
         i = 1
         height_factor = 0
         for col_ref in [subitem["ref"] for item in constants.column_mapping for subitem in item["items"]]:
-            cell_height = 1
-            if isinstance(row_data.get(col_ref, ""), list):
-                cell_height = len(row_data.get(col_ref, ""))
-                val = "\n".join(row_data.get(col_ref, ""))
-            elif isinstance(row_data.get(col_ref, ""), dict):
-                if "url" not in row_data.get(col_ref, ""):
-                    raise ValueError("Missing url attribute for dict value " + col_ref)
-                val = row_data.get(col_ref, "")["url"]
-                if "title" in row_data.get(col_ref, ""):
-                    val = row_data.get(col_ref, "")["title"]
-            else:
-                val = row_data.get(col_ref, "")
-            val = utils.remove_invalid_xml_chars(val)
-
-            if re.match(r"^(-\s?)?\d+\.\d+\s?%$", str(val)):
-                val = float(re.sub(r"\s?%", "", val))
-            elif re.match(r"^(-\s?)?\d+\s?%$", str(val)):
-                val = float(re.sub(r"\s?%", "", val))
-
-            cell = worksheet.cell(
-                row=j,
-                column=i,
-                value=val,
-            )
-            cell.number_format = "@"
-            if isinstance(row_data.get(col_ref, ""), dict):
-                cell.hyperlink = row_data.get(col_ref, "")["url"]
-            cell.alignment = Alignment(
-                horizontal="center" if cell_height == 1 else "left",
-                vertical="center"
-            )
-            cell.font = Font(
-                size=12,
-                color="FFFFFF"
-            )
-            if i <= len(constants.column_mapping[0]["items"]):  # header column since first column mapping group
-                cell.font = Font(
-                    bold=True
-                )
-                cell.border = header_border
-                cell.fill = header_fill
-            else:
-                cell.border = standard_border
-                cell.fill = standard_fill
+            val, cell_height, hyperlink = utils.format_cell_value(row_data.get(col_ref, ""), col_ref)
+            cell = write_cell(worksheet, j, i, val, cell_height, hyperlink, i <= len(constants.column_mapping[0]["items"]), styles)
+            if fills is not None and fills.color(j - 3, i - 1) is not None:
+                color = fills.color(j - 3, i - 1)
+                if color not in static_fills:
+                    static_fills[color] = PatternFill(start_color=color, end_color=color, fill_type="solid")
+                cell.fill = static_fills[color]
             i += 1
             height_factor = min(max(height_factor, cell_height), 20)
 
         worksheet.row_dimensions[j].height = height_factor * 16
         j += 1
 
-    i = 1
-    for conditional_formatting_item in [subitem["conditional-formatting"] if "conditional-formatting" in subitem else {} for item in constants.column_mapping for subitem in item["items"]]:
-        column_letter = openpyxl.utils.get_column_letter(i)
-        if "fill-mapping" in conditional_formatting_item:
-            for filter_equality, filling_color in conditional_formatting_item["fill-mapping"].items():
-                worksheet.conditional_formatting.add(
-                    f"{column_letter}1:{column_letter}{j}",
-                    FormulaRule(
-                        formula=[f"${column_letter}1=\"{filter_equality}\""],
-                        fill=PatternFill(
-                            start_color=filling_color,
-                            end_color=filling_color,
-                            fill_type="solid"
-                        )
-                    )
-                )
-        if "fill-percentile" in conditional_formatting_item:
-            worksheet.conditional_formatting.add(f"{column_letter}1:{column_letter}{j}", ColorScaleRule(
-                start_type="percentile",
-                start_value=0,
-                start_color=conditional_formatting_item["fill-percentile"]["start_color"],
-                mid_type="percentile",
-                mid_value=50,
-                mid_color=conditional_formatting_item["fill-percentile"]["mid_color"],
-                end_type="percentile",
-                end_value=100,
-                end_color=conditional_formatting_item["fill-percentile"]["end_color"]
-            ))
-        i += 1
+    if fills is None:
+        add_conditional_formatting(worksheet, enumerate([subitem for item in constants.column_mapping for subitem in item["items"]], start=1), j)
 
     # for i in range(i, 1025):
     #     worksheet.column_dimensions[openpyxl.utils.get_column_letter(i)].hidden = True
@@ -574,11 +827,194 @@ def export_to_file(data):
 
     worksheet.sheet_view.selection[0].activeCell = "A1"
     worksheet.sheet_view.selection[0].sqref = "A1"
-    workbook.save(args.file)
-    logger.info(f"excel file {args.file} created successfully!")
+
+    for sheet in extra_sheets or []:
+        add_table_sheet(workbook, sheet, header_fill, header_border)
+    profiling.checkpoint("after rows")
+
+    with profiling.stage("save"):
+        workbook.save(file)
+    logger.info(f"excel file {file if isinstance(file, str) else 'stream'} created successfully!")
+
+
+def is_removed_mark(cell):
+    return cell.comment is not None and cell.comment.text.startswith(constants.removed_fund["comment"])
+
+
+def update_file(data, file=None, extra_sheets=None):
+    # updates a previously generated workbook in place: rows are keyed on the ISIN column
+    # only cells whose value changed are rewritten, columns and notes added by users are kept
+    # the workbook is still loaded and saved whole by openpyxl, the cost of an update grows with the workbook, not with the funds changed
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=args.debug, logger_name="export")
+
+    if file is None:
+        file = args.file
+
+    data, extra_sheets = select_records(data, extra_sheets)
+    workbook = openpyxl.load_workbook(file)
+    worksheet = workbook[constants.worksheet["title"]]
+    styles = get_styles()
+
+    subitems = [subitem for item in constants.column_mapping for subitem in item["items"]]
+    header = {cell.value: cell.column for cell in worksheet[2] if cell.value is not None}
+    missing_columns = [subitem["name"] for subitem in subitems if subitem["name"] not in header]
+    if missing_columns:
+        raise ValueError(f"Columns {utils.join_h(missing_columns)} not found in {file}, regenerate it without --update")
+    columns = [(header[subitem["name"]], subitem) for subitem in subitems]
+    first_columns = [subitem["ref"] for subitem in constants.column_mapping[0]["items"]]
+    isin_column = header[next(subitem["name"] for subitem in subitems if subitem["ref"] == "isin")]
+
+    rows = {}
+    for j in range(3, worksheet.max_row + 1):
+        isin = worksheet.cell(row=j, column=isin_column).value
+        if isin:
+            rows[isin] = j
+
+    changed_cells = 0
+    added_funds = 0
+    next_row = max(rows.values(), default=2) + 1
+    for row_data in data:
+        j = rows.pop(row_data["isin"], None)
+        is_new = j is None
+        if is_new:
+            j = next_row
+            next_row += 1
+            added_funds += 1
+        elif is_removed_mark(worksheet.cell(row=j, column=isin_column)):
+            # fund back in the results
+            write_cell(worksheet, j, isin_column, row_data["isin"], 1, None, True, styles).comment = None
+            changed_cells += 1
+        height_factor = 0
+        for column, subitem in columns:
+            val, cell_height, hyperlink = utils.format_cell_value(row_data.get(subitem["ref"], ""), subitem["ref"])
+            height_factor = min(max(height_factor, cell_height), 20)
+            cell = worksheet.cell(row=j, column=column)
+            if not is_new and (cell.value if cell.value is not None else "") == (val if val is not None else "") and (cell.hyperlink.target if cell.hyperlink else None) == hyperlink:
+                continue
+            write_cell(worksheet, j, column, val, cell_height, hyperlink, subitem["ref"] in first_columns, styles)
+            changed_cells += 1
+        if is_new or worksheet.row_dimensions[j].height != height_factor * 16:
+            worksheet.row_dimensions[j].height = height_factor * 16
+
+    # funds no longer returned stay in the sheet, marked on their ISIN cell
+    removed_fill = PatternFill(
+        start_color=constants.removed_fund["color"],
+        end_color=constants.removed_fund["color"],
+        fill_type="solid"
+    )
+    for isin, j in rows.items():
+        cell = worksheet.cell(row=j, column=isin_column)
+        if not is_removed_mark(cell):
+            cell.fill = removed_fill
+            cell.comment = Comment(f"{constants.removed_fund['comment']} {utils.get_utc_time()}", "arbitrage")
+            changed_cells += 1
+
+    # conditional formatting ranges are recomputed once, rules added by users are kept
+    generated_ranges = {f"{get_column_letter(column)}1:{get_column_letter(column)}" for column, subitem in columns if "conditional-formatting" in subitem}
+    user_rules = [(conditional_formatting.sqref, rule) for conditional_formatting in worksheet.conditional_formatting for rule in conditional_formatting.rules if re.sub(r"\d+$", "", str(conditional_formatting.sqref)) not in generated_ranges]
+    worksheet.conditional_formatting = ConditionalFormattingList()
+    for sqref, rule in user_rules:
+        worksheet.conditional_formatting.add(str(sqref), rule)
+    add_conditional_formatting(worksheet, columns, next_row)
+
+    for sheet in extra_sheets or []:
+        if sheet["title"] in workbook.sheetnames:
+            del workbook[sheet["title"]]
+        add_table_sheet(workbook, sheet, styles["header_fill"], styles["header_border"])
+
+    workbook.save(file)
+    logger.info(f"excel file {file} updated: {changed_cells} cells changed, {added_funds} funds added, {len(rows)} funds not found anymore")
 
 
 if __name__ == "__main__":
-    data = gather_data()
-    logger.pretty(data)
-    export_to_file(data=data)
+    if args.serve:
+        service.serve(args, list_funds=list_funds, fetch=get_fund_data, export=export_to_file, derive=compute_projection if args.projection_amount or args.projection_contribution else None)
+    elif args.history_diff or args.history_isin:
+        history.query(args)
+    elif args.holdings_query:
+        holdings.query(args)
+    elif args.queue and args.queue_role == "worker":
+        workqueue.run_worker(workqueue.open_queue(args.queue, args.lease), get_fund_data, debug=args.debug)
+    else:
+        if args.profile:
+            profiling.start(args.profile, memory=args.profile_memory)
+        if args.request_cache:
+            requestcache.start()
+        if args.deadline:
+            transport.set_deadline(args.deadline)
+        if args.hedge:
+            transport.enable_hedging()
+        with profiling.stage("fetch"):
+            try:
+                data = gather_data()
+            finally:
+                transport.clear_deadline()  # the deadline only bounds the fetch, not the later stages
+        if args.kid_store:
+            with profiling.stage("kid"):
+                data = apply_updates(data, kid.fetch_documents(data, args.kid_store, args.kid_workers, debug=args.debug))
+        if args.projection_amount or args.projection_contribution:
+            with profiling.stage("projection"):
+                data = apply_updates(data, compute_projection(data))
+        if args.dump_records:
+            for record in data:
+                logger.pretty(record, no_debug=True)
+        if args.lazy_enrichment:
+            # the workbook is written from the fund data while the enrichment is backfilled
+            backfill = enrichment.Backfill([record["isin"] for record in data], get_enrichment, args.enrichment_cache, args.enrichment_workers, debug=args.debug)
+            backfill.start()
+            with profiling.stage("export"):
+                if args.update and os.path.exists(args.file):
+                    update_file(data=data)
+                else:
+                    export_to_file(data=data)
+            with profiling.stage("enrichment"):
+                data = apply_updates(data, backfill.join())
+        extra_sheets = []
+        if args.kid_store:
+            extra_sheets.append(kid.sheet(data))
+        if args.history_db:
+            with profiling.stage("history"):
+                connection = history.open_store(args.history_db)
+                if args.replay:
+                    # a replayed run is compared with the run preceding it, not with itself
+                    run_id = history.resolve_run(connection, args.replay)
+                else:
+                    # stored before the comparison, a failing changes sheet does not lose the run
+                    run_id = history.save_run(connection, data)
+                    logger.info(f"Run {run_id} stored in history {args.history_db}")
+                if args.changes_sheet:
+                    previous = history.latest_run(connection, before=run_id)
+                    if previous is None:
+                        logger.warning(f"No previous run in history {args.history_db}, the changes sheet is empty")
+                    fields = args.history_fields.split(",") if args.history_fields else None
+                    extra_sheets.append(history.changes_sheet(connection, previous, data, fields=fields))
+        if args.backtest_navs:
+            with profiling.stage("backtest"):
+                extra_sheets.append(backtest.sheet(data, args.backtest_navs, args.backtest_allocations, rebalance=args.rebalance, band=args.drift_band / 100, logger=logger))
+        if args.alternatives:
+            with profiling.stage("alternatives"):
+                extra_sheets.append(alternatives.sheet(data, args.alternatives, min_similarity=args.alternatives_min_similarity, logger=logger))
+        if args.look_through:
+            with profiling.stage("look-through"):
+                extra_sheets.append(lookthrough.sheet(data, args.look_through, logger=logger))
+        if args.holdings_index:
+            with profiling.stage("holdings"):
+                count = holdings.update(holdings.open_index(args.holdings_index), data)
+                logger.info(f"Holdings of {count} funds indexed in {args.holdings_index}")
+        with profiling.stage("export"):
+            if (args.update and os.path.exists(args.file)) or (args.lazy_enrichment and not args.static_fills and not args.low_memory and not args.shard_by):
+                # static fills and low memory workbooks are written again, percentiles of q_notation change with the backfill
+                # sharded workbooks too, update_file only knows the single sheet layout
+                update_file(data=data, extra_sheets=extra_sheets)
+            else:
+                export_to_file(data=data, extra_sheets=extra_sheets)
+        if isinstance(data, spool.RecordSpool):
+            data.close()
+        for line in transport.summary():
+            logger.info(f"Transport {line}")
+        if args.request_cache:
+            requests_count, hits = requestcache.stop()
+            logger.info(f"Request cache: {requests_count} distinct requests, {hits} duplicates served without a network call")
+        if args.profile:
+            profiling.stop()
+            logger.info(f"Profile written to {args.profile}")
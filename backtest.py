@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import datetime
+import constants
+import fundtable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# backtest of candidate allocations over NAV histories, every allocation is simulated at once as rows of (allocations, funds) arrays
+# the initial investment pays the maximum subscription fee of every fund bought
+# a rebalancing sells what is above the target weight and pays the maximum redemption fee of the funds sold,
+# buys what is below and pays the conversion rate of the funds bought (a switch between funds of the range)
+# a rebalancing happens on the first NAV date of every period (--rebalance) and whenever a weight drifts from its target by more than the band
+
+period_keys = {
+    "monthly": lambda date: (date.year, date.month),
+    "quarterly": lambda date: (date.year, (date.month - 1) // 3),
+    "yearly": lambda date: date.year,
+    "never": lambda date: None
+}
+
+
+def read_navs(path):
+    # wide CSV: a date column (ISO dates) then one NAV column per ISIN, empty cells are carried from the previous date
+    # returns (dates, isins, navs as a (dates, funds) array with nan before the first NAV of a fund)
+    with open(path, "r", newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = sorted((datetime.date.fromisoformat(row[0].strip()), row[1:]) for row in reader if row and row[0].strip())
+    isins = [isin.strip().upper() for isin in header[1:]]
+    navs = numpy.array([[float(value) if value.strip() else numpy.nan for value in values] for _, values in rows], dtype=float).reshape(len(rows), len(isins))
+    for t in range(1, len(rows)):
+        missing = numpy.isnan(navs[t])
+        navs[t, missing] = navs[t - 1, missing]
+    return [date for date, _ in rows], isins, navs
+
+
+def read_allocations(path):
+    # wide CSV: a name column then one weight column per ISIN, weights of a row are normalized to a sum of 1
+    with open(path, "r", newline="", encoding="utf-8") as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        rows = [row for row in reader if row and row[0].strip()]
+    isins = [isin.strip().upper() for isin in header[1:]]
+    weights = numpy.array([[float(value) if value.strip() else 0.0 for value in row[1:]] for row in rows], dtype=float).reshape(len(rows), len(isins))
+    totals = weights.sum(axis=1, keepdims=True)
+    if (weights < 0).any() or (totals <= 0).any():
+        raise ValueError(f"Allocations of {path} must have positive weights")
+    return [row[0].strip() for row in rows], isins, weights / totals
+
+
+def run(dates, navs, targets, subscription, redemption, conversion, rebalance="quarterly", band=0.0):
+    # simulates every allocation from a value of 1, targets (allocations, funds) and fees (funds) being fractions
+    # returns the values (dates, allocations) and per allocation the turnover, the costs and the number of rebalancings
+    period_key = period_keys[rebalance]
+    holdings = targets * (1 - subscription)
+    costs = (targets * subscription).sum(axis=1)
+    turnover = numpy.zeros(len(targets))
+    rebalancings = numpy.zeros(len(targets), dtype=int)
+    values = numpy.empty((len(dates), len(targets)))
+    values[0] = holdings.sum(axis=1)
+    growth = navs[1:] / navs[:-1]
+    for t in range(1, len(dates)):
+        holdings *= growth[t - 1]
+        value = holdings.sum(axis=1)
+        due = numpy.zeros(len(targets), dtype=bool)
+        if period_key(dates[t]) != period_key(dates[t - 1]):
+            due[:] = True
+        if band:
+            due |= (numpy.abs(holdings / value[:, None] - targets) > band).any(axis=1)
+        if due.any():
+            trades = targets[due] * value[due, None] - holdings[due]
+            sold = numpy.maximum(-trades, 0)
+            bought = numpy.maximum(trades, 0)
+            cost = (sold * redemption).sum(axis=1) + (bought * conversion).sum(axis=1)
+            holdings[due] = targets[due] * (value[due] - cost)[:, None]
+            turnover[due] += (sold.sum(axis=1) + bought.sum(axis=1)) / 2 / value[due]
+            costs[due] += cost
+            # an allocation already on its targets trades nothing, it is not counted as rebalanced
+            traded = numpy.abs(trades).sum(axis=1) > constants.backtest_trade_tolerance * value[due]
+            rebalancings[numpy.flatnonzero(due)[traded]] += 1
+            value[due] -= cost
+        values[t] = value
+    return values, turnover, costs, rebalancings
+
+
+def statistics(dates, values, turnover, costs, rebalancings):
+    # rows of the statistics sheet: returns, volatility and drawdown in percent, annualized with the dates span
+    years = max((dates[-1] - dates[0]).days / 365.25, 1 / 365.25)
+    periods_per_year = (len(dates) - 1) / years
+    returns = values[1:] / values[:-1] - 1
+    drawdowns = 1 - values / numpy.maximum.accumulate(values, axis=0)
+    total = values[-1] - 1
+    rows = []
+    for k in range(values.shape[1]):
+        rows.append([
+            round(float(total[k]) * 100, 2),
+            round(float((1 + total[k]) ** (1 / years) - 1) * 100, 2),
+            round(float(returns[:, k].std() * numpy.sqrt(periods_per_year)) * 100, 2) if len(returns) > 1 else None,
+            round(float(drawdowns[:, k].max()) * 100, 2),
+            round(float(turnover[k] / years) * 100, 2),
+            int(rebalancings[k]),
+            round(float(costs[k]) * 100, 2)
+        ])
+    return rows
+
+
+def fees(data, isins):
+    # maximum subscription, maximum redemption and conversion fees of the funds as fractions, 0 when unknown
+    fields = ["fee_maximum_subscription", "fee_maximum_redemption", "fee_conversion_rate"]
+    known = {}
+    for record in data:
+        if record["isin"] in isins:
+            known[record["isin"]] = [fundtable.number(record.get(field)) for field in fields]
+    table = numpy.array([known.get(isin, [0.0] * len(fields)) for isin in isins], dtype=float).reshape(len(isins), len(fields))
+    return [numpy.nan_to_num(table[:, k]) / 100 for k in range(len(fields))], [isin for isin in isins if isin not in known]
+
+
+def sheet(data, navs_path, allocations_path, rebalance="quarterly", band=0.0, logger=None):
+    # statistics sheet of the allocations of allocations_path over the NAV history of navs_path
+    dates, nav_isins, navs = read_navs(navs_path)
+    names, isins, targets = read_allocations(allocations_path)
+    missing = [isin for isin in isins if isin not in nav_isins]
+    if missing:
+        raise ValueError(f"No NAV history in {navs_path} for {', '.join(missing)}")
+    navs = navs[:, [nav_isins.index(isin) for isin in isins]]
+
+    # the backtest starts once every fund held by an allocation has a NAV
+    held = targets.max(axis=0) > 0
+    start = int(numpy.isnan(navs[:, held]).any(axis=1).sum())  # NAVs are carried forward, nan only precede the first NAV
+    if start >= len(dates) - 1:
+        raise ValueError(f"The NAV history of {navs_path} has less than 2 dates common to the funds of the allocations")
+    dates, navs = dates[start:], numpy.nan_to_num(navs[start:], nan=1.0)  # funds never held may have no NAV
+
+    (subscription, redemption, conversion), unknown = fees(data, isins)
+    if unknown and logger is not None:
+        logger.warning(f"Backtest: fees of {', '.join(unknown)} unknown, taken as 0")
+    values, turnover, costs, rebalancings = run(dates, navs, targets, subscription, redemption, conversion, rebalance=rebalance, band=band)
+    if logger is not None:
+        logger.info(f"Backtest: {len(names)} allocations of {len(isins)} funds over {len(dates)} dates from {dates[0]} to {dates[-1]}")
+    return {
+        "title": constants.backtest_sheet["title"],
+        "header": constants.backtest_sheet["header"],
+        "rows": [[name] + row for name, row in zip(names, statistics(dates, values, turnover, costs, rebalancings))]
+    }
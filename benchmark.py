@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# benchmarks running on synthetic fund records, no network access needed
+# usage: python benchmark.py memory|shards|table|projection|alternatives|look-through [--sizes 100,1000,5000,20000]
+
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import alternatives
+import fundtable
+import lookthrough
+import projection
+import utils
+import xlsx_fast
+
+
+def synthetic_record(i):
+    # record shaped like the output of arbitrage.get_fund_data
+    rnd = random.Random(i)
+    return {
+        "asset_class": rnd.choice(["Actions", "Obligations", "Monétaire", "Diversifié"]),
+        "asset_region_class": rnd.choice(["Europe", "Eurozone", "Asie-Pacifique", "Amérique du Nord", "Monde"]),
+        "fundshare_id": 100000 + i,
+        "legal_name": f"BNP PARIBAS SYNTHETIC FUND {i}",
+        "legal_form": "SICAV",
+        "creation_date": "2001-01-01",
+        "share_type": "Classic C",
+        "share_size": f"{rnd.randint(10 ** 5, 10 ** 9)}€",
+        "share_vl": f"{round(rnd.uniform(10, 500), 2)}€",
+        "isin": f"FR{i:010d}",
+        "favorite": "",
+        "currency": rnd.choice(["Euro", "Dollar"]),
+        "base_index": ["MSCI World (EUR) NR", "ESTR"],
+        "sri_risk": rnd.randint(1, 7),
+        "morning_star": rnd.randint(0, 5),
+        "pea": rnd.choice(["Yes", "No"]),
+        "source_details": {"url": f"https://www.bnpparibas-am.com/fr-fr/individuel/fundsheet/fund-{i}?tab=overview", "title": "FR"},
+        "policy": ["Le fonds a pour objectif d'accroître la valeur de ses actifs à moyen terme"] * 6,
+        "perf_cumulated": f"{round(rnd.uniform(-20, 80), 2)} %",
+        "perf_cumulated_diff": f"{round(rnd.uniform(-10, 10), 2)} %",
+        "volatility": round(rnd.uniform(1, 25), 2),
+        "sharpe_ratio": round(rnd.uniform(-1, 2), 2),
+        "dic_details": {"url": f"https://docfinder.bnpparibas-am.com/api/files/{i}", "title": "FRE"},
+        "q_notation": rnd.randint(1, 5),
+        "more_details": {"url": f"https://www.quantalys.com/Fonds/{i}", "title": "FR"},
+        "scenario_stressed": f"{round(rnd.uniform(-60, 0), 2)} %",
+        "scenario_unfavorable": f"{round(rnd.uniform(-20, 5), 2)} %",
+        "scenario_moderate": f"{round(rnd.uniform(0, 8), 2)} %",
+        "scenario_favorable": f"{round(rnd.uniform(5, 20), 2)} %",
+        "portfolio_holdings": [f"Holding {k} ({round(rnd.uniform(0, 10), 2)}%)" for k in range(10)],
+        "portfolio_currencies": ["Euro (80.0%)", "Dollar (20.0%)"],
+        "portfolio_sectors": [f"Secteur {k} ({round(rnd.uniform(0, 30), 2)}%)" for k in range(8)],
+        "portfolio_countries": [f"Pays {k} ({round(rnd.uniform(0, 30), 2)}%)" for k in range(8)],
+        "portfolio_weights": {
+            "countries": {f"Pays {rnd.randint(0, 60)}": round(rnd.uniform(0, 30), 2) for _ in range(8)},
+            "currencies": {"Euro": 80.0, rnd.choice(["Dollar", "Yen", "Livre"]): 20.0},
+            "sectors": {f"Secteur {rnd.randint(0, 20)}": round(rnd.uniform(0, 30), 2) for _ in range(8)}
+        },
+        "fee_conversion_rate": 0.0,
+        "fee_ongoing_charges": round(rnd.uniform(0.1, 2.5), 2),
+        "fee_maximum_subscription": rnd.choice([0.0, 2.0, 3.0]),
+        "fee_maximum_redemption": 0.0,
+        "fee_real_ongoing": round(rnd.uniform(0.1, 2.5), 2),
+        "fee_redemption_acquired": 0.0,
+        "fee_maximum_management": 1.5
+    }
+
+
+def synthetic_fund(isin):
+    # stands for arbitrage.get_fund_data in the workers of the pool
+    return synthetic_record(int(isin[2:]))
+
+
+def measure_memory(count, low_memory, results):
+    # runs in its own process so that the RSS high-water mark only covers this run and arbitrage parses its own arguments
+    # the funds go through the real run: arbitrage.gather_data and its pool of workers, then export_to_file with the fast engine,
+    # only the fetch of a fund is replaced by a synthetic record
+    with tempfile.TemporaryDirectory() as directory:
+        sys.argv = ["arbitrage.py", "-o", os.path.join(directory, "benchmark.xlsx"), "--xlsx-engine", "fast", "--progress", "off", "--workers", str(min(8, count))] + (["--low-memory"] if low_memory else [])
+        import arbitrage
+        arbitrage.list_funds = lambda: [f"FR{i:010d}" for i in range(count)]
+        arbitrage.get_fund_data = synthetic_fund
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        start = time.perf_counter()
+        data = arbitrage.gather_data()
+        arbitrage.export_to_file(data=data)
+        if low_memory:
+            data.close()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+    results.put((peak, rss, time.perf_counter() - start))
+
+
+def benchmark_memory(sizes):
+    print(f"{'funds':>8} {'mode':>11} {'tracemalloc peak':>17} {'RSS growth':>11} {'time':>8}")
+    for count in sizes:
+        for low_memory in [False, True]:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure_memory, args=(count, low_memory, results))
+            process.start()
+            peak, rss, duration = results.get()
+            process.join()
+            print(f"{count:>8} {'low-memory' if low_memory else 'list':>11} {peak / 2 ** 20:>14.1f} MB {rss / 2 ** 10:>8.1f} MB {duration:>7.2f}s")
+
+
+def benchmark_shards(sizes):
+    # single sheet against one sheet per asset class generated by 1, 2, 4... processes up to the number of cores
+    worker_counts = sorted({1 << k for k in range((os.cpu_count() or 1).bit_length()) if 1 << k <= (os.cpu_count() or 1)} | {os.cpu_count() or 1})
+    print(f"{'funds':>8} {'mode':>14} {'time':>8}")
+    for count in sizes:
+        data = [synthetic_record(i) for i in range(count)]
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            xlsx_fast.write_workbook(os.path.join(directory, "benchmark.xlsx"), data)
+            print(f"{count:>8} {'single sheet':>14} {time.perf_counter() - start:>7.2f}s")
+            for workers in worker_counts:
+                start = time.perf_counter()
+                xlsx_fast.write_sharded_workbook(os.path.join(directory, "benchmark.xlsx"), data, "asset_class", workers=workers)
+                print(f"{count:>8} {f'{workers} processes':>14} {time.perf_counter() - start:>7.2f}s")
+
+
+def benchmark_table(sizes, repeat=20):
+    # the same selection on the list of records and on the fund table: one class, ongoing charges below 1.5 %, best 5 years performance first
+    conditions = [("asset_class", "=", "Actions"), ("fee_ongoing_charges", "<", "1.5")]
+    keys = [("perf_cumulated", True), ("isin", False)]
+
+    def select_records(records):
+        selected = [record for record in records if record["asset_class"] == "Actions" and float(record["fee_ongoing_charges"]) < 1.5]
+        return sorted(selected, key=lambda record: (-utils.format_cell_value(record["perf_cumulated"], "perf_cumulated")[0], record["isin"]))
+
+    print(f"{'funds':>8} {'list of dicts':>14} {'table build':>12} {'table query':>12} {'speedup':>8}")
+    for count in sizes:
+        records = [synthetic_record(i) for i in range(count)]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            expected = select_records(records)
+        list_time = (time.perf_counter() - start) / repeat
+        start = time.perf_counter()
+        table = fundtable.FundTable(records)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            rows = table.select(conditions, keys)
+        query_time = (time.perf_counter() - start) / repeat
+        if [records[i]["isin"] for i in rows] != [record["isin"] for record in expected]:
+            raise AssertionError("The fund table and the list of records disagree")
+        print(f"{count:>8} {list_time * 1000:>11.2f} ms {build_time * 1000:>9.1f} ms {query_time * 1000:>9.3f} ms {list_time / query_time:>7.0f}x")
+
+
+def benchmark_projection(sizes, paths=1000):
+    # 10000€ then 100€ every month over 5 years, with a single payment the Monte Carlo only draws the sum of the returns
+    print(f"{'funds':>8} {'paths':>12} {'single payment':>15} {'monthly plan':>13}")
+    for count in sizes:
+        records = [synthetic_record(i) for i in range(count)]
+        durations = []
+        for contribution in [0, 100]:
+            start = time.perf_counter()
+            projection.compute(records, 10000, contribution, "monthly", 5, paths=paths)
+            durations.append(time.perf_counter() - start)
+        print(f"{count:>8} {count * paths:>12} {durations[0]:>14.2f}s {durations[1]:>12.2f}s")
+
+
+def benchmark_alternatives(sizes, k=5):
+    # one favorite every 100 funds, the feature matrix is built from the records at every call
+    print(f"{'funds':>8} {'favorites':>10} {'features':>9} {'duration':>10}")
+    for count in sizes:
+        records = [dict(synthetic_record(i), favorite="Favori" if i % 100 == 0 else "") for i in range(count)]
+        start = time.perf_counter()
+        alternatives.sheet(records, k)
+        duration = time.perf_counter() - start
+        print(f"{count:>8} {(count + 99) // 100:>10} {alternatives.features(records)[-1].shape[1]:>9} {duration * 1000:>8.1f} ms")
+
+
+def benchmark_look_through(sizes, funds=50):
+    # sizes are numbers of candidate weightings of a portfolio of 50 funds
+    records = [synthetic_record(i) for i in range(funds)]
+    rnd = random.Random(0)
+    print(f"{'weightings':>10} {'duration':>10}")
+    for count in sizes:
+        weightings = {f"w{k}": {record["isin"]: rnd.random() for record in records} for k in range(count)}
+        start = time.perf_counter()
+        lookthrough.sheet(records, weightings)
+        print(f"{count:>10} {(time.perf_counter() - start) * 1000:>8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic fund records")
+    parser.add_argument("benchmark", choices=["memory", "shards", "table", "projection", "alternatives", "look-through"])
+    parser.add_argument("--sizes", default="100,1000,5000,20000", help="Comma separated numbers of funds (default is %(default)s)")
+    benchmark_args = parser.parse_args()
+    if benchmark_args.benchmark == "memory":
+        benchmark_memory([int(size) for size in benchmark_args.sizes.split(",")])
+    elif benchmark_args.benchmark == "shards":
+        benchmark_shards([int(size) for size in benchmark_args.sizes.split(",")])
+    elif benchmark_args.benchmark == "table":
+        benchmark_table([int(size) for size in benchmark_args.sizes.split(",")])
+    elif benchmark_args.benchmark == "projection":
+        benchmark_projection([int(size) for size in benchmark_args.sizes.split(",")])
+    elif benchmark_args.benchmark == "alternatives":
+        benchmark_alternatives([int(size) for size in benchmark_args.sizes.split(",")])
+    elif benchmark_args.benchmark == "look-through":
+        benchmark_look_through([int(size) for size in benchmark_args.sizes.split(",")])
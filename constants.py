@@ -15,6 +15,69 @@ argparse = {
                     "short": "d",
                     "description": "Enable debugging",
                     "default": False
+                },
+                {
+                    "name": "dump-records",
+                    "description": "Log every fund record once fetched",
+                    "default": False
+                },
+                {
+                    "name": "executor",
+                    "description": "Backend fetching the funds concurrently (default is %(default)s)",
+                    "enum": [
+                        "process", "thread", "asyncio"
+                    ],
+                    "default": "process"
+                },
+                {
+                    "name": "workers",
+                    "description": "Number of funds fetched concurrently, auto measures the throughput during a warm-up and picks it (default is %(default)s)",
+                    "default": "auto"
+                },
+                {
+                    "name": "progress",
+                    "description": "Progress of the fetch: funds completed and failed, requests in flight per host, request rate, bytes received and ETA, as a bar or as periodic log lines, auto draws a bar on a terminal and logs otherwise (default is %(default)s)",
+                    "enum": [
+                        "auto", "bar", "log", "off"
+                    ],
+                    "default": "auto"
+                },
+                {
+                    "name": "profile",
+                    "description": "Directory where cProfile stats per stage and per worker, a folded stacks flame graph and a merged report are written (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "profile-memory",
+                    "description": "With --profile, also take tracemalloc snapshots at the end of every stage",
+                    "default": False
+                },
+                {
+                    "name": "preflight",
+                    "description": "Validate the API payloads of this many randomly chosen funds before the full run, all schema drift is reported at once and the run stops on drift that would make funds fail (disabled by default)",
+                    "type": int,
+                    "default": 0
+                },
+                {
+                    "name": "deadline",
+                    "description": "Seconds allowed to fetch the funds, the requests still running then are stopped and the fields they fill are marked as missing (disabled by default)",
+                    "type": float,
+                    "default": 0
+                },
+                {
+                    "name": "hedge",
+                    "description": "Send a duplicate of the API calls slower than the 95th percentile of their endpoint, the first answer wins",
+                    "default": False
+                },
+                {
+                    "name": "request-cache",
+                    "description": "Share the API responses between the workers of a run so that each distinct request is fetched once per run, worth it when funds share requests (disabled by default)",
+                    "default": False
+                },
+                {
+                    "name": "low-memory",
+                    "description": "Spill fund records to disk as they arrive and stream them into the fast Excel engine, memory stays constant whatever the number of funds",
+                    "default": False
                 }
             ]
         },
@@ -71,6 +134,325 @@ argparse = {
                     "short": "o",
                     "description": "Output Excel file (default is %(default)s)",
                     "default": f"{os.getcwd()}/arbitrage.xlsx"
+                },
+                {
+                    "name": "xlsx-engine",
+                    "description": "Engine writing the Excel file, fast streams the sheet XML straight into the file (default is %(default)s)",
+                    "enum": [
+                        "openpyxl", "fast"
+                    ],
+                    "default": "openpyxl"
+                },
+                {
+                    "name": "query",
+                    "description": "Comma separated conditions selecting the funds written, FIELD then one of = != < <= > >= ~ (contains) then a value, e.g. asset_class=Actions,fee_ongoing_charges<1.5 (all funds by default, requires numpy)",
+                    "default": None
+                },
+                {
+                    "name": "sort",
+                    "description": "Comma separated fields ordering the funds written, - before a field for a descending order, e.g. -perf_cumulated,fee_ongoing_charges (fund list order by default, requires numpy)",
+                    "default": None
+                },
+                {
+                    "name": "group-by",
+                    "description": "Add a sheet of aggregates per value of this field over the funds written (disabled by default, requires numpy)",
+                    "enum": [
+                        "asset_class", "asset_region_class", "currency", "legal_form", "share_type", "pea", "favorite"
+                    ],
+                    "default": None
+                },
+                {
+                    "name": "aggregate",
+                    "description": "Comma separated FIELD:FUNCTION aggregates of --group-by, FUNCTION being sum, mean, median, min or max (default is %(default)s)",
+                    "default": "fee_ongoing_charges:mean,perf_cumulated:mean,volatility:mean,sri_risk:median"
+                },
+                {
+                    "name": "shard-by",
+                    "description": "Write one sheet per asset class or per region, generated in parallel processes, after an index sheet linking to them (disabled by default)",
+                    "enum": [
+                        "asset_class", "asset_region_class"
+                    ],
+                    "default": None
+                },
+                {
+                    "name": "shard-workers",
+                    "description": "Number of processes generating the sheets of --shard-by (default is %(default)s, the number of cores)",
+                    "type": int,
+                    "default": os.cpu_count() or 1
+                },
+                {
+                    "name": "checkpoint-every",
+                    "description": "Write a partial workbook once the favorites are fetched, then every this many funds, the file is replaced atomically (disabled by default)",
+                    "type": int,
+                    "default": 0
+                },
+                {
+                    "name": "static-fills",
+                    "description": "Compute the percentile and category colors once and write them as static fills, plus a sheet of percentile ranks, instead of conditional formatting rules (requires numpy)",
+                    "default": False
+                },
+                {
+                    "name": "lazy-enrichment",
+                    "description": "Write the workbook from the fund data first, the third part notation and details are backfilled in the background then updated in the workbook",
+                    "default": False
+                },
+                {
+                    "name": "enrichment-cache",
+                    "description": "JSON lines file caching the third part enrichment, an interrupted backfill resumes from it (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "enrichment-workers",
+                    "description": "Number of funds enriched concurrently by the backfill (default is %(default)s)",
+                    "type": int,
+                    "default": 4
+                },
+                {
+                    "name": "kid-store",
+                    "description": "Directory where the key information documents of every fund are downloaded, deduplicated and extracted (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "kid-workers",
+                    "description": "Number of key information documents downloaded concurrently (default is %(default)s)",
+                    "type": int,
+                    "default": 16
+                },
+                {
+                    "name": "scenario-history",
+                    "description": "Directory where the full scenario history of every fund is stored as compact numeric arrays (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "update",
+                    "short": "u",
+                    "description": "Update the existing Excel file in place instead of regenerating it, only changed cells are rewritten",
+                    "default": False
+                }
+            ]
+        },
+        {
+            "name": "Service",
+            "items": [
+                {
+                    "name": "serve",
+                    "description": "Run as a long-running service keeping fund data in memory and serving it over HTTP",
+                    "default": False
+                },
+                {
+                    "name": "bind",
+                    "description": "Address the service listens on (default is %(default)s)",
+                    "default": "127.0.0.1"
+                },
+                {
+                    "name": "port",
+                    "description": "Port the service listens on (default is %(default)s)",
+                    "type": int,
+                    "default": 8080
+                },
+                {
+                    "name": "refresh-interval",
+                    "description": "Seconds between two background refreshes of the fund data (default is %(default)s)",
+                    "type": int,
+                    "default": 3600
+                },
+                {
+                    "name": "refresh-workers",
+                    "description": "Maximum number of funds fetched concurrently during a refresh (default is %(default)s)",
+                    "type": int,
+                    "default": 8
+                }
+            ]
+        },
+        {
+            "name": "History",
+            "items": [
+                {
+                    "name": "history-db",
+                    "description": "SQLite file where the fund records of every run are stored (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "history-diff",
+                    "description": "Print the changes between two stored runs (RUN_A,RUN_B or RUN compared with its previous run, a run being an id, latest, previous or a date) or list stored runs with 'runs', then exit",
+                    "default": None
+                },
+                {
+                    "name": "history-isin",
+                    "description": "Print the stored history of an ISIN, then exit",
+                    "default": None
+                },
+                {
+                    "name": "history-fields",
+                    "description": "Comma separated list of record fields compared or printed by history queries and the changes sheet (all fields by default)",
+                    "default": None
+                },
+                {
+                    "name": "changes-sheet",
+                    "description": "Add a sheet listing the changes since the last stored run",
+                    "default": False
+                },
+                {
+                    "name": "replay",
+                    "description": "Build the outputs from the records of a stored run (an id, latest, previous or a date) instead of fetching the funds, the run is not stored again (disabled by default)",
+                    "default": None
+                }
+            ]
+        },
+        {
+            "name": "Projection",
+            "items": [
+                {
+                    "name": "projection-amount",
+                    "description": "Amount invested at once, adds the net of fees value of the investment plan at the horizon for every fund under each KID scenario (disabled by default, requires numpy)",
+                    "type": float,
+                    "default": 0
+                },
+                {
+                    "name": "projection-contribution",
+                    "description": "Amount invested at every contribution period of the investment plan (default is %(default)s)",
+                    "type": float,
+                    "default": 0
+                },
+                {
+                    "name": "projection-frequency",
+                    "description": "Contribution period of the investment plan (default is %(default)s)",
+                    "enum": [
+                        "monthly", "quarterly", "yearly"
+                    ],
+                    "default": "monthly"
+                },
+                {
+                    "name": "projection-horizon",
+                    "description": "Years of the investment plan (default is %(default)s)",
+                    "type": int,
+                    "default": 5
+                },
+                {
+                    "name": "projection-paths",
+                    "description": "Monte Carlo paths per fund drawn with its volatility around the moderate scenario, adds quantiles of the value at the horizon (disabled by default)",
+                    "type": int,
+                    "default": 0
+                },
+                {
+                    "name": "projection-gross-scenarios",
+                    "description": "Deduct the ongoing charges from the KID scenario returns, which are otherwise taken as net of them like PRIIPs scenarios",
+                    "default": False
+                }
+            ]
+        },
+        {
+            "name": "Backtest",
+            "items": [
+                {
+                    "name": "backtest-navs",
+                    "description": "CSV file of NAV histories: a date column (YYYY-MM-DD) then one column per ISIN, adds a sheet backtesting the allocations of --backtest-allocations (disabled by default, requires numpy)",
+                    "default": None
+                },
+                {
+                    "name": "backtest-allocations",
+                    "description": "CSV file of candidate allocations: a name column then one weight column per ISIN",
+                    "default": None
+                },
+                {
+                    "name": "rebalance",
+                    "description": "Rebalancing of the backtested allocations to their target weights (default is %(default)s)",
+                    "enum": [
+                        "monthly", "quarterly", "yearly", "never"
+                    ],
+                    "default": "quarterly"
+                },
+                {
+                    "name": "drift-band",
+                    "description": "Also rebalance an allocation as soon as a weight drifts from its target by more than this many percentage points (disabled by default)",
+                    "type": float,
+                    "default": 0
+                }
+            ]
+        },
+        {
+            "name": "Alternatives",
+            "items": [
+                {
+                    "name": "alternatives",
+                    "description": "Add a sheet of this many cheaper equivalents of every favorite: funds of the same SRI with lower ongoing charges and the most similar metrics and breakdowns (disabled by default, requires numpy)",
+                    "type": int,
+                    "default": 0
+                },
+                {
+                    "name": "alternatives-min-similarity",
+                    "description": "Minimum cosine similarity of an equivalent to its favorite, between -1 and 1 (default is %(default)s)",
+                    "type": float,
+                    "default": 0.5
+                }
+            ]
+        },
+        {
+            "name": "Look-through",
+            "items": [
+                {
+                    "name": "look-through",
+                    "description": "Add a sheet of the country, sector, currency and holding exposures of the favorites portfolio, one column per weight column of the favorites file (weight, weight_NAME...) (requires numpy)",
+                    "default": False
+                }
+            ]
+        },
+        {
+            "name": "Holdings index",
+            "items": [
+                {
+                    "name": "holdings-index",
+                    "description": "SQLite file indexing the holdings, countries, sectors and currencies of the funds with their weight, updated at every run (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "holdings-query",
+                    "description": "Print the funds of the holdings index exposed to a holding, country, sector or currency (case insensitive, * wildcards allowed), then exit",
+                    "default": None
+                },
+                {
+                    "name": "holdings-category",
+                    "description": "Restrict --holdings-query to one breakdown category (all categories by default)",
+                    "enum": [
+                        "countries", "currencies", "holdings", "sectors"
+                    ],
+                    "default": None
+                },
+                {
+                    "name": "holdings-min-weight",
+                    "description": "Minimal weight in percent of the funds printed by --holdings-query (default is %(default)s)",
+                    "type": float,
+                    "default": 0
+                }
+            ]
+        },
+        {
+            "name": "Distributed",
+            "items": [
+                {
+                    "name": "queue",
+                    "description": "Shared work queue used to fetch funds from several hosts: a directory on shared storage or a SQLite file (.db, .sqlite) (disabled by default)",
+                    "default": None
+                },
+                {
+                    "name": "queue-role",
+                    "description": "Role of this process on the work queue (default is %(default)s)",
+                    "enum": [
+                        "coordinator", "worker"
+                    ],
+                    "default": "coordinator"
+                },
+                {
+                    "name": "lease",
+                    "description": "Seconds after which a job claimed by a silent worker is handed out again (default is %(default)s)",
+                    "type": int,
+                    "default": 120
+                },
+                {
+                    "name": "local-workers",
+                    "description": "Number of worker processes started by the coordinator on this host (default is %(default)s)",
+                    "type": int,
+                    "default": 0
                 }
             ]
         }
@@ -88,6 +470,7 @@ type_to_website_prefix = {
 }
 
 favorites_main_key = "isin"
+favorites_weight_prefix = "weight"  # columns of the favorites file holding the weights of a portfolio, see --look-through
 
 more_details_domain = "https://www.quantalys.com"
 more_details_cookie = "UQY4IPIWOASM4GQGUWJBCHPU4VEQPCGBKDRKFXCHSXJIWTIOYPQKCY2NFOO4RZ7LAU6NNSQQX5UVQJT767P677SOKY3SEW74PBUDHBEQEWH4E===;"
@@ -148,6 +531,174 @@ breakdowns_exclude = [
     "FUNDSHEET_HOLDINGS_TITLE_BY_RATINGS"
 ]
 
+executor_max_workers = {  # upper bound of the auto-tuner per backend
+    "process": 32,
+    "thread": 64,
+    "asyncio": 128
+}
+executor_tune_batch = 2  # funds fetched per worker at each warm-up level
+executor_tune_gain = 1.15  # minimal throughput gain to keep doubling the workers
+
+profile_sample_interval = 0.005  # seconds between two stack samples
+profile_traceback_depth = 10  # frames kept by tracemalloc
+profile_report_lines = 25  # functions or allocation sites listed per section of the report
+
+preflight_workers = 8  # funds validated concurrently by the preflight
+
+static_fill_steps = 8  # colors between two colors of a fill-percentile scale with --static-fills
+
+rankings_sheet = {
+    "title": "Rangs"
+}
+
+fund_table = {  # columns of the fund table of --query, --sort and --group-by (see fundtable.py)
+    "numeric": [
+        "share_size", "share_vl", "sri_risk", "morning_star", "q_notation", "perf_cumulated", "perf_cumulated_diff", "volatility", "sharpe_ratio",
+        "scenario_stressed", "scenario_unfavorable", "scenario_moderate", "scenario_favorable",
+        "fee_conversion_rate", "fee_ongoing_charges", "fee_maximum_subscription", "fee_maximum_redemption", "fee_real_ongoing", "fee_redemption_acquired", "fee_maximum_management",
+        "projection_stressed", "projection_unfavorable", "projection_moderate", "projection_favorable", "projection_p5", "projection_p50", "projection_p95"
+    ],
+    "categorical": ["asset_class", "asset_region_class", "currency", "legal_form", "share_type", "pea", "favorite"],
+    "text": ["isin", "legal_name"],
+    "indexes": ["isin", "sri_risk", "perf_cumulated", "volatility", "fee_ongoing_charges", "fee_real_ongoing"],  # sorted indexes, categorical fields always have one
+    "aggregates": ["sum", "mean", "median", "min", "max"],
+    "group_sheet": {
+        "title": "Groupes",
+        "count": "Fonds"
+    }
+}
+
+projection_seed = 0  # seed of the Monte Carlo, a run gives the same quantiles for the same inputs
+projection_percentiles = [5, 50, 95]  # quantiles of the Monte Carlo terminal values written
+projection_chunk_elements = 1 << 22  # monthly returns drawn at once by the Monte Carlo
+projection_frequency_names = {
+    "monthly": "par mois",
+    "quarterly": "par trimestre",
+    "yearly": "par an"
+}
+projection_column = {  # format of the projection columns, see projection.column_group
+    "width": 9,
+    "size": 8,
+    "conditional-formatting": {
+        "fill-percentile": {
+            "start_color": "610000",
+            "mid_color": "946A00",
+            "end_color": "005E23"
+        }
+    }
+}
+
+backtest_trade_tolerance = 1e-9  # trades of a rebalancing below this fraction of the allocation value do not count as a rebalancing
+backtest_sheet = {
+    "title": "Backtest",
+    "header": ["Allocation", "Rendement total %", "Rendement annualisé %", "Volatilité annualisée %", "Perte max %", "Rotation annuelle %", "Rééquilibrages", "Coûts %"]
+}
+
+alternatives = {  # feature vector of the cheaper equivalents of --alternatives (see alternatives.py)
+    "metrics": ["fee_ongoing_charges", "fee_real_ongoing", "sri_risk", "volatility", "sharpe_ratio", "perf_cumulated", "scenario_moderate", "scenario_unfavorable"],
+    "breakdowns": ["countries", "sectors", "currencies"],
+    "weights": {  # share of every block in the similarity
+        "metrics": 2,
+        "countries": 1,
+        "sectors": 1,
+        "currencies": 0.5
+    },
+    "sheet": {
+        "title": "Alternatives",
+        "header": ["Favori", "ISIN favori", "Nom favori", "Frais courants favori %", "Rang", "ISIN", "Nom", "Frais courants %", "Économie (points)", "Similarité %"]
+    }
+}
+
+look_through = {  # exposures of the favorites portfolio of --look-through (see lookthrough.py)
+    "categories": ["countries", "sectors", "currencies", "holdings"],
+    "total": "Total ventilé",
+    "sheet": {
+        "title": "Transparence",
+        "header": ["Ventilation", "Libellé"]  # then one column per weighting
+    }
+}
+
+shard_index_sheet = {  # first sheet of the workbooks written with --shard-by
+    "title": "Index",
+    "header": ["Feuille", "Fonds", "Favoris"],
+    "unknown": "Non classé"  # sheet of the funds without a value for the shard field
+}
+
+changes_sheet = {  # changes since the previous run of --changes-sheet (see history.changes_sheet)
+    "title": "Évolutions",
+    "header": ["ISIN", "Champ", "Avant", "Après"]
+}
+
+enrichment_cache_days = 7  # enrichment cache entries older than this are fetched again
+
+request_cache_lease = 120  # seconds before a request being fetched by a worker is considered lost
+request_cache_failure_ttl = 5  # seconds a failed request is reported to the workers waiting for it
+request_cache_poll_interval = 0.05  # seconds between two checks of a request being fetched by another worker
+
+transport_chunk_size = 1 << 16  # bytes read at once from an API response
+transport_error_excerpt = 1000  # bytes of an invalid JSON response logged
+
+request_timeouts = {  # (connect, read) seconds per host, read is the longest wait between two received bytes
+    "default": (5, 30),
+    "api.bnpparibas-am.com": (5, 30),
+    "www.quantalys.com": (5, 15)
+}
+progress = {  # live progress of --progress (see progress.py)
+    "slots": 1024,  # counters of as many worker threads, more threads share slots
+    "bar_interval": 0.5,  # seconds between two refreshes of the bar
+    "log_interval": 30,  # seconds between two log lines
+    "rate_window": 10,  # seconds over which the request rate and the ETA are measured
+    "bar_width": 30
+}
+hedge_window = 200  # latest call durations per endpoint giving the 95th percentile of --hedge
+hedge_min_samples = 20  # calls of an endpoint observed before hedging its calls
+hedge_threads = 8  # threads sending the hedged calls of a worker process
+late_mark = "N/A (timeout)"  # value of the fields of a request that did not answer in time
+
+scenario_fields = {
+    "scenario_stressed": "num02120_portfolio_return_stress_scenario_rhp_or_first_call_dat",
+    "scenario_unfavorable": "num02030_portfolio_return_unfavourable_scenario_rhp_or_first_ca",
+    "scenario_moderate": "num02060_portfolio_return_moderate_scenario_rhp_or_first_call_d",
+    "scenario_favorable": "num02090_portfolio_return_favourable_scenario_rhp_or_first_call"
+}
+
+kid_figures = {  # labels of the French (DIC) and English (KID) documents, the figure is the first group matched
+    "entry_costs": r"(?:Coûts d'entrée|Entry costs).{0,200}?(\d+(?:[.,]\d+)?)\s?%",
+    "exit_costs": r"(?:Coûts de sortie|Exit costs).{0,200}?(\d+(?:[.,]\d+)?)\s?%",
+    "ongoing_costs": r"(?:Frais de gestion et autres frais administratifs (?:et|ou) d'exploitation|Management fees and other administrative (?:and|or) operating costs).{0,200}?(\d+(?:[.,]\d+)?)\s?%",
+    "transaction_costs": r"(?:Coûts de transaction|Transaction costs).{0,200}?(\d+(?:[.,]\d+)?)\s?%",
+    "risk_class": r"classe de risque (\d)\s?sur\s?7|classified this product as (\d)\s?out of\s?7",
+    "scenario_stressed": r"(?:Tensions|Stress).{0,200}?(?:Rendement annuel moyen|Average return each year)\s?([-\u2212]?\s?\d+(?:[.,]\d+)?)\s?%",
+    "scenario_unfavorable": r"(?:Défavorable|Unfavourable).{0,200}?(?:Rendement annuel moyen|Average return each year)\s?([-\u2212]?\s?\d+(?:[.,]\d+)?)\s?%",
+    "scenario_moderate": r"(?:Intermédiaire|Moderate).{0,200}?(?:Rendement annuel moyen|Average return each year)\s?([-\u2212]?\s?\d+(?:[.,]\d+)?)\s?%",
+    "scenario_favorable": r"(?<![a-zà-ÿ])(?:Favorable|Favourable).{0,200}?(?:Rendement annuel moyen|Average return each year)\s?([-\u2212]?\s?\d+(?:[.,]\d+)?)\s?%"
+}
+
+kid_max_age = 7 * 24 * 3600  # seconds a document served without ETag nor Last-Modified is reused before being downloaded again
+kid_sheet = {  # sheet of the figures extracted from the key information documents (see kid.sheet)
+    "title": "DIC",
+    "header": ["ISIN", "Empreinte SHA-256"],
+    "figures": {
+        "entry_costs": "Coûts d'entrée %",
+        "exit_costs": "Coûts de sortie %",
+        "ongoing_costs": "Frais de gestion %",
+        "transaction_costs": "Coûts de transaction %",
+        "risk_class": "Classe de risque",
+        "scenario_stressed": "Tensions %",
+        "scenario_unfavorable": "Défavorable %",
+        "scenario_moderate": "Intermédiaire %",
+        "scenario_favorable": "Favorable %"
+    }
+}
+
+queue_max_attempts = 3
+queue_poll_interval = 1
+
+removed_fund = {
+    "color": "8B0000",
+    "comment": "Fund not found anymore since"
+}
+
 worksheet = {
     "color":  "1072BA",
     "title":  "Assets"
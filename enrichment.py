@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import datetime
+import json
+import os
+import threading
+from pylogger_unified import logger as pylogger_unified
+import constants
+
+# third party enrichment (Quantalys) fetched apart from the fund data, see --lazy-enrichment
+# results are appended to a JSON lines cache as soon as they arrive, so an interrupted backfill resumes where it stopped
+# a failure only leaves the enrichment fields of that fund empty
+
+
+class EnrichmentCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path is None or not os.path.exists(path):
+            return
+        expiry = (datetime.datetime.utcnow() - datetime.timedelta(days=constants.enrichment_cache_days)).isoformat()
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line of an interrupted backfill
+                if entry["date"] >= expiry:
+                    self.entries[entry["isin"]] = entry["fields"]
+
+    def get(self, isin):
+        return self.entries.get(isin)
+
+    def put(self, isin, fields):
+        with self.lock:
+            self.entries[isin] = fields
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps({"isin": isin, "date": datetime.datetime.utcnow().isoformat(), "fields": fields}, ensure_ascii=False) + "\n")
+
+
+class Backfill(threading.Thread):
+    # runs in the background while the workbook is written from the fund data
+    # join() returns the updates to apply to the records: isin -> enrichment fields
+
+    def __init__(self, funds, fetch, cache_path, workers, debug=False):
+        super().__init__(daemon=True)
+        self.funds = funds
+        self.fetch = fetch
+        self.cache = EnrichmentCache(cache_path)
+        self.workers = workers
+        self.logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="enrichment")
+        self.updates = {}
+
+    def run(self):
+        missing = []
+        for isin in self.funds:
+            fields = self.cache.get(isin)
+            if fields is None:
+                missing.append(isin)
+            else:
+                self.updates[isin] = fields
+        self.logger.info(f"Enrichment backfill: {len(self.updates)} funds from cache, {len(missing)} to fetch")
+
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, isin): isin for isin in missing}
+            for future in concurrent.futures.as_completed(futures):
+                isin = futures[future]
+                try:
+                    fields = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Failed to enrich {isin}: {e}")
+                    failed += 1
+                    continue
+                self.cache.put(isin, fields)
+                self.updates[isin] = fields
+        self.logger.info(f"Enrichment backfill done: {len(self.updates)} funds enriched, {failed} failed")
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        return self.updates
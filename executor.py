@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+import threading
+import time
+from pylogger_unified import logger as pylogger_unified
+import constants
+import progress
+import transport
+
+# execution backends used to fetch the funds
+# every backend hands out concurrent.futures futures so that the ordered map and the auto-tuner work the same on all of them
+
+
+class ProcessBackend:
+
+    def __init__(self, workers):
+        # the progress counters are shared with the workers, whatever the start method
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(), initializer=progress.attach, initargs=(progress.state,))
+
+    def submit(self, fn, item):
+        return self.executor.submit(fn, item)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class ThreadBackend:
+
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, fn, item):
+        return self.executor.submit(fn, item)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class AsyncioBackend:
+    # event loop running in its own thread, the blocking fetch runs in the loop default executor
+    # the semaphore bounds the number of fetches in flight
+
+    def __init__(self, workers):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.make_semaphore(workers), self.loop).result()
+
+    async def make_semaphore(self, workers):
+        return asyncio.Semaphore(workers)
+
+    async def run(self, fn, item):
+        async with self.semaphore:
+            return await self.loop.run_in_executor(None, fn, item)
+
+    def submit(self, fn, item):
+        return asyncio.run_coroutine_threadsafe(self.run(fn, item), self.loop)
+
+    def shutdown(self):
+        asyncio.run_coroutine_threadsafe(self.loop.shutdown_default_executor(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+backends = {
+    "process": ProcessBackend,
+    "thread": ThreadBackend,
+    "asyncio": AsyncioBackend
+}
+
+
+def timed_call(arguments):
+    # runs in the worker, the latency is measured where the fetch happens
+    fn, item = arguments
+    start = time.perf_counter()
+    result = fn(item)
+    return result, time.perf_counter() - start
+
+
+def map_window(backend, fn, items, window):
+    # yields fn(item) in the order of items with window calls in flight at all times: a call is submitted as soon as any call ends,
+    # the results that end before the ones submitted earlier wait in a reorder buffer, so a slow item only delays its own result
+    items = iter(items)
+    pending = {}  # future -> position of its item
+    finished = {}  # position -> future ended out of order
+    submitted = 0
+    following = 0
+    for item in itertools.islice(items, window):
+        pending[backend.submit(fn, item)] = submitted
+        submitted += 1
+    while pending or finished:
+        if following in finished:
+            yield finished.pop(following).result()
+            following += 1
+            continue
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            finished[pending.pop(future)] = future
+            for item in itertools.islice(items, 1):
+                pending[backend.submit(fn, item)] = submitted
+                submitted += 1
+
+
+class Resizable:
+    # pool recreated with the number of workers of every warm-up level: processes are only started once a level needs them
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.pool = None
+        self.workers = 0
+
+    def resize(self, workers):
+        if workers != self.workers:
+            self.shutdown()
+            self.pool = backends[self.backend](workers)
+            self.workers = workers
+
+    def submit(self, fn, item):
+        return self.pool.submit(fn, item)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def tune(backend, fn, funds, max_workers, logger):
+    # warm-up: the first funds are fetched with a growing number of workers in flight (1, 2, 4...)
+    # the growth stops as soon as the throughput does not improve enough, the best level is kept
+    # warm-up records are yielded as they come, nothing is fetched twice
+    # backend is a Resizable pool, grown with the level probed
+    # returns the chosen number of workers and the number of funds already fetched
+    levels = []
+    position = 0
+    workers = 1
+    while workers <= max_workers and position < len(funds):
+        batch = funds[position:position + workers * constants.executor_tune_batch]
+        position += len(batch)
+        backend.resize(workers)
+        latencies = []
+        start = time.perf_counter()
+        for result, latency in map_window(backend, timed_call, [(fn, isin) for isin in batch], workers):
+            latencies.append(latency)
+            yield result
+        elapsed = time.perf_counter() - start
+        throughput = len(batch) / elapsed if elapsed else float("inf")
+        latency = sum(latencies) / len(latencies)
+        levels.append((workers, throughput, latency))
+        logger.debug(f"Warm-up with {workers} workers: {throughput:.2f} funds/s, mean latency {latency:.2f}s over {len(batch)} funds")
+        best = max(levels, key=lambda level: level[1])
+        if best[0] != workers or len(batch) < workers * constants.executor_tune_batch:
+            break
+        if len(levels) > 1 and throughput < levels[-2][1] * constants.executor_tune_gain:
+            break
+        workers *= 2
+
+    workers, throughput, latency = max(levels, key=lambda level: level[1])
+    tried = ", ".join(f"{level[0]}: {level[1]:.2f}/s" for level in levels)
+    logger.info(f"Auto-tuned workers: {workers} ({throughput:.2f} funds/s, mean latency {latency:.2f}s; tried {tried})")
+    return workers, position
+
+
+def map_records(fn, funds, backend="process", workers="auto", debug=False):
+    # fetches the funds with the chosen backend and yields the records in the order of funds
+    # the transport stats of every call are reported with its record and merged in this process
+    for record, stats in map_calls(transport.Accounted(fn), funds, backend, workers, debug):
+        transport.merge(stats)
+        yield record
+
+
+def map_calls(fn, funds, backend, workers, debug):
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="executor")
+    funds = list(funds)
+    if not funds:
+        return
+
+    if workers == "auto":
+        max_workers = min(constants.executor_max_workers[backend], len(funds))
+        pool = Resizable(backend)
+        try:
+            workers, position = yield from tune(pool, fn, funds, max_workers, logger)
+            # idle processes are not kept around, each one holds its own copy of the interpreter
+            pool.resize(workers)
+            yield from map_window(pool, fn, funds[position:], workers)
+        finally:
+            pool.shutdown()
+        return
+
+    logger.info(f"Fetching {len(funds)} funds with {workers} {backend} workers")
+    pool = backends[backend](workers)
+    try:
+        yield from map_window(pool, fn, funds, workers)
+    finally:
+        pool.shutdown()
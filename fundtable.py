@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import operator
+import constants
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# columnar view of the fund records used to select, order and aggregate the funds written (--query, --sort, --group-by)
+# numeric fields are float arrays (nan when not numeric), categorical fields are dictionary encoded: sorted categories and int32 codes
+# so that comparing or ordering codes compares the categories, text fields are object arrays
+# sorted indexes answer range conditions with two binary searches, queries return row numbers and never copy the records
+
+currency_symbols = "".join(set(constants.currency_code_to_symbol.values()))
+
+aggregates = {
+    "sum": lambda values: float(values.sum()),
+    "mean": lambda values: float(values.mean()),
+    "median": lambda values: float(numpy.median(values)),
+    "min": lambda values: float(values.min()),
+    "max": lambda values: float(values.max())
+}
+
+
+def number(value):
+    # numeric value of a record field: plain numbers, percentages and amounts followed by a currency symbol
+    if isinstance(value, bool):
+        return numpy.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.rstrip(currency_symbols).rstrip("% "))
+        except ValueError:
+            return numpy.nan
+    return numpy.nan
+
+
+class FundTable:
+
+    def __init__(self, records):
+        self.size = len(records)
+        self.numeric = {field: numpy.fromiter((number(record.get(field)) for record in records), dtype=float, count=self.size) for field in constants.fund_table["numeric"]}
+        self.categories = {}
+        self.codes = {}
+        for field in constants.fund_table["categorical"]:
+            categories, codes = numpy.unique(numpy.array([str(record.get(field) or "") for record in records], dtype=object), return_inverse=True)
+            self.categories[field] = [str(category) for category in categories]
+            self.codes[field] = codes.astype(numpy.int32)
+        self.text = {field: numpy.array([str(record.get(field) or "") for record in records], dtype=object) for field in constants.fund_table["text"]}
+
+        # sorted indexes: row numbers in the order of the values, nan last
+        self.indexes = {}
+        self.sorted = {}
+        for field in constants.fund_table["indexes"] + constants.fund_table["categorical"]:
+            column = self.column(field)
+            self.indexes[field] = numpy.argsort(column, kind="stable")
+            self.sorted[field] = column[self.indexes[field]]
+
+    def column(self, field):
+        if field in self.numeric:
+            return self.numeric[field]
+        if field in self.codes:
+            return self.codes[field]
+        return self.text[field]
+
+    def key(self, field, value):
+        # value compared with the column: float for numeric fields, [first code, last code + 1) of the value for categorical fields
+        if field in self.numeric:
+            return float(value)
+        if field in self.codes:
+            return bisect.bisect_left(self.categories[field], value), bisect.bisect_right(self.categories[field], value)
+        return value
+
+    def index_bounds(self, field, op, value):
+        # [low, high) positions in the sorted index of the rows matching the condition
+        ordered = self.sorted[field]
+        key = self.key(field, value)
+        if field in self.codes:
+            left, right = (int(numpy.searchsorted(ordered, code, side="left")) for code in key)
+        else:
+            left, right = int(numpy.searchsorted(ordered, key, side="left")), int(numpy.searchsorted(ordered, key, side="right"))
+        end = self.size
+        if field in self.numeric:
+            end -= int(numpy.isnan(ordered).sum())  # nan matches no range
+        return {"=": (left, right), "<": (0, left), "<=": (0, right), ">": (right, end), ">=": (left, end)}[op]
+
+    def mask(self, field, op, value):
+        # boolean mask of the rows matching field op value
+        if op == "!=":
+            return ~self.mask(field, "=", value)
+        if op == "~":
+            value = value.casefold()
+            if field in self.codes:
+                matching = [code for code, category in enumerate(self.categories[field]) if value in category.casefold()]
+                return numpy.isin(self.codes[field], matching)
+            return numpy.fromiter((value in str(val).casefold() for val in self.column(field)), dtype=bool, count=self.size)
+        if field in self.indexes:
+            low, high = self.index_bounds(field, op, value)
+            mask = numpy.zeros(self.size, dtype=bool)
+            mask[self.indexes[field][low:high]] = True
+            return mask
+        column = self.column(field)
+        key = self.key(field, value)
+        return numpy.asarray({"=": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}[op](column, key), dtype=bool)
+
+    def filter(self, conditions):
+        # row numbers matching all the conditions (field, op, value), in record order
+        mask = numpy.ones(self.size, dtype=bool)
+        for field, op, value in conditions:
+            mask &= self.mask(field, op, value)
+        return numpy.flatnonzero(mask)
+
+    def sort(self, keys, rows=None):
+        # rows ordered by the keys (field, descending), first key first, ties keep the record order, nan last
+        if rows is None:
+            rows = numpy.arange(self.size)
+        if not keys:
+            return rows
+        if len(keys) == 1 and not keys[0][1] and keys[0][0] in self.indexes and len(rows) == self.size:
+            return self.indexes[keys[0][0]]
+        columns = []
+        for field, descending in reversed(keys):  # numpy.lexsort sorts on the last key first
+            column = self.column(field)[rows]
+            if field in self.text:
+                column = numpy.unique(column, return_inverse=True)[1]
+            columns.append(-column if descending else column)
+        return rows[numpy.lexsort(columns)]
+
+    def select(self, conditions, keys):
+        return self.sort(keys, self.filter(conditions))
+
+    def group_by(self, field, functions, rows=None):
+        # one row per value of field: value, number of funds, then the aggregates (field, function) over the numeric values
+        if rows is None:
+            rows = numpy.arange(self.size)
+        codes = self.codes[field][rows]
+        order = numpy.argsort(codes, kind="stable")
+        codes = codes[order]
+        boundaries = numpy.flatnonzero(numpy.diff(codes)) + 1
+        starts = numpy.concatenate([[0], boundaries]) if len(codes) else []
+        segments = {column: numpy.split(self.numeric[column][rows][order], boundaries) for column, _ in functions}
+        groups = []
+        for k, start in enumerate(starts):
+            row = [self.categories[field][codes[start]], int((boundaries[k] if k < len(boundaries) else len(codes)) - start)]
+            for column, function in functions:
+                values = segments[column][k]
+                values = values[~numpy.isnan(values)]
+                row.append(round(aggregates[function](values), 2) if len(values) else None)
+            groups.append(row)
+        return groups
+
+    def group_sheet(self, field, functions, rows=None):
+        names = {subitem["ref"]: subitem["name"].replace("\n", " ") for item in constants.column_mapping for subitem in item["items"]}
+        return {
+            "title": constants.fund_table["group_sheet"]["title"],
+            "header": [names.get(field, field), constants.fund_table["group_sheet"]["count"]] + [f"{names.get(column, column)} ({function})" for column, function in functions],
+            "rows": self.group_by(field, functions, rows)
+        }
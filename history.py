@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+import constants
+import utils
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY AUTOINCREMENT, run_date TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS snapshots (run_id INTEGER NOT NULL, isin TEXT NOT NULL, run_date TEXT NOT NULL, record TEXT NOT NULL, PRIMARY KEY (run_id, isin))",
+    "CREATE INDEX IF NOT EXISTS snapshots_isin_date ON snapshots (isin, run_date)",
+]
+
+
+def open_store(path):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def save_run(connection, data, run_date=None):
+    if run_date is None:
+        run_date = utils.get_utc_time()
+    with connection:
+        run_id = connection.execute("INSERT INTO runs (run_date) VALUES (?)", (run_date,)).lastrowid
+        connection.executemany(
+            "INSERT INTO snapshots (run_id, isin, run_date, record) VALUES (?, ?, ?, ?)",
+            ((run_id, record["isin"], run_date, json.dumps(record, ensure_ascii=False, sort_keys=True)) for record in data)
+        )
+    return run_id
+
+
+def list_runs(connection):
+    return connection.execute("SELECT runs.id, runs.run_date, COUNT(snapshots.isin) FROM runs LEFT JOIN snapshots ON snapshots.run_id = runs.id GROUP BY runs.id ORDER BY runs.id").fetchall()
+
+
+def resolve_run(connection, ref):
+    # a run is referenced by its id, by "latest", by "previous" or by a date prefix (latest run of that day)
+    ref = str(ref).strip()
+    if ref.isdigit():
+        row = connection.execute("SELECT id FROM runs WHERE id = ?", (int(ref),)).fetchone()
+    elif ref == "latest":
+        row = connection.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+    elif ref == "previous":
+        row = connection.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET 1").fetchone()
+    else:
+        row = connection.execute("SELECT id FROM runs WHERE run_date LIKE ? ORDER BY id DESC LIMIT 1", (ref + "%",)).fetchone()
+    if row is None:
+        raise ValueError(f"Run {ref} not found in history")
+    return row[0]
+
+
+def latest_run(connection, before=None):
+    # id of the latest run stored (before run id before when given), None when there is none
+    if before is None:
+        row = connection.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+    else:
+        row = connection.execute("SELECT id FROM runs WHERE id < ? ORDER BY id DESC LIMIT 1", (before,)).fetchone()
+    return None if row is None else row[0]
+
+
+def previous_run(connection, run_id):
+    row = connection.execute("SELECT id FROM runs WHERE id < ? ORDER BY id DESC LIMIT 1", (run_id,)).fetchone()
+    if row is None:
+        raise ValueError(f"No run stored before run {run_id}")
+    return row[0]
+
+
+def load_run(connection, run_id):
+    return {isin: json.loads(record) for isin, record in connection.execute("SELECT isin, record FROM snapshots WHERE run_id = ?", (run_id,))}
+
+
+def diff_records(old_records, new_records, fields=None):
+    # returns (isin, field, old value, new value) for every change between two sets of records
+    # funds added or removed appear with a None record on the missing side
+    # fields of a request that did not answer in time (constants.late_mark) on either side are not compared
+    changes = []
+    for isin in sorted(set(old_records) | set(new_records)):
+        old = old_records.get(isin)
+        new = new_records.get(isin)
+        if old is None or new is None:
+            changes.append((isin, "added" if old is None else "removed", None, None))
+            continue
+        for field in fields if fields else sorted(set(old) | set(new)):
+            if old.get(field) != new.get(field) and constants.late_mark not in (old.get(field), new.get(field)):
+                changes.append((isin, field, old.get(field), new.get(field)))
+    return changes
+
+
+def diff_runs(connection, run_a, run_b, fields=None):
+    return diff_records(load_run(connection, run_a), load_run(connection, run_b), fields=fields)
+
+
+def isin_history(connection, isin, fields=None):
+    rows = []
+    for run_date, record in connection.execute("SELECT run_date, record FROM snapshots WHERE isin = ? ORDER BY run_date", (isin.upper(),)):
+        record = json.loads(record)
+        rows.append((run_date, {field: record.get(field) for field in fields} if fields else record))
+    return rows
+
+
+def format_value(value):
+    if isinstance(value, list):
+        return ", ".join(str(v) for v in value)
+    if isinstance(value, dict):
+        return value["url"] if "url" in value else json.dumps(value, ensure_ascii=False, sort_keys=True)
+    if value is None:
+        return ""
+    return str(value)
+
+
+def field_names():
+    return {subitem["ref"]: subitem["name"].replace("\n", " ") for item in constants.column_mapping for subitem in item["items"]}
+
+
+def changes_sheet(connection, run_id, data, fields=None):
+    # builds the "changes since last run" sheet comparing a stored run with the current records, empty without stored run (run_id None)
+    names = field_names()
+    changes = diff_records(load_run(connection, run_id), {record["isin"]: record for record in data}, fields=fields) if run_id is not None else []
+    return {
+        "title": constants.changes_sheet["title"],
+        "header": constants.changes_sheet["header"],
+        "rows": [[isin, names.get(field, field), format_value(old), format_value(new)] for isin, field, old, new in changes]
+    }
+
+
+def query(args):
+    connection = open_store(args.history_db)
+    fields = args.history_fields.split(",") if args.history_fields else None
+    if args.history_isin:
+        for run_date, values in isin_history(connection, args.history_isin, fields=fields):
+            print("\t".join([run_date] + [f"{field}={format_value(value)}" for field, value in values.items()]))
+        return
+    refs = args.history_diff.split(",")
+    if refs == ["runs"]:
+        for run_id, run_date, count in list_runs(connection):
+            print(f"{run_id}\t{run_date}\t{count}")
+        return
+    if len(refs) == 1:
+        # a single run is compared with the run preceding it
+        run_b = resolve_run(connection, refs[0])
+        run_a = previous_run(connection, run_b)
+    else:
+        run_a, run_b = (resolve_run(connection, ref) for ref in refs)
+    for isin, field, old, new in diff_runs(connection, run_a, run_b, fields=fields):
+        print(f"{isin}\t{field}\t{format_value(old)}\t{format_value(new)}")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import utils
+
+# inverted index of the portfolio breakdowns: (category, label) -> funds and their weight in percent
+# updated at every run for the funds fetched, funds not fetched keep the rows of their last run
+# labels are matched case insensitively through label_key, indexed with the weight so that threshold queries read the index only
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS funds (isin TEXT PRIMARY KEY, legal_name TEXT, updated TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS exposures (category TEXT NOT NULL, label_key TEXT NOT NULL, label TEXT NOT NULL, isin TEXT NOT NULL, weight REAL NOT NULL, PRIMARY KEY (category, label_key, isin)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS exposures_label_weight ON exposures (label_key, weight)",
+    "CREATE INDEX IF NOT EXISTS exposures_isin ON exposures (isin)",
+]
+
+
+def open_index(path):
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def label_key(label):
+    return " ".join(label.casefold().split())
+
+
+def update(connection, data, updated=None):
+    # replaces the rows of every fund of data that has portfolio weights, returns the number of funds indexed
+    if updated is None:
+        updated = utils.get_utc_time()
+    count = 0
+    with connection:
+        for record in data:
+            weights = record.get("portfolio_weights")
+            if not isinstance(weights, dict):
+                continue  # holdings not fetched (deadline, older stored run): the previous rows are kept
+            connection.execute("DELETE FROM exposures WHERE isin = ?", (record["isin"],))
+            connection.executemany(
+                "INSERT OR REPLACE INTO exposures (category, label_key, label, isin, weight) VALUES (?, ?, ?, ?, ?)",
+                ((category, label_key(label), label, record["isin"], weight) for category, labels in weights.items() for label, weight in labels.items())
+            )
+            connection.execute("INSERT OR REPLACE INTO funds (isin, legal_name, updated) VALUES (?, ?, ?)", (record["isin"], record.get("legal_name"), updated))
+            count += 1
+    return count
+
+
+def find(connection, label, category=None, min_weight=0):
+    # funds exposed to label (* and ? wildcards allowed), largest weight first
+    # returns (isin, legal name, category, label, weight)
+    key = label_key(label)
+    conditions = ["exposures.label_key GLOB ?" if any(c in key for c in "*?[") else "exposures.label_key = ?", "exposures.weight >= ?"]
+    parameters = [key, min_weight]
+    if category is not None:
+        conditions.append("exposures.category = ?")
+        parameters.append(category)
+    return connection.execute(
+        "SELECT exposures.isin, funds.legal_name, exposures.category, exposures.label, exposures.weight FROM exposures "
+        f"LEFT JOIN funds ON funds.isin = exposures.isin WHERE {' AND '.join(conditions)} ORDER BY exposures.weight DESC, exposures.isin",
+        parameters
+    ).fetchall()
+
+
+def query(args):
+    connection = open_index(args.holdings_index)
+    for isin, legal_name, category, label, weight in find(connection, args.holdings_query, category=args.holdings_category, min_weight=args.holdings_min_weight):
+        print(f"{isin}\t{legal_name or ''}\t{category}\t{label}\t{weight:.2f} %")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from pylogger_unified import logger as pylogger_unified
+import constants
+import utils
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# key information documents (KID/DIC) store
+# documents are stored once per content hash, the index keeps the validators of every url
+# so that unchanged documents are neither downloaded nor extracted again on later runs
+# documents served without validator (ETag, Last-Modified) are reused as stored until constants.kid_max_age old
+
+
+class DocumentStore:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        self.index_path = os.path.join(path, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                self.index = json.load(file)
+
+    def object_path(self, digest, extension):
+        return os.path.join(self.path, "objects", f"{digest}.{extension}")
+
+    def save_index(self):
+        write_file(self.index_path, json.dumps(self.index, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8"))
+
+    def figures(self, digest):
+        with open(self.object_path(digest, "json"), "r", encoding="utf-8") as file:
+            return json.load(file)
+
+
+def write_file(path, content):
+    # content written to a temporary file of its own then moved into place: threads storing the same document do not collide
+    # and a file is never read half written
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def extract_text(pdf_path):
+    reader = pypdf.PdfReader(pdf_path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_figures(text):
+    # first percentage (or risk class) found after each label of constants.kid_figures
+    figures = {}
+    flat_text = re.sub(r"\s+", " ", text)
+    for name, pattern in constants.kid_figures.items():
+        match = re.search(pattern, flat_text, flags=re.IGNORECASE)
+        if match:
+            figures[name] = float(next(group for group in match.groups() if group is not None).replace(",", ".").replace(" ", "").replace("\u2212", "-"))
+    return figures
+
+
+def process_document(store, isin, url, logger):
+    # returns (isin, digest, figures, status, index entry) where status is downloaded, deduplicated, unchanged or cached
+    known = store.index.get(url)
+    headers = {}
+    if known and os.path.exists(store.object_path(known["hash"], "json")):
+        if not known.get("etag") and not known.get("last_modified") and time.time() - known.get("checked", 0) < constants.kid_max_age:
+            return isin, known["hash"], store.figures(known["hash"]), "cached", known
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
+
+    response = utils.download_data(url, headers=headers)
+    if response.status_code == 304:
+        return isin, known["hash"], store.figures(known["hash"]), "unchanged", dict(known, checked=time.time())
+
+    digest = hashlib.sha256(response.content).hexdigest()
+    entry = {
+        "isin": isin,
+        "hash": digest,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "checked": time.time()
+    }
+    if os.path.exists(store.object_path(digest, "json")):
+        return isin, digest, store.figures(digest), "deduplicated", entry
+
+    pdf_path = store.object_path(digest, "pdf")
+    write_file(pdf_path, response.content)
+
+    figures = {}
+    if pypdf is not None:
+        try:
+            text = extract_text(pdf_path)
+        except Exception as e:
+            logger.warning(f"Failed to extract text from the document of {isin}: {e}")
+        else:
+            write_file(store.object_path(digest, "txt"), text.encode("utf-8"))
+            figures = extract_figures(text)
+    # the figures are written last, their file tells that the document is stored
+    write_file(store.object_path(digest, "json"), json.dumps(figures, ensure_ascii=False).encode("utf-8"))
+    return isin, digest, figures, "downloaded", entry
+
+
+def fetch_documents(data, store_path, workers, debug=False):
+    # downloads the key information document of every fund concurrently
+    # returns the updates to apply to the records: isin -> {"kid_hash": ..., "kid_figures": ...}
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="kid")
+    if pypdf is None:
+        logger.warning("pypdf is not installed, documents are stored without text extraction")
+
+    store = DocumentStore(store_path)
+    documents = [(record["isin"], record["dic_details"]["url"]) for record in data if isinstance(record.get("dic_details"), dict)]
+    updates = {}
+    statuses = {"downloaded": 0, "deduplicated": 0, "unchanged": 0, "cached": 0, "failed": 0}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_document, store, isin, url, logger): (isin, url) for isin, url in documents}
+        for future in concurrent.futures.as_completed(futures):
+            isin, url = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to get the document of {isin}: {e}")
+                statuses["failed"] += 1
+                continue
+            isin, digest, figures, status, entry = result
+            store.index[url] = entry
+            statuses[status] += 1
+            updates[isin] = {
+                "kid_hash": digest,
+                "kid_figures": figures
+            }
+
+    store.save_index()
+    logger.info(f"Key information documents: {', '.join(f'{count} {status}' for status, count in statuses.items())}")
+    return updates
+
+
+def sheet(data):
+    # figures extracted from the key information document of every fund that has one
+    names = constants.kid_sheet["figures"]
+    rows = []
+    for record in data:
+        if record.get("kid_hash"):
+            figures = record.get("kid_figures") or {}
+            rows.append([record["isin"], record["kid_hash"]] + [figures.get(name) for name in names])
+    return {
+        "title": constants.kid_sheet["title"],
+        "header": constants.kid_sheet["header"] + list(names.values()),
+        "rows": rows
+    }
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import constants
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# look-through exposure of the favorites portfolio: the breakdowns of the funds weighted by the weight columns of the favorites file
+# the numeric breakdowns of every fund (portfolio_weights) form a sparse (funds, labels) matrix kept as coordinates sorted by label,
+# the exposures of all the weightings are the product weightings @ breakdowns: the coordinates are scaled by the weight of their fund
+# for every weighting at once, then summed per label with one numpy.add.reduceat
+
+
+def coordinates(data, isins, categories):
+    # category -> (fund positions in isins, label of every coordinate, weights as fractions) sorted by label, the records are read once
+    # funds without breakdown have no coordinate
+    positions = {isin: k for k, isin in enumerate(isins)}
+    entries = {category: [] for category in categories}
+    for record in data:
+        weights = record.get("portfolio_weights")
+        if record["isin"] not in positions or not isinstance(weights, dict):
+            continue
+        for category in categories:
+            entries[category].extend((label, positions[record["isin"]], weight / 100) for label, weight in weights.get(category, {}).items())
+    result = {}
+    for category, items in entries.items():
+        items.sort(key=lambda item: item[0])
+        result[category] = (numpy.array([item[1] for item in items], dtype=int), [item[0] for item in items], numpy.array([item[2] for item in items], dtype=float))
+    return result
+
+
+def aggregate(weightings, funds, labels, values):
+    # (distinct labels, exposures (weightings, distinct labels)) of the weightings (weightings, funds) to the coordinates sorted by label
+    if not labels:
+        return [], numpy.zeros((len(weightings), 0))
+    distinct, starts = numpy.unique(numpy.array(labels, dtype=object), return_index=True)
+    return [str(label) for label in distinct], numpy.add.reduceat(weightings[:, funds] * values, starts, axis=1)
+
+
+def sheet(data, weightings, logger=None):
+    # weightings: name -> {isin: weight} as read by utils.parse_weightings, every weighting is normalized to a sum of 1
+    names = list(weightings)
+    isins = sorted({isin for weights in weightings.values() for isin in weights})
+    matrix = numpy.array([[weightings[name].get(isin, 0.0) for isin in isins] for name in names], dtype=float).reshape(len(names), len(isins))
+    matrix /= matrix.sum(axis=1, keepdims=True)
+    titles = {subitem["ref"]: subitem["name"].replace("\n", " ") for item in constants.column_mapping for subitem in item["items"]}
+
+    rows = []
+    covered = set()
+    for category, (funds, labels, values) in coordinates(data, isins, constants.look_through["categories"]).items():
+        covered.update(funds.tolist())
+        labels, exposures = aggregate(matrix, funds, labels, values)
+        title = titles.get(f"portfolio_{category}", category)
+        for k in numpy.lexsort((numpy.arange(len(labels)), -exposures[0])) if len(labels) else []:  # largest exposure of the first weighting first
+            rows.append([title, labels[k]] + [round(float(value) * 100, 2) for value in exposures[:, k]])
+        # share of every weighting whose breakdown is known, holdings only list the main lines
+        rows.append([title, constants.look_through["total"]] + [round(float(value) * 100, 2) for value in exposures.sum(axis=1)])
+
+    missing = [isin for k, isin in enumerate(isins) if k not in covered]
+    if missing and logger is not None:
+        logger.warning(f"Look-through: no breakdown for {', '.join(missing)}, their weight is not broken down")
+    if logger is not None:
+        logger.info(f"Look-through: {len(names)} weightings of {len(isins)} funds")
+    return {
+        "title": constants.look_through["sheet"]["title"],
+        "header": constants.look_through["sheet"]["header"] + names,
+        "rows": rows
+    }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import cProfile
+import glob
+import io
+import linecache
+import multiprocessing.util
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import constants
+
+# profiling of a run, enabled with --profile DIR
+# every stage (fetch, kid, history, export, save) gets its own cProfile stats, every fetch worker too
+# a sampling thread collects the stacks of all threads in the folded format read by flamegraph.pl and speedscope
+# everything is merged into DIR/report.txt once the run is over
+
+profiler = None
+
+
+class Sampler(threading.Thread):
+    # folded stacks "stage;file:function;file:function count" of every thread but itself
+
+    def __init__(self, stage_name):
+        super().__init__(daemon=True)
+        self.stage_name = stage_name
+        self.stacks = collections.Counter()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(constants.profile_sample_interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join([self.stage_name()] + stack[::-1])] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+class Profiler:
+
+    def __init__(self, directory, memory=False):
+        self.directory = directory
+        self.memory = memory
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.prof")) + glob.glob(os.path.join(directory, "*.folded")):
+            os.remove(path)
+        self.stack = []
+        self.profiles = {}
+        self.durations = collections.Counter()
+        self.snapshots = []
+        if memory:
+            tracemalloc.start(constants.profile_traceback_depth)
+        self.sampler = Sampler(lambda: ";".join(self.stack) or "main")
+        self.sampler.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # nested stages suspend the profile of the enclosing stage, one profiler can run at a time
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        self.stack.append(name)
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.durations[name] += time.perf_counter() - start
+            self.stack.pop()
+            self.checkpoint(f"after {name}")
+            if self.stack:
+                self.profiles[self.stack[-1]].enable()
+
+    def checkpoint(self, label):
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(os.path.join(self.directory, f"{len(self.snapshots):02d}-{label.replace(' ', '-')}.snapshot"))
+            self.snapshots.append((label, snapshot))
+
+    def close(self):
+        self.sampler.stop()
+        if os.getpid() in worker_states:
+            dump_worker(worker_states[os.getpid()], self.directory)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, f"stage-{name}.prof"))
+        if self.memory:
+            tracemalloc.stop()
+        write_report(self.directory, self.durations, self.snapshots, self.sampler.stacks)
+
+
+class ProfiledCall:
+    # wraps the fetch function so that every worker (process or thread) profiles its own calls
+    # nothing is written while the funds are fetched: a worker process dumps its stats when it exits,
+    # the worker threads of the main process are dumped when profiling stops
+
+    def __init__(self, fn, directory):
+        self.fn = fn
+        self.directory = directory
+        self.main_pid = os.getpid()
+
+    def __call__(self, item):
+        state = worker_state(os.getpid() != self.main_pid, self.directory)
+        local = state["local"]
+        if not hasattr(local, "profile"):
+            local.profile = cProfile.Profile()
+            state["profiles"].append((f"{os.getpid()}-{threading.get_ident()}", local.profile))
+        if local.profile is not None:
+            try:
+                local.profile.enable()
+            except ValueError:
+                # from Python 3.12 one profiler runs at a time per process: worker threads of the main process are not
+                # profiled while the fetch stage is, the sampler still records their stacks
+                local.profile = None
+        try:
+            return self.fn(item)
+        finally:
+            if local.profile is not None:
+                local.profile.disable()
+
+
+worker_states = {}
+worker_states_lock = threading.Lock()
+
+
+def worker_state(worker_process, directory):
+    # the main process samples its own threads, worker processes start their own sampler and dump everything when they exit
+    with worker_states_lock:
+        if os.getpid() not in worker_states:
+            state = {"local": threading.local(), "profiles": [], "sampler": None}
+            if worker_process:
+                if profiler is not None:
+                    # a forked worker inherits the running profile of the fetch stage: its stats are never written
+                    # and from Python 3.12 it keeps the worker profile from starting
+                    for profile in profiler.profiles.values():
+                        profile.disable()
+                state["sampler"] = Sampler(lambda: "fetch-worker")
+                state["sampler"].start()
+                multiprocessing.util.Finalize(None, dump_worker, args=(state, directory), exitpriority=10)
+            worker_states[os.getpid()] = state
+        return worker_states[os.getpid()]
+
+
+def dump_worker(state, directory):
+    for name, profile in state["profiles"]:
+        if profile is not None:
+            profile.dump_stats(os.path.join(directory, f"worker-{name}.prof"))
+    if state["sampler"] is not None:
+        state["sampler"].stop()
+        with open(os.path.join(directory, f"worker-{os.getpid()}.folded"), "w", encoding="utf-8") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in state["sampler"].stacks.items())
+
+
+def write_report(directory, durations, snapshots, stacks):
+    with open(os.path.join(directory, "main.folded"), "w", encoding="utf-8") as file:
+        file.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+    folded = collections.Counter()
+    for path in glob.glob(os.path.join(directory, "*.folded")):
+        if os.path.basename(path) == "profile.folded":
+            continue
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                stack, count = line.rstrip("\n").rsplit(" ", 1)
+                folded[stack] += int(count)
+    with open(os.path.join(directory, "profile.folded"), "w", encoding="utf-8") as file:
+        file.writelines(f"{stack} {count}\n" for stack, count in sorted(folded.items()))
+
+    report = io.StringIO()
+    report.write("Stage durations (nested stages are included in their parent)\n")
+    for name, duration in durations.items():
+        report.write(f"  {name:<12} {duration:>9.2f}s\n")
+
+    sections = [(f"stage {os.path.basename(path)[6:-5]}", [path]) for path in sorted(glob.glob(os.path.join(directory, "stage-*.prof")))]
+    workers = sorted(glob.glob(os.path.join(directory, "worker-*.prof")))
+    if workers:
+        sections.append((f"fetch workers ({len(workers)} merged)", workers))
+    all_stats = None
+    for title, paths in sections:
+        stats = pstats.Stats(*paths, stream=report)
+        report.write(f"\n{'=' * 20} {title} {'=' * 20}\n")
+        stats.sort_stats("cumulative").print_stats(constants.profile_report_lines)
+        if all_stats is None:
+            all_stats = pstats.Stats(*paths)
+        else:
+            all_stats.add(*paths)
+    if all_stats is not None:
+        all_stats.dump_stats(os.path.join(directory, "profile.prof"))
+
+    previous = None
+    for label, snapshot in snapshots:
+        report.write(f"\n{'=' * 20} memory {label}: {sum(stat.size for stat in snapshot.statistics('filename')) / 2 ** 20:.1f} MB traced {'=' * 20}\n")
+        statistics = snapshot.compare_to(previous, "lineno") if previous is not None else snapshot.statistics("lineno")
+        for stat in statistics[:constants.profile_report_lines]:
+            frame = stat.traceback[0]
+            report.write(f"  {stat}\n      {linecache.getline(frame.filename, frame.lineno).strip()}\n")
+        previous = snapshot
+
+    with open(os.path.join(directory, "report.txt"), "w", encoding="utf-8") as file:
+        file.write(report.getvalue())
+
+
+def start(directory, memory=False):
+    global profiler
+    profiler = Profiler(directory, memory=memory)
+    return profiler
+
+
+def stop():
+    global profiler
+    if profiler is not None:
+        profiler.close()
+        profiler = None
+
+
+def stage(name):
+    # no-op unless profiling was started
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def checkpoint(label):
+    if profiler is not None:
+        profiler.checkpoint(label)
+
+
+def wrap(fn):
+    # fetch function handed to the executor, profiled in the workers when profiling was started
+    if profiler is None:
+        return fn
+    return ProfiledCall(fn, profiler.directory)
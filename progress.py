@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import constants
+
+# live progress of the fetch aggregated over all the workers: funds completed and failed, requests in flight per host,
+# request rate, bytes received and ETA, rendered as a bar on a terminal or as periodic key=value log lines
+# every thread counting something owns a slot of a shared array of counters and is the only one writing it, so the fetch path
+# increments its own counters without any lock; the reporter thread of the main process sums the slots, a slot may be read
+# one increment late. The lock of the slot counter is only taken once per thread, when it claims its slot
+# worker processes inherit the array (fork) or receive it through attach (spawn)
+
+fields = ["completed", "failed", "requests", "bytes"]  # then the requests in flight to every host of the run and to other hosts
+COMPLETED, FAILED, REQUESTS, BYTES = range(len(fields))
+
+state = None  # (host -> position of its in-flight counter, counters, next free slot), None when the progress is off
+local = threading.local()
+reporter = None
+
+
+def run_hosts():
+    # hosts called by a run, as host[:port]
+    urls = [constants.api_endpoint, constants.more_details_domain, constants.website_domain]
+    hosts = [urllib.parse.urlsplit(url).netloc for url in urls] + [host for host in constants.request_timeouts if host != "default"]
+    return list(dict.fromkeys(hosts))
+
+
+def start(total, mode, logger):
+    global state, reporter
+    if mode == "off":
+        return
+    if mode == "auto":
+        mode = "bar" if sys.stderr.isatty() else "log"
+    hosts = run_hosts()
+    positions = {host: len(fields) + k for k, host in enumerate(hosts)}
+    state = (positions, multiprocessing.RawArray("d", constants.progress["slots"] * (len(fields) + len(hosts) + 1)), multiprocessing.Value("i", 0))
+    reporter = Reporter(total, mode, logger)
+    reporter.start()
+
+
+def stop():
+    global state, reporter
+    if reporter is not None:
+        reporter.stopped.set()
+        reporter.join()
+        reporter.report(final=True)
+    state = None
+    reporter = None
+
+
+def attach(shared):
+    # initializer of the worker processes
+    global state
+    state = shared
+
+
+def slot():
+    # offset of the counters of the calling thread, None when the progress is off
+    # a forked process inherits the thread locals of its parent, the pid tells whether the slot is really ours
+    if state is None:
+        return None
+    if getattr(local, "pid", None) != os.getpid():
+        positions, _, next_slot = state
+        with next_slot.get_lock():
+            index = next_slot.value
+            next_slot.value += 1
+        # beyond constants.progress["slots"] threads share slots, their counts are approximate
+        local.offset = (index % constants.progress["slots"]) * (len(fields) + len(positions) + 1)
+        local.pid = os.getpid()
+    return local.offset
+
+
+def add(field, amount=1):
+    offset = slot()
+    if offset is not None:
+        state[1][offset + field] += amount
+
+
+@contextlib.contextmanager
+def request(url):
+    # a request to url is in flight
+    offset = slot()
+    if offset is None:
+        yield
+        return
+    positions, counters, _ = state
+    host = offset + positions.get(urllib.parse.urlsplit(url).netloc, len(fields) + len(positions))
+    counters[offset + REQUESTS] += 1
+    counters[host] += 1
+    try:
+        yield
+    finally:
+        counters[host] -= 1
+
+
+def mark_failed():
+    # the fund being fetched by this thread is returned without its data (deadline)
+    local.failed = True
+
+
+class Tracked:
+    # wraps the fetch function of the workers: counts the funds completed and failed
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, item):
+        local.failed = False
+        try:
+            result = self.fn(item)
+        except Exception:
+            add(FAILED)
+            raise
+        add(FAILED if local.failed else COMPLETED)
+        return result
+
+
+class Reporter(threading.Thread):
+
+    def __init__(self, total, mode, logger):
+        super().__init__(daemon=True, name="progress")
+        self.total = total
+        self.mode = mode
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.samples = collections.deque([(time.monotonic(), 0, 0)])  # (time, funds done, requests) of the rate window
+        self.width = 0
+
+    def run(self):
+        interval = constants.progress["bar_interval"] if self.mode == "bar" else constants.progress["log_interval"]
+        while not self.stopped.wait(interval):
+            self.report()
+
+    def totals(self):
+        # counters summed over the slots claimed, read without lock
+        positions, counters, next_slot = state
+        width = len(fields) + len(positions) + 1
+        values = counters[:min(next_slot.value, constants.progress["slots"]) * width]
+        return [sum(values[k::width]) for k in range(width)]
+
+    def report(self, final=False):
+        positions = state[0]
+        totals = self.totals()
+        completed, failed, requests_count, received = (int(value) for value in totals[:len(fields)])
+        in_flight = {host: int(totals[position]) for host, position in positions.items()}
+        in_flight["other"] = int(totals[-1])
+
+        now = time.monotonic()
+        self.samples.append((now, completed + failed, requests_count))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= constants.progress["rate_window"]:
+            self.samples.popleft()
+        elapsed = now - self.samples[0][0]
+        fund_rate = (completed + failed - self.samples[0][1]) / elapsed if elapsed else 0
+        request_rate = (requests_count - self.samples[0][2]) / elapsed if elapsed else 0
+        eta = (self.total - completed - failed) / fund_rate if fund_rate else None
+        busy = {host: count for host, count in in_flight.items() if count}
+
+        if self.mode == "log":
+            flight = ",".join(f"{host}:{count}" for host, count in busy.items()) or "none"
+            self.logger.info(f"Progress completed={completed} failed={failed} total={self.total} in_flight={flight} rate={request_rate:.1f}/s bytes={received} eta={'-' if eta is None else f'{round(eta)}s'}")
+            return
+        done = (completed + failed) / self.total if self.total else 1
+        bar = "#" * int(done * constants.progress["bar_width"])
+        flight = ", ".join(f"{host} {count}" for host, count in busy.items()) or "none"
+        line = f"[{bar.ljust(constants.progress['bar_width'], '.')}] {completed + failed}/{self.total} funds ({failed} failed) | {request_rate:.1f} req/s | {received / 2 ** 20:.1f} MiB | in flight: {flight} | ETA {duration(eta)}"
+        sys.stderr.write("\r" + line.ljust(self.width) + ("\n" if final else ""))
+        sys.stderr.flush()
+        self.width = len(line)
+
+
+def duration(seconds):
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import constants
+import fundtable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# net of fees terminal value of an investment plan in every fund, under each KID scenario and optionally by Monte Carlo
+# time is counted in months: the initial amount is invested at month 0, contributions at the start of every contribution period
+# from month 0 on, a monthly plan over 5 years makes 60 contributions
+# entry fees are taken from every payment, exit fees from the terminal value
+# KID scenario returns are average annual returns net of the ongoing charges of the fund (PRIIPs), unless told they are gross
+# the Monte Carlo draws monthly log returns centred on the moderate scenario with the volatility of the fund,
+# its median follows the moderate scenario
+# all the funds are computed at once as arrays, Monte Carlo paths by chunks of constants.projection_chunk_elements values
+
+periods_per_year = 12
+
+frequencies = {
+    "monthly": 1,
+    "quarterly": 3,
+    "yearly": 12
+}
+
+
+def schedule(amount, contribution, frequency, horizon):
+    # payment at the start of every month of the horizon
+    payments = numpy.zeros(horizon * periods_per_year)
+    payments[0] = amount
+    payments[::frequencies[frequency]] += contribution
+    return payments
+
+
+def scenario_values(returns, entry_fees, exit_fees, payments):
+    # terminal values (funds, scenarios): every net payment grows at the monthly rate of the annual return until the horizon
+    months_left = numpy.arange(len(payments), 0, -1)
+    monthly_growth = (1 + returns[:, :, None]) ** (months_left / periods_per_year)
+    return (monthly_growth * payments).sum(axis=-1) * (1 - entry_fees[:, None]) * (1 - exit_fees[:, None])
+
+
+def simulate(drift, volatility, payments, paths, rng):
+    # terminal values (funds, paths) of the gross payments, fees being proportional they are applied to the quantiles
+    # monthly log returns are normal with the given annual log drift and volatility, the median growth is exp(drift) a year
+    periods = len(payments)
+    mean = drift / periods_per_year
+    deviation = volatility / numpy.sqrt(periods_per_year)
+    if numpy.count_nonzero(payments) == 1 and payments[0]:
+        # a single payment only depends on the sum of the log returns, which is normal too
+        total = rng.standard_normal((len(drift), paths)) * (deviation * numpy.sqrt(periods))[:, None] + (mean * periods)[:, None]
+        return payments[0] * numpy.exp(total)
+    values = numpy.empty((len(drift), paths))
+    chunk = max(1, constants.projection_chunk_elements // periods)
+    flat = values.reshape(-1)
+    for start in range(0, flat.size, chunk):
+        stop = min(start + chunk, flat.size)
+        funds = numpy.arange(start, stop) // paths
+        log_returns = rng.standard_normal((stop - start, periods)) * deviation[funds, None] + mean[funds, None]
+        # growth of a payment made at month k: exp of the log returns from month k to the horizon
+        growth = numpy.exp(numpy.cumsum(log_returns[:, ::-1], axis=1)[:, ::-1])
+        flat[start:stop] = growth @ payments
+    return values
+
+
+def compute(data, amount, contribution, frequency, horizon, paths=0, gross_scenarios=False):
+    # returns isin -> projection fields for every record, the records are read once and only their numeric inputs are kept
+    inputs = ["fee_maximum_subscription", "fee_maximum_redemption", "fee_ongoing_charges", "volatility"] + list(constants.scenario_fields)
+    isins = []
+    numbers = {field: [] for field in inputs}
+    for record in data:
+        isins.append(record["isin"])
+        for field in inputs:
+            numbers[field].append(fundtable.number(record.get(field)))
+    numbers = {field: numpy.array(values, dtype=float) for field, values in numbers.items()}
+    entry_fees = numpy.nan_to_num(numbers["fee_maximum_subscription"]) / 100
+    exit_fees = numpy.nan_to_num(numbers["fee_maximum_redemption"]) / 100
+    returns = numpy.stack([numbers[field] for field in constants.scenario_fields], axis=1).reshape(len(isins), len(constants.scenario_fields)) / 100
+    if gross_scenarios:
+        returns = (1 + returns) * (1 - numpy.nan_to_num(numbers["fee_ongoing_charges"])[:, None] / 100) - 1
+    payments = schedule(amount, contribution, frequency, horizon)
+
+    values = scenario_values(returns, entry_fees, exit_fees, payments)
+    fields = [field.replace("scenario_", "projection_") for field in constants.scenario_fields]
+    results = {
+        isin: {field: None if numpy.isnan(value) else round(float(value), 2) for field, value in zip(fields, row)}
+        for isin, row in zip(isins, values)
+    }
+
+    if paths:
+        # funds without moderate scenario or volatility are left out of the simulation
+        quantile_fields = [f"projection_p{percentile}" for percentile in constants.projection_percentiles]
+        for isin in isins:
+            results[isin].update({field: None for field in quantile_fields})
+        drift = numpy.log1p(returns[:, list(constants.scenario_fields).index("scenario_moderate")])
+        volatility = numbers["volatility"] / 100
+        simulated = numpy.flatnonzero(~numpy.isnan(drift) & ~numpy.isnan(volatility))
+        if len(simulated):
+            rng = numpy.random.default_rng(constants.projection_seed)
+            terminal = simulate(drift[simulated], volatility[simulated], payments, paths, rng)
+            quantiles = numpy.percentile(terminal, constants.projection_percentiles, axis=1).T * ((1 - entry_fees[simulated]) * (1 - exit_fees[simulated]))[:, None]
+            for k, row in zip(simulated, quantiles):
+                results[isins[k]].update({field: round(float(value), 2) for field, value in zip(quantile_fields, row)})
+    return results
+
+
+def column_group(amount, contribution, frequency, horizon, paths=0):
+    # columns of the projection appended to constants.column_mapping, named after the scenario columns
+    name = f"Projection nette de frais\n{amount:g}€"
+    if contribution:
+        name += f" + {contribution:g}€ {constants.projection_frequency_names[frequency]}"
+    name += f" sur {horizon} ans"
+    items = [dict(constants.projection_column, ref=field.replace("scenario_", "projection_"), name=subitem["name"]) for field, subitem in zip(constants.scenario_fields, scenario_subitems())]
+    if paths:
+        items += [dict(constants.projection_column, ref=f"projection_p{percentile}", name=f"Monte Carlo\n{percentile}%") for percentile in constants.projection_percentiles]
+    return {"name": name, "size": 12, "items": items}
+
+
+def scenario_subitems():
+    subitems = {subitem["ref"]: subitem for item in constants.column_mapping for subitem in item["items"]}
+    return [subitems[field] for field in constants.scenario_fields]
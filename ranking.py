@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import constants
+import utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# static fills computed once in Python instead of conditional formatting rules re-evaluated by the spreadsheet
+# fill-percentile columns follow the 3 colors scale of Excel (min, median and max of the numeric cells, colors interpolated on the value)
+# with the interpolation quantized to constants.static_fill_steps colors per half so that the workbook holds a bounded number of styles
+# fill-mapping columns get the color of their value
+
+
+class StaticFills:
+
+    def __init__(self, colors, palette, rankings):
+        self.colors = colors  # palette index per row and column, -1 when the cell keeps its default fill
+        self.palette = palette
+        self.rankings = rankings
+
+    def color(self, row, column):
+        # row and column start at 0 on the first record and the first column
+        index = self.colors[row, column]
+        return self.palette[index] if index >= 0 else None
+
+
+def hex_to_rgb(color):
+    return [int(color[k:k + 2], 16) for k in (0, 2, 4)]
+
+
+def scale_palette(colors):
+    # 2 * steps + 1 colors from start to end color through mid color
+    steps = constants.static_fill_steps
+    start, mid, end = (numpy.array(hex_to_rgb(colors[key]), dtype=float) for key in ["start_color", "mid_color", "end_color"])
+    ratios = numpy.linspace(0, 1, steps + 1)[:, None]
+    rgb = numpy.vstack([start + (mid - start) * ratios[:-1], mid + (end - mid) * ratios])
+    return ["".join(f"{round(channel):02X}" for channel in color) for color in rgb]
+
+
+def scale_indexes(values):
+    # position of every value on the quantized scale, -1 for non numeric cells (ignored by Excel too)
+    steps = constants.static_fill_steps
+    indexes = numpy.full(len(values), -1, dtype=numpy.int16)
+    valid = ~numpy.isnan(values)
+    if not valid.any():
+        return indexes
+    low, median, high = numpy.percentile(values[valid], [0, 50, 100])
+    below = valid & (values <= median)
+    above = valid & (values > median)
+    if median > low:
+        indexes[below] = numpy.rint((values[below] - low) / (median - low) * steps)
+    else:
+        indexes[below] = steps  # values equal to the median get the mid color
+    if high > median:
+        indexes[above] = steps + numpy.rint((values[above] - median) / (high - median) * steps)
+    return indexes
+
+
+def percent_ranks(values):
+    # PERCENTRANK.INC of every numeric value in percent: share of the other values strictly lower
+    ranks = numpy.full(len(values), numpy.nan)
+    valid = ~numpy.isnan(values)
+    count = int(valid.sum())
+    if count == 0:
+        return ranks
+    ordered = numpy.sort(values[valid])
+    ranks[valid] = numpy.searchsorted(ordered, values[valid], side="left") / max(count - 1, 1) * 100
+    return numpy.round(ranks, 1)
+
+
+def compute(data, subitems):
+    # one pass over the records, only the numeric values of the percentile columns and the mapped colors are kept
+    percentile_columns = [i for i, subitem in enumerate(subitems) if "fill-percentile" in subitem.get("conditional-formatting", {})]
+    mapping_columns = [i for i, subitem in enumerate(subitems) if "fill-mapping" in subitem.get("conditional-formatting", {})]
+    palette = []
+    palette_index = {}
+
+    def palette_position(color):
+        if color not in palette_index:
+            palette_index[color] = len(palette)
+            palette.append(color)
+        return palette_index[color]
+
+    mappings = {
+        i: {str(value): palette_position(color) for value, color in subitems[i]["conditional-formatting"]["fill-mapping"].items()}
+        for i in mapping_columns
+    }
+    numbers = {i: [] for i in percentile_columns}
+    mapped = {i: [] for i in mapping_columns}
+    names = []
+    for row_data in data:
+        names.append((row_data.get("isin", ""), row_data.get("legal_name", "")))
+        for i in percentile_columns:
+            val = utils.format_cell_value(row_data.get(subitems[i]["ref"], ""), subitems[i]["ref"])[0]
+            numbers[i].append(float(val) if isinstance(val, (int, float)) and not isinstance(val, bool) else numpy.nan)
+        for i in mapping_columns:
+            val = utils.format_cell_value(row_data.get(subitems[i]["ref"], ""), subitems[i]["ref"])[0]
+            mapped[i].append(mappings[i].get(str(val), -1))
+
+    colors = numpy.full((len(names), len(subitems)), -1, dtype=numpy.int32)
+    for i in mapping_columns:
+        colors[:, i] = mapped[i]
+    ranks = {}
+    for i in percentile_columns:
+        values = numpy.array(numbers[i], dtype=float)
+        scale = numpy.array([palette_position(color) for color in scale_palette(subitems[i]["conditional-formatting"]["fill-percentile"])])
+        indexes = scale_indexes(values)
+        colors[:, i] = numpy.where(indexes >= 0, scale[numpy.maximum(indexes, 0)], -1)
+        ranks[i] = percent_ranks(values)
+
+    rankings = {
+        "title": constants.rankings_sheet["title"],
+        "header": ["ISIN", "Nom"] + [subitems[i]["name"].replace("\n", " ") for i in percentile_columns],
+        "rows": [
+            [isin, name] + [None if numpy.isnan(ranks[i][j]) else float(ranks[i][j]) for i in percentile_columns]
+            for j, (isin, name) in enumerate(names)
+        ]
+    }
+    return StaticFills(colors, palette, rankings)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import requests
+import constants
+import transport
+
+# API responses shared by every worker of a run (processes, threads or local queue workers) in an SQLite WAL database
+# the first caller of a request leases it and fetches it, concurrent callers of the same request wait for its response
+# so each distinct request runs once per run whatever the number of workers
+# the database path is handed to the workers through an environment variable
+
+environment_variable = "ARBITRAGE_REQUEST_CACHE"
+
+# a failure shared with the waiting workers is raised again as the first of these kinds it belongs to
+# the timeouts come first so that utils.late_errors still match
+error_kinds = [transport.DeadlineExceeded, requests.exceptions.Timeout, requests.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.RequestException, ValueError, RuntimeError]
+
+local = threading.local()
+
+
+def connection(path):
+    # one connection per thread and per process
+    if getattr(local, "pid", None) != os.getpid() or getattr(local, "path", None) != path:
+        local.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        local.pid = os.getpid()
+        local.path = path
+    return local.connection
+
+
+def enabled():
+    return bool(os.environ.get(environment_variable))
+
+
+def request_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def start():
+    # creates the cache of this run, removed when the process that created it exits
+    directory = tempfile.mkdtemp(prefix="arbitrage-cache-")
+    path = os.path.join(directory, "requests.db")
+    database = sqlite3.connect(path, isolation_level=None)
+    database.execute("PRAGMA journal_mode=WAL")
+    database.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, state TEXT NOT NULL, expires REAL, body TEXT, kind TEXT, hits INTEGER NOT NULL DEFAULT 0)")
+    database.close()
+    os.environ[environment_variable] = path
+    pid = os.getpid()
+
+    def cleanup():
+        if os.getpid() == pid:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    atexit.register(cleanup)
+    return path
+
+
+def stop():
+    # returns (distinct requests, requests served by the cache) and disables the cache for this process
+    path = os.environ.pop(environment_variable, None)
+    if path is None:
+        return 0, 0
+    requests_count, hits = connection(path).execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM responses WHERE state = 'done'").fetchone()
+    connection(path).close()
+    local.pid = None
+    return requests_count, hits
+
+
+def fetch(key, request):
+    # returns the response of request(), fetched once per key by all the workers of the run
+    # a response already fetched is read without any transaction, the write lock is only taken to lease a request
+    path = os.environ.get(environment_variable)
+    if not path:
+        return request()
+    database = connection(path)
+    while True:
+        row = database.execute("SELECT state, expires, body, kind FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and row[0] == "done":
+            database.execute("UPDATE responses SET hits = hits + 1 WHERE key = ?", (key,))  # single statement, the lock is held for the update only
+            return json.loads(row[2])
+        if row is not None and row[1] > time.time():
+            if row[0] == "failed":
+                raise next(kind for kind in error_kinds if kind.__name__ == row[3])(f"Request failed in another worker: {row[2]}")
+            # fetched by another worker, waiting does not outlive the deadline of the run
+            transport.remaining_time()
+            time.sleep(constants.request_cache_poll_interval)
+            continue
+        # unknown, failed a while ago or lease expired (worker killed): this worker leases it unless another one was faster
+        database.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        if database.execute("SELECT 1 FROM responses WHERE key = ? AND (state = 'done' OR expires > ?)", (key, now)).fetchone() is not None:
+            database.execute("COMMIT")
+            continue
+        database.execute("INSERT OR REPLACE INTO responses (key, state, expires) VALUES (?, 'pending', ?)", (key, now + constants.request_cache_lease))
+        database.execute("COMMIT")
+        break
+
+    try:
+        response = request()
+    except (transport.DeadlineExceeded, requests.exceptions.Timeout):
+        # not shared: the waiting workers fetch it again with their own time left
+        database.execute("DELETE FROM responses WHERE key = ?", (key,))
+        raise
+    except Exception as e:
+        # the failure is shared for a short while so that workers waiting for this request do not all retry it
+        kind = next((kind for kind in error_kinds if isinstance(e, kind)), RuntimeError).__name__
+        database.execute("UPDATE responses SET state = 'failed', expires = ?, body = ?, kind = ? WHERE key = ?", (time.time() + constants.request_cache_failure_ttl, f"{type(e).__name__}: {e}", kind, key))
+        raise
+    database.execute("UPDATE responses SET state = 'done', body = ? WHERE key = ?", (json.dumps(response, ensure_ascii=False), key))
+    return response
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import array
+import json
+import os
+import sys
+
+# scenario history of a fund stored as one file: a JSON header line followed by the values as doubles
+# values are interleaved row by row (one row per published scenario, one column per field)
+
+
+def history_path(directory, isin):
+    return os.path.join(directory, f"{isin.upper()}.scenarios")
+
+
+def save_history(directory, isin, history):
+    os.makedirs(directory, exist_ok=True)
+    fields = list(history)
+    count = len(history[fields[0]]) if fields else 0
+    values = array.array("d", (history[field][i] for i in range(count) for field in fields))
+    path = history_path(directory, isin)
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(json.dumps({"fields": fields, "count": count, "byteorder": sys.byteorder}).encode("utf-8") + b"\n")
+        values.tofile(file)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_history(directory, isin):
+    # returns field -> array of doubles (nan when the field was missing), oldest scenario first
+    with open(history_path(directory, isin), "rb") as file:
+        header = json.loads(file.readline())
+        values = array.array("d")
+        values.fromfile(file, header["count"] * len(header["fields"]))
+    if header["byteorder"] != sys.byteorder:
+        values.byteswap()
+    width = len(header["fields"])
+    return {field: values[i::width] for i, field in enumerate(header["fields"])}
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import random
+from pylogger_unified import logger as pylogger_unified
+import constants
+
+# schemas of the API payloads read by arbitrage.get_fund_data
+# a schema is made of type names (see type_checks), dicts of fields and the wrappers below
+# it is compiled once into nested closures, validating a payload reports every drift found instead of stopping at the first one
+# drift is reported as error (the fund would fail) or warning (the fund would be exported with degraded values)
+
+
+class Nullable:
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class ListOf:
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class MapOf:
+    # dict with free keys, reported as * in paths so that drift is aggregated over keys and funds
+
+    def __init__(self, spec):
+        self.spec = spec
+
+
+class Optional:
+    # dict field that may be missing, missing is reported with the given severity when set
+
+    def __init__(self, spec, missing=None):
+        self.spec = spec
+        self.missing = missing
+
+
+class Check:
+    # spec completed by a function returning [(severity, message)] for the value
+
+    def __init__(self, spec, check):
+        self.spec = spec
+        self.check = check
+
+
+def is_numeric(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(value)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+type_checks = {
+    "str": lambda value: isinstance(value, str),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "numeric": is_numeric,
+    "numeric_or_empty": lambda value: not value or is_numeric(value),  # read as "float(value) if value else 0"
+    "any": lambda value: True
+}
+
+
+def compile_spec(spec):
+    # returns validate(value, path, report) appending (severity, path, message) to report
+    if isinstance(spec, str):
+        type_check = type_checks[spec]
+
+        def validate(value, path, report):
+            if not type_check(value):
+                report.append(("error", path, f"expected {spec}, got {type(value).__name__}"))
+        return validate
+
+    if isinstance(spec, Nullable):
+        inner = compile_spec(spec.spec)
+
+        def validate(value, path, report):
+            if value is not None:
+                inner(value, path, report)
+        return validate
+
+    if isinstance(spec, ListOf):
+        inner = compile_spec(spec.spec)
+
+        def validate(value, path, report):
+            if not isinstance(value, list):
+                report.append(("error", path, f"expected list, got {type(value).__name__}"))
+                return
+            for item in value:
+                inner(item, f"{path}[]", report)
+        return validate
+
+    if isinstance(spec, MapOf):
+        inner = compile_spec(spec.spec)
+
+        def validate(value, path, report):
+            if not isinstance(value, dict):
+                report.append(("error", path, f"expected object, got {type(value).__name__}"))
+                return
+            for item in value.values():
+                inner(item, f"{path}.*", report)
+        return validate
+
+    if isinstance(spec, Check):
+        inner = compile_spec(spec.spec)
+        check = spec.check
+
+        def validate(value, path, report):
+            errors = len(report)
+            inner(value, path, report)
+            if len(report) == errors:
+                report.extend((severity, path, message) for severity, message in check(value))
+        return validate
+
+    if isinstance(spec, dict):
+        fields = []
+        for key, field_spec in spec.items():
+            missing = "error"
+            if isinstance(field_spec, Optional):
+                missing = field_spec.missing
+                field_spec = field_spec.spec
+            fields.append((key, compile_spec(field_spec), missing))
+
+        def validate(value, path, report):
+            if not isinstance(value, dict):
+                report.append(("error", path, f"expected object, got {type(value).__name__}"))
+                return
+            for key, inner, missing in fields:
+                if key in value:
+                    inner(value[key], f"{path}.{key}", report)
+                elif missing is not None:
+                    report.append((missing, f"{path}.{key}", "missing"))
+        return validate
+
+    raise TypeError(f"Invalid schema {spec!r}")
+
+
+def empty_fee(value):
+    # a fee without value or of zero, as int, float or string, shared by arbitrage.check_fees and unknown_fees
+    return value is None or value in ("", "0") or (isinstance(value, (int, float)) and value == 0)
+
+
+def unknown_fees(fees_timed):
+    # same rule as arbitrage.check_fees: unknown fees are only accepted when empty or zero
+    drift = []
+    for fee_key, fee in fees_timed.items():
+        if fee_key in constants.known_fee_keys or not isinstance(fee, dict) or empty_fee(fee.get("value")):
+            continue
+        drift.append(("error", f"unknown fee {fee_key} with value {fee['value']}"))
+    return drift
+
+
+def unknown_breakdowns(breakdowns):
+    drift = []
+    seen = set()
+    for breakdown in breakdowns or []:
+        header = breakdown["labels"]["header"]
+        category = next((category for category, headers in constants.breakdowns_mapping.items() if header in headers), None)
+        if category is None:
+            if header not in constants.breakdowns_exclude:
+                drift.append(("warning", f"unknown breakdown header {header}"))
+        elif category in seen:
+            drift.append(("error", f"several breakdowns for {category}"))
+        else:
+            seen.add(category)
+    return drift
+
+
+def latest_scenario(scenarios):
+    if not scenarios:
+        return [("error", "no scenarios")]
+    return [("error", f"{key} missing in the latest scenario") for key in constants.scenario_fields.values() if key not in scenarios[-1]]
+
+
+fee = {"value": "numeric_or_empty"}
+fees_read = [  # fees read by arbitrage.get_fund_data, the other known fees may be missing
+    "at_launch_ongoing_charges",
+    "estimated_ongoing_charges",
+    "maximum_conversion_rate",
+    "maximum_management_fees",
+    "maximum_redemption_fixed_fees_acquired",
+    "real_ongoing_charges",
+    "redemption_fixed_fees_acquired",
+    "total_redemption_fees",
+    "total_subscription_fees"
+]
+perfs = ListOf({"value": "numeric", "type": "str", "currency": "str"})
+
+schemas = {
+    "fundsheet": {
+        "classification": {"asset_class": "str", "region_reporting": "str"},
+        "fundshare_id": "numeric",
+        "legal_name": "str",
+        "portfolio": {"legal_form": "str", "creation_date": "str", "base_currency_code": "str", "base_currency": "str"},
+        "fundshare_selection": {
+            "share_types": MapOf("str"),
+            "share_types_isin_codes": MapOf("str"),
+            "morning_star": "numeric_or_empty",
+            "flags": {"pea_flag": "any"}
+        },
+        "nav": {
+            "nav_info": MapOf({"share_size": Optional(Nullable("numeric"))}),
+            "two_latest_nav": MapOf(ListOf({"nav": "numeric"}))
+        },
+        "overview": {"bench": {"name": "str"}, "disclaimers": {"investment_policy": "str"}},
+        "risk": {"sri_risk": {"value": "numeric_or_empty"}},
+        "fundsheet_uri": "str",
+        "performances": {
+            "disclaimers": {"currency_fluctuation_not_euro": "any"},
+            "perfs": Nullable({"cumulated": {"shares": Nullable(perfs), "benches": Nullable(perfs)}}),
+            "risk_analysis": Optional({
+                "stats": Optional({
+                    "volatility": Optional(Nullable("numeric"), missing="warning"),
+                    "sharpe_ratio": Optional(Nullable("numeric"), missing="warning")
+                }, missing="warning")
+            }, missing="warning")
+        },
+        "publications": MapOf({"documents": ListOf({"url": "str", "doc_type": Optional(Nullable("str"))})}),
+        "fees": {
+            "fees_timed": Check({key: fee if key in fees_read else Optional(Nullable("any")) for key in constants.known_fee_keys}, unknown_fees)
+        }
+    },
+    "holdings": {
+        "breakdowns": Optional(Nullable(Check(ListOf({
+            "labels": {"header": "str"},
+            "level_1_breakdowns": ListOf({"label": "str", "rank": "numeric", "ptf_value": Nullable("number"), "bench_value": Nullable("number")})
+        }), unknown_breakdowns)), missing="warning")
+    },
+    "scenarios": Check(ListOf(MapOf(Nullable("any"))), latest_scenario)
+}
+
+validators = {name: compile_spec(spec) for name, spec in schemas.items()}
+
+
+def validate(name, payload):
+    report = []
+    validators[name](payload, name, report)
+    return report
+
+
+def preflight(funds, sample_size, fetch_payloads, workers, debug=False):
+    # validates the payloads of a random sample of funds, every drift found is logged at once
+    # returns False when a drift would make funds fail
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="preflight")
+    sample = random.sample(funds, min(sample_size, len(funds)))
+    logger.info(f"Preflight: validating the API payloads of {len(sample)} funds out of {len(funds)}")
+
+    drift = collections.defaultdict(list)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_payloads, isin): isin for isin in sample}
+        for future in concurrent.futures.as_completed(futures):
+            isin = futures[future]
+            try:
+                payloads = future.result()
+            except Exception as e:
+                drift[("error", "request", f"{type(e).__name__}: {e}")].append(isin)
+                continue
+            for name, payload in payloads.items():
+                for entry in validate(name, payload):
+                    drift[entry].append(isin)
+
+    for (severity, path, message), isins in sorted(drift.items(), key=lambda item: (item[0][0], -len(item[1]), item[0][1])):
+        log = logger.error if severity == "error" else logger.warning
+        log(f"{path}: {message} ({len(isins)}/{len(sample)} funds, e.g. {', '.join(sorted(isins)[:3])})")
+    errors = sum(1 for severity, _, _ in drift if severity == "error")
+    if not drift:
+        logger.info("Preflight: no schema drift found")
+    else:
+        logger.info(f"Preflight: {errors} errors and {len(drift) - errors} warnings")
+    return errors == 0
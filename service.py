@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import io
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pylogger_unified import logger as pylogger_unified
+import utils
+
+
+class FundCache:
+    # keeps the latest known record of every fund in memory
+    # records are refreshed in background, a fund failing to refresh keeps its previous record, a fund no longer listed is dropped
+    # derive computes fields over all the records once they are refreshed (records -> {isin: fields}), e.g. the projection
+
+    def __init__(self, list_funds, fetch, export, workers, interval, debug=False, derive=None):
+        self.list_funds = list_funds
+        self.fetch = fetch
+        self.export = export
+        self.derive = derive
+        self.workers = workers
+        self.interval = interval
+        self.logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="service")
+        self.records = {}
+        self.order = []
+        self.version = 0
+        self.last_refresh = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.workbook_cache = (None, None)
+
+    def refresh(self):
+        self.refreshing = True
+        try:
+            try:
+                funds = self.list_funds()
+            except (Exception, SystemExit) as e:
+                self.logger.error(f"Failed to list funds, keeping cached data: {e}")
+                return
+            failed = 0
+            fresh = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.fetch, fund): fund for fund in funds}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        failed += 1
+                        self.logger.warning(f"Failed to refresh {futures[future]}, keeping cached data: {e}")
+                        continue
+                    fresh[record["isin"]] = record
+            # the new records are built and derived aside then swapped in at once, clients never see a record without its derived fields
+            with self.lock:
+                records = {fund: fresh.get(fund) or dict(self.records[fund]) for fund in funds if fund in fresh or fund in self.records}
+            if self.derive is not None:
+                updates = self.derive(list(records.values()))
+                for fund, record in records.items():
+                    record.update(updates.get(fund, {}))
+            with self.lock:
+                self.records = records
+                self.order = list(records)
+                self.version += 1
+                self.last_refresh = utils.get_utc_time()
+            self.logger.info(f"Refresh done: {len(funds) - failed} funds refreshed, {failed} failed")
+        finally:
+            self.refreshing = False
+
+    def run(self):
+        while not self.stop_event.is_set():
+            # the refresh thread outlives any failed refresh, the cached data is kept until the next one
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(f"Refresh failed, keeping cached data: {e}")
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, isin):
+        with self.lock:
+            return self.records.get(isin.upper())
+
+    def select(self, filters):
+        # filters are exact matches on record fields (case insensitive)
+        # min_<field> and max_<field> filters are numeric bounds
+        with self.lock:
+            records = [self.records[isin] for isin in self.order]
+        for key, value in filters.items():
+            if key.startswith("min_") or key.startswith("max_"):
+                field = key[4:]
+                bound = float(value)
+                records = [r for r in records if isinstance(r.get(field), (int, float)) and (r[field] >= bound if key.startswith("min_") else r[field] <= bound)]
+            else:
+                records = [r for r in records if str(r.get(key, "")).lower() == value.lower()]
+        return records
+
+    def workbook(self, filters):
+        # the unfiltered workbook is built once per refresh and served from memory afterwards
+        if not filters:
+            version, content = self.workbook_cache
+            if version == self.version and content is not None:
+                return content
+        version = self.version
+        buffer = io.BytesIO()
+        self.export(data=self.select(filters), file=buffer)
+        content = buffer.getvalue()
+        if not filters:
+            self.workbook_cache = (version, content)
+        return content
+
+    def status(self):
+        with self.lock:
+            return {
+                "funds": len(self.order),
+                "version": self.version,
+                "last_refresh": self.last_refresh,
+                "refreshing": self.refreshing
+            }
+
+
+def make_handler(cache):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            cache.logger.debug(f"{self.address_string()} {format % args}")
+
+        def send_content(self, status, content, content_type, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def send_json(self, status, obj):
+            self.send_content(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            filters = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+            path = url.path.rstrip("/")
+            try:
+                if path == "/status":
+                    self.send_json(200, cache.status())
+                elif path == "/funds":
+                    self.send_json(200, cache.select(filters))
+                elif path.startswith("/funds/"):
+                    record = cache.get(path[len("/funds/"):])
+                    if record is None:
+                        self.send_json(404, {"error": "Unknown ISIN"})
+                    else:
+                        self.send_json(200, record)
+                elif path.endswith(".xlsx"):
+                    if not cache.version:
+                        self.send_json(503, {"error": "Fund data not loaded yet"})
+                        return
+                    self.send_content(
+                        200,
+                        cache.workbook(filters),
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        headers={"Content-Disposition": f"attachment; filename=\"{path.split('/')[-1]}\""}
+                    )
+                else:
+                    self.send_json(404, {"error": "Unknown endpoint"})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+            except Exception as e:
+                cache.logger.error(f"Failed to answer {self.path}: {e}")
+                self.send_json(500, {"error": str(e)})
+
+    return Handler
+
+
+def serve(args, list_funds, fetch, export, derive=None):
+    cache = FundCache(
+        list_funds=list_funds,
+        fetch=fetch,
+        export=export,
+        workers=args.refresh_workers,
+        interval=args.refresh_interval,
+        debug=args.debug,
+        derive=derive
+    )
+    cache.start()
+    server = ThreadingHTTPServer((args.bind, args.port), make_handler(cache))
+    cache.logger.info(f"Serving fund data on http://{args.bind}:{args.port} (refresh every {args.refresh_interval}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        cache.logger.warning("Interrupted, stopping service")
+    finally:
+        cache.stop_event.set()
+        server.server_close()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+
+
+class RecordSpool:
+    # fund records spilled to a temporary JSON lines file as they arrive
+    # the spool can be iterated several times, only one record is decoded at a time
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix="arbitrage-", suffix=".jsonl", dir=directory)
+        self.file = os.fdopen(fd, "w", encoding="utf-8")
+        self.count = 0
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.file.flush()
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                yield json.loads(line)
+
+    @classmethod
+    def from_records(cls, records, directory=None):
+        records_spool = cls(directory=directory)
+        for record in records:
+            records_spool.append(record)
+        return records_spool
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.path)
+
+
+class MergedRecords:
+    # records in the order of isins, taken from a dict of records fetched ahead (favorites)
+    # and from the other records, which are in that order already
+    # can be iterated several times, the other records can be a list or a spool
+
+    def __init__(self, isins, first, others):
+        self.isins = isins
+        self.first = first
+        self.others = others
+
+    def __len__(self):
+        return len(self.isins)
+
+    def __iter__(self):
+        others = iter(self.others)
+        for isin in self.isins:
+            if isin in self.first:
+                yield self.first[isin]
+            else:
+                yield next(others)
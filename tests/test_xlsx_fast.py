@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# the fast engine must write the same workbook as openpyxl: both engines write the same synthetic records,
+# the two files are read back with openpyxl and compared sheet by sheet
+
+import os
+import sys
+import tempfile
+import openpyxl
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+directory = tempfile.mkdtemp(prefix="arbitrage-tests-")
+sys.argv = ["arbitrage.py", "--file", os.path.join(directory, "arbitrage.xlsx"), "--favorites", os.path.join(directory, "favorites.csv")]
+
+import arbitrage  # noqa: E402 (arguments are parsed on import)
+import benchmark  # noqa: E402
+
+count = 50
+
+
+def write(engine, path, extra_sheets=None):
+    arbitrage.args.xlsx_engine = engine
+    records = [benchmark.synthetic_record(i) for i in range(count)]
+    records[0]["favorite"] = "Favori"
+    arbitrage.export_to_file(data=records, file=path, extra_sheets=extra_sheets)
+    return openpyxl.load_workbook(path)
+
+
+def color(value):
+    # rgb colors compared as such, theme colors by their theme
+    if value is None:
+        return None
+    return value.rgb if value.type == "rgb" else (value.type, value.theme if value.type == "theme" else value.indexed)
+
+
+def cell_style(cell):
+    return (
+        cell.fill.fill_type, color(cell.fill.fgColor),
+        cell.font.b, cell.font.i, cell.font.sz, color(cell.font.color),
+        cell.alignment.horizontal, cell.alignment.vertical, cell.alignment.wrap_text,
+        cell.border.left.style, cell.border.right.style, cell.border.top.style, cell.border.bottom.style,
+        cell.number_format
+    )
+
+
+def rules(worksheet):
+    return sorted(
+        (str(formatting.sqref), rule.type, tuple(rule.formula or ()), rule.dxf.fill.fgColor.rgb if rule.dxf is not None and rule.dxf.fill is not None else None,
+         tuple((value.type, value.val) for value in rule.colorScale.cfvo) if rule.colorScale is not None else None,
+         tuple(color.rgb for color in rule.colorScale.color) if rule.colorScale is not None else None)
+        for formatting in worksheet.conditional_formatting for rule in formatting.rules
+    )
+
+
+@pytest.fixture(scope="module")
+def workbooks():
+    extra_sheets = [{"title": "Extra", "header": ["ISIN", "Valeur"], "rows": [["FR0000000001", 1.5], ["FR0000000002", None], ["FR0000000003", float("nan")], ["FR0000000004", float("-inf")]]}]
+    return write("openpyxl", os.path.join(directory, "openpyxl.xlsx"), extra_sheets), write("fast", os.path.join(directory, "fast.xlsx"), extra_sheets)
+
+
+def test_sheets(workbooks):
+    expected, actual = workbooks
+    assert actual.sheetnames == expected.sheetnames
+
+
+def test_cells(workbooks):
+    expected, actual = workbooks
+    for name in expected.sheetnames:
+        a, b = expected[name], actual[name]
+        assert (b.max_row, b.max_column) == (a.max_row, a.max_column), name
+        for row_a, row_b in zip(a.iter_rows(), b.iter_rows()):
+            for cell_a, cell_b in zip(row_a, row_b):
+                assert cell_b.value == cell_a.value, f"{name}!{cell_a.coordinate}"
+                assert (cell_b.hyperlink.target if cell_b.hyperlink else None) == (cell_a.hyperlink.target if cell_a.hyperlink else None), f"{name}!{cell_a.coordinate}"
+                if not isinstance(cell_a, openpyxl.cell.cell.MergedCell):  # cells hidden by a merge are not styled by the fast engine
+                    assert cell_style(cell_b) == cell_style(cell_a), f"{name}!{cell_a.coordinate}"
+
+
+def test_non_finite(workbooks):
+    # NaN and infinities are written as empty cells, as openpyxl does
+    expected, actual = workbooks
+    assert [cell.value for cell in actual["Extra"]["B"][3:]] == [cell.value for cell in expected["Extra"]["B"][3:]] == [None, None]
+
+
+def test_layout(workbooks):
+    expected, actual = workbooks
+    for name in expected.sheetnames:
+        a, b = expected[name], actual[name]
+        assert b.freeze_panes == a.freeze_panes, name
+        assert b.auto_filter.ref == a.auto_filter.ref, name
+        assert sorted(map(str, b.merged_cells.ranges)) == sorted(map(str, a.merged_cells.ranges)), name
+        assert {key: dimension.width for key, dimension in b.column_dimensions.items()} == {key: dimension.width for key, dimension in a.column_dimensions.items()}, name
+        assert [b.row_dimensions[j].height for j in range(1, b.max_row + 1)] == [a.row_dimensions[j].height for j in range(1, a.max_row + 1)], name
+        assert b.sheet_properties.tabColor == a.sheet_properties.tabColor, name
+
+
+def test_conditional_formatting(workbooks):
+    expected, actual = workbooks
+    for name in expected.sheetnames:
+        assert rules(actual[name]) == rules(expected[name]), name
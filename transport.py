@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+import urllib.parse
+import zlib
+import constants
+import progress
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# compressed transport of the API calls: the encodings are negotiated explicitly and bodies are decompressed while they are received
+# compressed and decompressed bytes are accounted per endpoint
+# calls made inside an accounted call (see Accounted) are reported with its result so that worker processes report them too
+# every call has connect and read timeouts per host, bounded by the deadline of the run when one is set
+# the deadline and hedging settings reach the workers through environment variables
+
+deadline_variable = "ARBITRAGE_DEADLINE"
+hedge_variable = "ARBITRAGE_HEDGE"
+
+totals = {}
+totals_lock = threading.Lock()
+local = threading.local()
+latencies = collections.defaultdict(lambda: collections.deque(maxlen=constants.hedge_window))
+hedge_executors = {}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def set_deadline(seconds):
+    os.environ[deadline_variable] = str(time.time() + seconds)
+
+
+def clear_deadline():
+    os.environ.pop(deadline_variable, None)
+
+
+def enable_hedging():
+    os.environ[hedge_variable] = "1"
+
+
+def remaining_time():
+    # seconds left before the deadline of the run, None without deadline
+    deadline = os.environ.get(deadline_variable)
+    if not deadline:
+        return None
+    remaining = float(deadline) - time.time()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline of the run exceeded")
+    return remaining
+
+
+def timeouts(url):
+    # (connect, read) timeouts of the host of url, no longer than the time left
+    connect, read = constants.request_timeouts.get(urllib.parse.urlsplit(url).hostname, constants.request_timeouts["default"])
+    remaining = remaining_time()
+    if remaining is not None:
+        connect, read = min(connect, remaining), min(read, remaining)
+    return connect, read
+
+
+def hedging():
+    return bool(os.environ.get(hedge_variable))
+
+
+def hedged(url, send):
+    # send() again when the first call is slower than the 95th percentile of the endpoint, the first answer wins
+    # the slower call is left to finish in the background, its answer is dropped
+    if not hedging():
+        return send()
+    endpoint = endpoint_name(url)
+    observed = sorted(latencies[endpoint])
+    stats = getattr(local, "stats", None)
+
+    def timed_send():
+        local.stats = stats  # accounted with the call that started it
+        start = time.perf_counter()
+        try:
+            return send()
+        finally:
+            latencies[endpoint].append(time.perf_counter() - start)
+            local.stats = None
+
+    if len(observed) < constants.hedge_min_samples:
+        return timed_send_inline(endpoint, send)
+    p95 = observed[int(len(observed) * 0.95)]
+    executor = hedge_executor()
+    first = executor.submit(timed_send)
+    done, _ = concurrent.futures.wait([first], timeout=p95)
+    if done:
+        return first.result()
+    second = executor.submit(timed_send)
+    done, _ = concurrent.futures.wait([first, second], return_when=concurrent.futures.FIRST_COMPLETED)
+    winner = done.pop()
+    if winner.exception() is not None:
+        # the other call may still succeed
+        return (second if winner is first else first).result()
+    return winner.result()
+
+
+def timed_send_inline(endpoint, send):
+    start = time.perf_counter()
+    response = send()
+    latencies[endpoint].append(time.perf_counter() - start)
+    return response
+
+
+def hedge_executor():
+    # one pool per process, pools are not inherited by worker processes
+    if os.getpid() not in hedge_executors:
+        hedge_executors[os.getpid()] = concurrent.futures.ThreadPoolExecutor(max_workers=constants.hedge_threads)
+    return hedge_executors[os.getpid()]
+
+
+def accept_encoding():
+    return "br, gzip, deflate" if brotli is not None else "gzip, deflate"
+
+
+class Identity:
+
+    def process(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b""
+
+
+class Zlib:
+
+    def __init__(self, wbits):
+        self.decompressor = zlib.decompressobj(wbits)
+
+    def process(self, chunk):
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+class Brotli:
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def process(self, chunk):
+        return self.decompressor.process(chunk)
+
+    def flush(self):
+        return b""
+
+
+def decompressor(encoding):
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "gzip":
+        return Zlib(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return Zlib(zlib.MAX_WBITS)
+    if encoding == "br" and brotli is not None:
+        return Brotli()
+    if encoding == "identity":
+        return Identity()
+    raise ValueError(f"Unsupported content encoding {encoding}")
+
+
+def endpoint_name(url):
+    # first two segments of the path, enough to tell the APIs apart (/push/fundsheet, /push/holdings...)
+    parsed = urllib.parse.urlsplit(url)
+    return parsed.netloc + "/" + "/".join(parsed.path.strip("/").split("/")[:2])
+
+
+def record(endpoint, compressed, decompressed):
+    stats = getattr(local, "stats", None)
+    if stats is None:
+        with totals_lock:
+            add(totals, endpoint, [1, compressed, decompressed])
+    else:
+        add(stats, endpoint, [1, compressed, decompressed])
+
+
+def add(stats, endpoint, values):
+    current = stats.setdefault(endpoint, [0, 0, 0])
+    for k, value in enumerate(values):
+        current[k] += value
+
+
+def merge(stats):
+    with totals_lock:
+        for endpoint, values in stats.items():
+            add(totals, endpoint, values)
+
+
+def iter_body(response):
+    # decompressed chunks of a streamed response (requested with stream=True), accounted once fully read
+    decoder = decompressor(response.headers.get("Content-Encoding"))
+    compressed = 0
+    decompressed = 0
+    for chunk in response.raw.stream(constants.transport_chunk_size, decode_content=False):
+        remaining_time()  # a body received slowly does not outlive the deadline
+        compressed += len(chunk)
+        progress.add(progress.BYTES, len(chunk))
+        chunk = decoder.process(chunk)
+        decompressed += len(chunk)
+        if chunk:
+            yield chunk
+    chunk = decoder.flush()
+    decompressed += len(chunk)
+    if chunk:
+        yield chunk
+    record(endpoint_name(response.url), compressed, decompressed)
+
+
+def read_body(response):
+    # whole decompressed body accumulated chunk by chunk in one buffer, instead of response.content then response.text
+    # json.loads still decodes the buffer into a new str, the body is not parsed while it is received
+    body = bytearray()
+    for chunk in iter_body(response):
+        body += chunk
+    return body
+
+
+class Accounted:
+    # wraps a worker function: returns (result, transport stats of the calls it made)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, item):
+        local.stats = {}
+        try:
+            return self.fn(item), local.stats
+        finally:
+            local.stats = None
+
+
+def summary():
+    # lines of the run summary, one per endpoint
+    lines = []
+    for endpoint, (count, compressed, decompressed) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        ratio = decompressed / compressed if compressed else 0
+        lines.append(f"{endpoint}: {count} calls, {compressed / 2 ** 10:.1f} KiB received, {decompressed / 2 ** 10:.1f} KiB decompressed (x{ratio:.1f})")
+    return lines
@@ -2,17 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import codecs
 import csv
 import datetime
+import importlib.util
 import json
 import os
+import re
 import requests
 from stdnum import isin
 from pylogger_unified import logger as pylogger_unified
 import constants
+import progress
+import requestcache
+import transport
 
 logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False)
 
+percent_pattern = re.compile(r"^(-\s?)?\d+(\.\d+)?\s?%$")
+query_pattern = re.compile(r"^(\w+)\s*(!=|<=|>=|=|<|>|~)(.*)$")  # condition of --query, operators of 2 characters first
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description=constants.argparse["description"])
@@ -24,11 +33,16 @@ def parse_args():
             }
             if "enum" in item:
                 arg_dict["choices"] = item["enum"]
-            if isinstance(item["default"], str):
-                arg_dict["default"] = item["default"]
-            elif isinstance(item["default"], bool):
+            if "type" in item:
+                arg_dict["type"] = item["type"]
+            if isinstance(item["default"], bool):
                 arg_dict["action"] = "store_" + str(not item["default"]).lower()
-            arg_group.add_argument(f"-{item['short']}", f"--{item['name']}", **arg_dict)
+            elif item["default"] is not None:
+                arg_dict["default"] = item["default"]
+            arg_flags = [f"--{item['name']}"]
+            if "short" in item:
+                arg_flags.insert(0, f"-{item['short']}")
+            arg_group.add_argument(*arg_flags, **arg_dict)
 
     return parser.parse_args()
 
@@ -115,20 +129,204 @@ def check_args(args):
     if os.path.splitext(os.path.basename(args.file))[1] != ".xlsx":
         raise OSError(f"File {os.path.basename(args.file)} must have xlsx extension !")
 
+    if (args.history_diff or args.history_isin or args.changes_sheet or args.replay) and not args.history_db:
+        raise ValueError("History queries, changes sheet and replay require --history-db")
+
+    if args.holdings_query and not args.holdings_index:
+        raise ValueError("--holdings-query requires --holdings-index")
+
+    if args.profile_memory and not args.profile:
+        raise ValueError("--profile-memory requires --profile")
+
+    if args.workers != "auto":
+        if not args.workers.isdigit() or int(args.workers) < 1:
+            raise ValueError("--workers must be auto or a positive number")
+        args.workers = int(args.workers)
+
+    if args.shard_by:
+        if args.update:
+            raise ValueError("--shard-by cannot be combined with --update, which updates the single sheet of the workbook")
+        if args.static_fills:
+            raise ValueError("--shard-by cannot be combined with --static-fills, whose colors are computed over a single sheet")
+        if args.low_memory:
+            raise ValueError("--shard-by cannot be combined with --low-memory, the records are partitioned in memory")
+        if args.shard_workers < 1:
+            raise ValueError("--shard-workers must be a positive number")
+        if args.xlsx_engine != "fast":
+            logger.warning("--shard-by generates the sheet XML with the fast Excel engine, --xlsx-engine fast is used")
+            args.xlsx_engine = "fast"
+
+    if args.deadline < 0:
+        raise ValueError("--deadline must be a positive number of seconds")
+
+    if args.checkpoint_every and args.update:
+        raise ValueError("--checkpoint-every cannot be combined with --update, checkpoints replace the workbook")
+
+    if args.lazy_enrichment and args.serve:
+        raise ValueError("--lazy-enrichment is not supported by the service mode")
+
+    if args.static_fills:
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--static-fills requires numpy")
+        if args.update:
+            raise ValueError("--static-fills cannot be combined with --update, percentiles change with every fund added")
+
+    if args.projection_amount or args.projection_contribution:
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--projection-amount and --projection-contribution require numpy")
+        if args.projection_amount < 0 or args.projection_contribution < 0:
+            raise ValueError("--projection-amount and --projection-contribution must be positive amounts")
+        if args.projection_horizon < 1:
+            raise ValueError("--projection-horizon must be at least 1 year")
+        if args.projection_paths < 0:
+            raise ValueError("--projection-paths must be a positive number")
+
+    if args.backtest_navs or args.backtest_allocations:
+        if not args.backtest_navs or not args.backtest_allocations:
+            raise ValueError("--backtest-navs and --backtest-allocations go together")
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--backtest-navs requires numpy")
+        for path in [args.backtest_navs, args.backtest_allocations]:
+            if not os.access(path, os.R_OK):
+                raise OSError(f"File {path} is not a readable file")
+        if args.drift_band < 0:
+            raise ValueError("--drift-band must be a positive number of percentage points")
+
+    if args.alternatives:
+        if args.alternatives < 0:
+            raise ValueError("--alternatives must be a positive number of funds")
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--alternatives requires numpy")
+        if not -1 <= args.alternatives_min_similarity <= 1:
+            raise ValueError("--alternatives-min-similarity must be between -1 and 1")
+
+    if args.look_through:
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--look-through requires numpy")
+        args.look_through = parse_weightings(args.favorites)
+
+    if args.query or args.sort or args.group_by:
+        if importlib.util.find_spec("numpy") is None:
+            raise ValueError("--query, --sort and --group-by require numpy")
+        if args.low_memory:
+            raise ValueError("--query, --sort and --group-by cannot be combined with --low-memory, the fund table is built in memory")
+        args.query = parse_query(args.query) if args.query else []
+        args.sort = parse_sort(args.sort) if args.sort else []
+        args.aggregate = parse_aggregates(args.aggregate)
+
+    if args.low_memory:
+        if args.update:
+            raise ValueError("--low-memory cannot be combined with --update, which loads the whole workbook")
+        if args.xlsx_engine != "fast":
+            logger.warning("--low-memory streams records into the fast Excel engine, --xlsx-engine fast is used")
+            args.xlsx_engine = "fast"
+
+    if args.update and args.xlsx_engine == "fast":
+        raise ValueError("--update cannot be combined with --xlsx-engine fast, the workbook is updated with openpyxl")
+
+
+def table_fields():
+    return constants.fund_table["numeric"] + constants.fund_table["categorical"] + constants.fund_table["text"]
+
+
+def parse_query(query):
+    # "field<value,field~value" -> [(field, operator, value)]
+    conditions = []
+    for condition in query.split(","):
+        match = query_pattern.match(condition.strip())
+        if match is None or match.group(1) not in table_fields():
+            raise ValueError(f"Invalid --query condition {condition}, expected FIELD OPERATOR VALUE with FIELD one of {', '.join(table_fields())}")
+        field, op, value = match.groups()
+        if field in constants.fund_table["numeric"] and op != "~":
+            try:
+                float(value)
+            except ValueError:
+                raise ValueError(f"Invalid --query condition {condition}, {field} is compared with numbers")
+        conditions.append((field, op, value.strip()))
+    return conditions
+
+
+def parse_sort(sort):
+    # "-field,field" -> [(field, descending)]
+    keys = []
+    for key in sort.split(","):
+        key = key.strip()
+        field = key.lstrip("-")
+        if field not in table_fields():
+            raise ValueError(f"Invalid --sort field {field}, expected one of {', '.join(table_fields())}")
+        keys.append((field, key.startswith("-")))
+    return keys
+
+
+def parse_aggregates(aggregates):
+    # "field:function,field:function" -> [(field, function)]
+    functions = []
+    for aggregate in aggregates.split(","):
+        field, _, function = aggregate.strip().partition(":")
+        if field not in constants.fund_table["numeric"] or function not in constants.fund_table["aggregates"]:
+            raise ValueError(f"Invalid --aggregate {aggregate}, expected FIELD:FUNCTION with a numeric FIELD and FUNCTION one of {', '.join(constants.fund_table['aggregates'])}")
+        functions.append((field, function))
+    return functions
+
+
+def parse_weightings(favorites):
+    # weight columns of the favorites file -> {name: {isin: weight}}, a column weight_NAME is named NAME, empty cells weigh 0
+    weightings = {}
+    for isin_code, row in favorites.items():
+        for column, value in row.items():
+            if column is None or not column.startswith(constants.favorites_weight_prefix):
+                continue
+            name = column[len(constants.favorites_weight_prefix):].strip(" _:-") or column
+            try:
+                weight = float(value) if value and value.strip() else 0.0
+            except ValueError:
+                raise ValueError(f"Invalid weight {value} of {isin_code} in column {column} of the favorites file")
+            if weight < 0:
+                raise ValueError(f"Negative weight {value} of {isin_code} in column {column} of the favorites file")
+            weightings.setdefault(name, {})[isin_code] = weight
+    if not weightings:
+        raise ValueError(f"--look-through requires a {constants.favorites_weight_prefix} column in the favorites file")
+    for name, weights in weightings.items():
+        if not sum(weights.values()):
+            raise ValueError(f"Weights of {name} in the favorites file are all 0")
+    return weightings
+
+
+# errors of a request that did not answer in time: the fields it fills are marked with constants.late_mark instead of failing the fund
+late_errors = (transport.DeadlineExceeded, requests.exceptions.Timeout)
+
 
 def request_data(url, method="GET", data=None, headers=None, cookies=None):
+    # responses are shared by all the workers of a run when the request cache is enabled (see requestcache.py)
+    return requestcache.fetch(
+        requestcache.request_key(method.upper(), url, data),
+        lambda: fetch_data(url, method=method, data=data, headers=headers, cookies=cookies)
+    )
+
+
+def fetch_data(url, method="GET", data=None, headers=None, cookies=None):
+    body = b""
     try:
+        # compression is negotiated and decoded by transport.py, which accounts the bytes per endpoint
+        # it also sets the timeouts of the call and may hedge it (see --deadline and --hedge)
+        headers = dict(headers or {}, **{"Accept-Encoding": transport.accept_encoding()})
         request_method = getattr(requests, method.lower())
-        if method.upper() == "GET":
-            response = request_method(url, headers=headers, cookies=cookies)
-        else:
-            response = request_method(url, headers=headers, cookies=cookies, data=data)
 
-        # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
+        def send():
+            with progress.request(url):
+                if method.upper() == "GET":
+                    response = request_method(url, headers=headers, cookies=cookies, stream=True, timeout=transport.timeouts(url))
+                else:
+                    response = request_method(url, headers=headers, cookies=cookies, data=data, stream=True, timeout=transport.timeouts(url))
+
+                with response:
+                    # Raise an exception for bad status codes (4xx or 5xx)
+                    response.raise_for_status()
+                    return transport.read_body(response)
 
         # Attempt to parse the JSON response
-        data = response.json()
+        body = transport.hedged(url, send)
+        data = json.loads(body)
         return data
 
     except requests.exceptions.RequestException as e:
@@ -139,7 +337,92 @@ def request_data(url, method="GET", data=None, headers=None, cookies=None):
     except json.JSONDecodeError as e:
         logger.error(f"Error decoding JSON: {e}")
         # Show the actual response content that failed to parse
-        logger.error(f"Response content: {response.content}")
+        logger.error(f"Response content: {bytes(body[:constants.transport_error_excerpt])}")
+        raise
+
+
+def iter_json_array(chunks):
+    # incremental parser of a JSON array: yields its items one by one while the body is being received
+    # only the item being decoded is kept in memory
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != "[":
+                    raise json.JSONDecodeError("Expecting '['", buffer, position)
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # the item may continue in the next chunk if it ends the buffer (a number for instance)
+                if end < len(buffer) or exhausted:
+                    yield item
+                    buffer = buffer[end:]
+                    position = 0
+                    continue
+        elif exhausted:
+            raise json.JSONDecodeError("Unexpected end of JSON array", buffer, position)
+        try:
+            buffer = buffer[position:] + text_decoder.decode(next(chunks))
+            position = 0
+        except StopIteration:
+            buffer = buffer[position:] + text_decoder.decode(b"", final=True)
+            position = 0
+            exhausted = True
+
+
+def request_json_stream(url, headers=None, cookies=None):
+    # GET a JSON array and yield its items as they are parsed
+    # with the request cache or hedging, the array goes through request_data like any other request and is received whole:
+    # a cached response is shared once complete and a hedged call can only win with its whole body
+    if requestcache.enabled() or transport.hedging():
+        yield from request_data(url, headers=headers, cookies=cookies)
+        return
+    try:
+        headers = dict(headers or {}, **{"Accept-Encoding": transport.accept_encoding()})
+        with progress.request(url), requests.get(url, headers=headers, cookies=cookies, stream=True, timeout=transport.timeouts(url)) as response:
+            response.raise_for_status()
+            body = transport.iter_body(response)
+            yield from iter_json_array(body)
+            for _ in body:
+                pass  # end of the body after the array, read so that the response is accounted
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error making API request: {e}")
+        raise
+
+    except json.JSONDecodeError as e:
+        logger.error(f"Error decoding JSON: {e}")
+        raise
+
+
+def download_data(url, headers=None):
+    # raw download (documents), a 304 Not Modified answer is returned as is for conditional requests
+    try:
+        with progress.request(url):
+            response = requests.get(url, headers=headers, timeout=transport.timeouts(url))
+        progress.add(progress.BYTES, len(response.content))
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error downloading {url}: {e}")
         raise
 
 
@@ -151,6 +434,31 @@ def remove_invalid_xml_chars(text):
     return "".join(c for c in text if ord(c) >= 32 or c in ("\t", "\n", "\r"))
 
 
+def format_cell_value(value, col_ref):
+    # converts a record value into the value written in its cell
+    # returns the value, the height of the cell in lines and the hyperlink of the cell if any
+    cell_height = 1
+    hyperlink = None
+    if isinstance(value, list):
+        cell_height = len(value)
+        val = "\n".join(value)
+    elif isinstance(value, dict):
+        if "url" not in value:
+            raise ValueError("Missing url attribute for dict value " + col_ref)
+        hyperlink = value["url"]
+        val = value["url"]
+        if "title" in value:
+            val = value["title"]
+    else:
+        val = value
+    val = remove_invalid_xml_chars(val)
+
+    if isinstance(val, str) and percent_pattern.match(val):
+        val = float(re.sub(r"\s?%", "", val))
+
+    return val, cell_height, hyperlink
+
+
 def join_h(lst):
     if len(lst) == 0:
         return ""
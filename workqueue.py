@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pylogger_unified import logger as pylogger_unified
+import constants
+
+# shared work queue used to spread fund fetching over several hosts
+# a job is an ISIN, a worker claims it with a lease, renews the lease while working and writes the record back
+# jobs whose lease expired (worker killed, host lost) are handed out again
+
+
+class DirectoryQueue:
+    # queue stored as files in a directory, usable on shared storage
+    # claiming a job is an atomic rename from jobs/ to leases/
+
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        for folder in ["jobs", "leases", "results", "failed"]:
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def folder(self, name, isin=""):
+        return os.path.join(self.path, name, isin)
+
+    def write(self, path, content):
+        tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(content, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def read(self, path):
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def put(self, funds):
+        # leftovers of a previous run are cleared first
+        for folder in ["jobs", "leases", "results", "failed"]:
+            for name in os.listdir(self.folder(folder)):
+                os.remove(self.folder(folder, name))
+        for isin in funds:
+            self.write(self.folder("jobs", isin), {"attempts": 0})
+        self.write(os.path.join(self.path, "ready"), {"funds": funds})
+
+    def funds(self):
+        if not os.path.exists(os.path.join(self.path, "ready")):
+            return None
+        return self.read(os.path.join(self.path, "ready"))["funds"]
+
+    def claim(self, worker):
+        for isin in sorted(os.listdir(self.folder("jobs"))):
+            if isin.endswith(".tmp"):
+                continue
+            try:
+                # the lease starts before the job shows in leases/, rename keeps the mtime and an old one would look expired
+                os.utime(self.folder("jobs", isin))
+                os.rename(self.folder("jobs", isin), self.folder("leases", isin))
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            job = self.read(self.folder("leases", isin))
+            job["worker"] = worker
+            self.write(self.folder("leases", isin), job)
+            return isin, job["attempts"]
+        return None, None
+
+    def renew(self, isin, worker):
+        try:
+            os.utime(self.folder("leases", isin))
+        except FileNotFoundError:
+            pass
+
+    def release(self, isin, worker):
+        # takes the lease of isin back if worker still holds it: the lease is moved aside first so that nobody else
+        # can requeue or release it meanwhile, a lease handed out again to another worker is put back
+        released = self.folder("leases", f"{isin}.{socket.gethostname()}.{os.getpid()}.tmp")
+        try:
+            os.rename(self.folder("leases", isin), released)
+        except FileNotFoundError:
+            return False
+        if self.read(released).get("worker") != worker:
+            os.rename(released, self.folder("leases", isin))
+            return False
+        os.remove(released)
+        return True
+
+    def complete(self, isin, worker, record):
+        self.write(self.folder("results", isin), record)
+        self.release(isin, worker)
+
+    def fail(self, isin, worker, error, attempts):
+        # a worker whose lease expired leaves the job to the worker holding it now
+        if not self.release(isin, worker):
+            return
+        target = "failed" if attempts + 1 >= constants.queue_max_attempts else "jobs"
+        self.write(self.folder(target, isin), {"attempts": attempts + 1, "error": error})
+
+    def requeue_expired(self):
+        requeued = []
+        now = time.time()
+        for isin in os.listdir(self.folder("leases")):
+            try:
+                if isin.endswith(".tmp") or os.path.getmtime(self.folder("leases", isin)) + self.lease > now:
+                    continue
+                os.rename(self.folder("leases", isin), self.folder("jobs", isin))
+                requeued.append(isin)
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def counts(self):
+        return {state: len([name for name in os.listdir(self.folder(state)) if not name.endswith(".tmp")]) for state in ["jobs", "leases", "results", "failed"]}
+
+    def result(self, isin):
+        return self.read(self.folder("results", isin))
+
+    def failures(self):
+        return {isin: self.read(self.folder("failed", isin))["error"] for isin in os.listdir(self.folder("failed")) if not isin.endswith(".tmp")}
+
+
+class SqliteQueue:
+    # queue stored in a local SQLite database, for workers running on the same host
+
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        connection = self.connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs (isin TEXT PRIMARY KEY, position INTEGER, state TEXT NOT NULL, worker TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, record TEXT, error TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, expires)")
+        connection.commit()
+        connection.close()
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # connections are not shared with worker processes
+        return {"path": self.path, "lease": self.lease}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @property
+    def connection(self):
+        # one connection per thread and per process
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = self.connect()
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def put(self, funds):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute("DELETE FROM jobs")
+            self.connection.executemany("INSERT OR REPLACE INTO jobs (isin, position, state) VALUES (?, ?, 'pending')", [(isin, i) for i, isin in enumerate(funds)])
+
+    def funds(self):
+        funds = [row[0] for row in self.connection.execute("SELECT isin FROM jobs ORDER BY position")]
+        return funds if funds else None
+
+    def claim(self, worker):
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT isin, attempts FROM jobs WHERE state = 'pending' OR (state = 'leased' AND expires < ?) ORDER BY position LIMIT 1", (time.time(),)).fetchone()
+            if row is None:
+                return None, None
+            self.connection.execute("UPDATE jobs SET state = 'leased', worker = ?, expires = ? WHERE isin = ?", (worker, time.time() + self.lease, row[0]))
+        return row
+
+    def renew(self, isin, worker):
+        self.connection.execute("UPDATE jobs SET expires = ? WHERE isin = ? AND worker = ? AND state = 'leased'", (time.time() + self.lease, isin, worker))
+
+    def complete(self, isin, worker, record):
+        self.connection.execute("UPDATE jobs SET state = 'done', record = ? WHERE isin = ?", (json.dumps(record, ensure_ascii=False), isin))
+
+    def fail(self, isin, worker, error, attempts):
+        state = "failed" if attempts + 1 >= constants.queue_max_attempts else "pending"
+        # a worker whose lease expired leaves the job to the worker holding it now
+        self.connection.execute("UPDATE jobs SET state = ?, attempts = ?, error = ? WHERE isin = ? AND worker = ? AND state = 'leased'", (state, attempts + 1, error, isin, worker))
+
+    def requeue_expired(self):
+        # expired leases are claimable directly, nothing to move
+        return [row[0] for row in self.connection.execute("SELECT isin FROM jobs WHERE state = 'leased' AND expires < ?", (time.time(),))]
+
+    def counts(self):
+        counts = dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {"jobs": counts.get("pending", 0), "leases": counts.get("leased", 0), "results": counts.get("done", 0), "failed": counts.get("failed", 0)}
+
+    def result(self, isin):
+        return json.loads(self.connection.execute("SELECT record FROM jobs WHERE isin = ?", (isin,)).fetchone()[0])
+
+    def failures(self):
+        return dict(self.connection.execute("SELECT isin, error FROM jobs WHERE state = 'failed'").fetchall())
+
+
+def open_queue(path, lease):
+    if os.path.splitext(path)[1] in [".db", ".sqlite", ".sqlite3"]:
+        return SqliteQueue(path, lease)
+    return DirectoryQueue(path, lease)
+
+
+def run_worker(queue, fetch, debug=False):
+    # claims jobs until the queue is drained
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name=f"worker-{worker}")
+
+    while queue.funds() is None:
+        logger.info("Waiting for the coordinator to fill the queue...")
+        time.sleep(constants.queue_poll_interval)
+
+    processed = 0
+    while True:
+        isin, attempts = queue.claim(worker)
+        if isin is None:
+            counts = queue.counts()
+            if not counts["jobs"] and not counts["leases"]:
+                break
+            time.sleep(constants.queue_poll_interval)
+            continue
+
+        stop_event = threading.Event()
+
+        def heartbeat():
+            while not stop_event.wait(queue.lease / 3):
+                queue.renew(isin, worker)
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            record = fetch(isin)
+        except Exception as e:
+            logger.error(f"Failed to fetch {isin} (attempt {attempts + 1}): {e}")
+            queue.fail(isin, worker, f"{type(e).__name__}: {e}", attempts)
+        else:
+            queue.complete(isin, worker, record)
+            processed += 1
+        finally:
+            stop_event.set()
+            thread.join()
+
+    logger.info(f"Queue drained, {processed} funds fetched by this worker")
+
+
+def coordinate(queue, funds, fetch, local_workers=0, debug=False):
+    # fills the queue, optionally starts local workers, hands out expired leases again and merges the records
+    # once the queue is drained, returns an iterator of the records in the order of funds, read one at a time from the queue
+    logger = pylogger_unified.init_logger(json_formatter=False, enable_gi=False, debug=debug, logger_name="coordinator")
+
+    queue.put(funds)
+    logger.info(f"{len(funds)} funds queued in {queue.path}")
+
+    processes = [multiprocessing.Process(target=run_worker, args=(queue, fetch, debug)) for _ in range(local_workers)]
+    for process in processes:
+        process.start()
+
+    expired = set()
+    while True:
+        for isin in set(queue.requeue_expired()) - expired:
+            logger.warning(f"Lease expired for {isin}, job handed out again")
+            expired.add(isin)
+        counts = queue.counts()
+        logger.debug(f"Queue state: {counts}")
+        if not counts["jobs"] and not counts["leases"]:
+            break
+        time.sleep(constants.queue_poll_interval)
+
+    for process in processes:
+        process.join()
+
+    failures = queue.failures()
+    for isin, error in failures.items():
+        logger.error(f"{isin} failed after {constants.queue_max_attempts} attempts: {error}")
+    if failures:
+        raise RuntimeError(f"{len(failures)} funds could not be fetched")
+
+    return (queue.result(isin) for isin in funds)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+from openpyxl.utils import get_column_letter
+import constants
+import utils
+
+# streaming xlsx writer: the sheet XML is written straight into the zip archive
+# styles are precomputed once, strings are written inline and hyperlinks are spilled to a temporary file
+# so nothing is kept per cell
+# sharded workbooks (see write_sharded_workbook) get one sheet per partition of the records, generated in worker processes
+
+namespace_main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+namespace_relationships = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+namespace_package_relationships = "http://schemas.openxmlformats.org/package/2006/relationships"
+relationship_prefix = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+header_color = "222222"
+standard_color = "333333"
+font_color = "FFFFFF"
+
+xml_declaration = "<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>\n"
+
+stream_buffer_size = 1 << 16
+
+
+def quote(value):
+    return escape(str(value), {"\"": "&quot;"})
+
+
+class StyleTable:
+    # shared style table (fonts, fills, borders, cell formats and differential formats)
+    # every cell format is identified by a key and built once
+
+    def __init__(self):
+        self.fonts = ["<font><name val=\"Calibri\"/><family val=\"2\"/><color theme=\"1\"/><sz val=\"11\"/><scheme val=\"minor\"/></font>"]  # default font of openpyxl
+        self.fills = [
+            "<fill><patternFill patternType=\"none\"/></fill>",
+            "<fill><patternFill patternType=\"gray125\"/></fill>"
+        ]
+        self.borders = ["<border><left/><right/><top/><bottom/><diagonal/></border>"]
+        self.xfs = ["<xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\" xfId=\"0\"/>"]
+        self.dxfs = []
+        self.index = {}
+
+        self.header_fill = self.add_fill(header_color)
+        self.standard_fill = self.add_fill(standard_color)
+        self.header_border = self.add_border("thick")
+        self.standard_border = self.add_border("thin")
+        self.first_column_font = self.add_font("<font><b val=\"1\"/></font>")
+        self.standard_font = self.add_font(f"<font><color rgb=\"00{font_color}\"/><sz val=\"12\"/></font>")
+
+    def add_font(self, font):
+        self.fonts.append(font)
+        return len(self.fonts) - 1
+
+    def add_fill(self, color):
+        self.fills.append(f"<fill><patternFill patternType=\"solid\"><fgColor rgb=\"00{color}\"/><bgColor rgb=\"00{color}\"/></patternFill></fill>")
+        return len(self.fills) - 1
+
+    def add_border(self, border_style):
+        side = f"style=\"{border_style}\"><color rgb=\"00{font_color}\"/>"
+        self.borders.append("<border>" + "".join(f"<{name} {side}</{name}>" for name in ["left", "right", "top", "bottom", "diagonal", "vertical", "horizontal"]) + "</border>")
+        return len(self.borders) - 1
+
+    def add_xf(self, key, font, fill, border, horizontal, number_format=0):
+        if key not in self.index:
+            self.xfs.append(
+                f"<xf numFmtId=\"{number_format}\" fontId=\"{font}\" fillId=\"{fill}\" borderId=\"{border}\" xfId=\"0\" applyNumberFormat=\"1\" applyFont=\"1\" applyFill=\"1\" applyBorder=\"1\" applyAlignment=\"1\">"
+                f"<alignment horizontal=\"{horizontal}\" vertical=\"center\"/></xf>"
+            )
+            self.index[key] = len(self.xfs) - 1
+        return self.index[key]
+
+    def header(self, size):
+        # header cells: bold white text of a given size (default size when None) on the dark header fill
+        key = ("header", size)
+        if key not in self.index:
+            font = self.add_font(f"<font><b val=\"1\"/><color rgb=\"00{font_color}\"/>" + (f"<sz val=\"{size}\"/>" if size else "") + "</font>")
+            self.add_xf(key, font, self.header_fill, self.header_border, "center")
+        return self.index[key]
+
+    def cell(self, first_column, horizontal, color=None):
+        # data cells, text number format (49 is "@"), color replaces the default fill (static fills)
+        if first_column:
+            return self.add_xf(("first_column", horizontal, color), self.first_column_font, self.static_fill(color) if color else self.header_fill, self.header_border, horizontal, number_format=49)
+        return self.add_xf(("standard", horizontal, color), self.standard_font, self.static_fill(color) if color else self.standard_fill, self.standard_border, horizontal, number_format=49)
+
+    def static_fill(self, color):
+        key = ("fill", color)
+        if key not in self.index:
+            self.index[key] = self.add_fill(color)
+        return self.index[key]
+
+    def dxf(self, color):
+        key = ("dxf", color)
+        if key not in self.index:
+            self.dxfs.append(f"<dxf><fill><patternFill patternType=\"solid\"><fgColor rgb=\"00{color}\"/><bgColor rgb=\"00{color}\"/></patternFill></fill></dxf>")
+            self.index[key] = len(self.dxfs) - 1
+        return self.index[key]
+
+    def xml(self):
+        return (
+            xml_declaration
+            + f"<styleSheet xmlns=\"{namespace_main}\">"
+            + f"<fonts count=\"{len(self.fonts)}\">" + "".join(self.fonts) + "</fonts>"
+            + f"<fills count=\"{len(self.fills)}\">" + "".join(self.fills) + "</fills>"
+            + f"<borders count=\"{len(self.borders)}\">" + "".join(self.borders) + "</borders>"
+            + "<cellStyleXfs count=\"1\"><xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\"/></cellStyleXfs>"
+            + f"<cellXfs count=\"{len(self.xfs)}\">" + "".join(self.xfs) + "</cellXfs>"
+            + "<cellStyles count=\"1\"><cellStyle name=\"Normal\" xfId=\"0\" builtinId=\"0\"/></cellStyles>"
+            + f"<dxfs count=\"{len(self.dxfs)}\">" + "".join(self.dxfs) + "</dxfs>"
+            + "</styleSheet>"
+        )
+
+
+def build_style_table(extra_sheets=None):
+    # every style used by the workbook is known from constants.column_mapping before any row is written
+    styles = StyleTable()
+    for column_group in constants.column_mapping:
+        styles.header(column_group["size"] if "size" in column_group else 18)
+        for subitem in column_group["items"]:
+            styles.header(subitem["size"] if "size" in subitem else 10)
+            for color in subitem.get("conditional-formatting", {}).get("fill-mapping", {}).values():
+                styles.dxf(color)
+    for first_column in [True, False]:
+        for horizontal in ["center", "left"]:
+            styles.cell(first_column, horizontal)
+    if extra_sheets:
+        styles.header(None)
+    return styles
+
+
+def cell_xml(reference, value, style):
+    # NaN and infinities have no representation in a workbook, openpyxl writes them as empty cells too
+    if value is None or value == "" or (isinstance(value, float) and not math.isfinite(value)):
+        return f"<c r=\"{reference}\" s=\"{style}\"/>"
+    if isinstance(value, bool):
+        return f"<c r=\"{reference}\" s=\"{style}\" t=\"b\"><v>{int(value)}</v></c>"
+    if isinstance(value, (int, float)):
+        return f"<c r=\"{reference}\" s=\"{style}\"><v>{repr(value)}</v></c>"
+    return f"<c r=\"{reference}\" s=\"{style}\" t=\"inlineStr\"><is><t xml:space=\"preserve\">{escape(str(value))}</t></is></c>"
+
+
+class BufferedStream:
+    # groups the many small XML fragments into large writes on the compressed zip stream
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= stream_buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.stream.write("".join(self.chunks).encode("utf-8"))
+        self.chunks = []
+        self.size = 0
+
+
+def iter_cells(data, col_refs):
+    # yields the formatted cells of every record: (values, heights, hyperlinks)
+    for row_data in data:
+        yield [utils.format_cell_value(row_data.get(col_ref, ""), col_ref) for col_ref in col_refs]
+
+
+def column_widths(data, subitems):
+    # same widths as the openpyxl engine: fixed width or longest line of the column, plus 4
+    widths = [subitem["width"] if "width" in subitem else 0 for subitem in subitems]
+    auto_columns = [i for i, width in enumerate(widths) if not width]
+    if not auto_columns:
+        return [width + 4 for width in widths]
+    # header rows: the group name sits in the first cell of each merge, the other merged cells read "None" in openpyxl
+    header_lines = []
+    for column_group in constants.column_mapping:
+        header_lines += [column_group["name"]] + ["None"] * (len(column_group["items"]) - 1)
+    for i in auto_columns:
+        widths[i] = max(len(cell_line) for cell_line in header_lines[i].split("\n") + subitems[i]["name"].split("\n"))
+    col_refs = [subitems[i]["ref"] for i in auto_columns]
+    for cells in iter_cells(data, col_refs):
+        for i, (val, cell_height, hyperlink) in zip(auto_columns, cells):
+            widths[i] = max(widths[i], max(len(cell_line) for cell_line in str(val).split("\n")))
+    return [width + 4 for width in widths]
+
+
+def iter_hyperlinks(hyperlinks):
+    hyperlinks.seek(0)
+    for line in hyperlinks:
+        yield json.loads(line)
+
+
+def write_assets_sheet(stream, data, styles, title_color, hyperlinks, fills=None):
+    # writes the main sheet, its hyperlinks are appended to the hyperlinks file as (cell reference, url)
+    # static fills (see ranking.py) replace the conditional formatting rules when given
+    # returns the number of hyperlinks
+    subitems = [subitem for item in constants.column_mapping for subitem in item["items"]]
+    col_refs = [subitem["ref"] for subitem in subitems]
+    letters = [get_column_letter(i + 1) for i in range(len(subitems))]
+    first_columns = len(constants.column_mapping[0]["items"])
+    last_letter = letters[-1]
+    hyperlink_count = 0
+
+    stream.write(xml_declaration)
+    stream.write(f"<worksheet xmlns=\"{namespace_main}\" xmlns:r=\"{namespace_relationships}\">")
+    stream.write(f"<sheetPr><tabColor rgb=\"00{title_color}\"/><outlinePr summaryBelow=\"1\" summaryRight=\"1\"/></sheetPr>")
+    stream.write(
+        "<sheetViews><sheetView workbookViewId=\"0\">"
+        f"<pane xSplit=\"{first_columns}\" ySplit=\"2\" topLeftCell=\"{letters[first_columns]}3\" activePane=\"bottomRight\" state=\"frozen\"/>"
+        "<selection pane=\"bottomRight\" activeCell=\"A1\" sqref=\"A1\"/>"
+        "</sheetView></sheetViews>"
+    )
+    stream.write("<sheetFormatPr baseColWidth=\"8\" defaultRowHeight=\"15\"/>")
+    stream.write("<cols>" + "".join(f"<col min=\"{i + 1}\" max=\"{i + 1}\" width=\"{width}\" customWidth=\"1\"/>" for i, width in enumerate(column_widths(data, subitems))) + "</cols>")
+    stream.write("<sheetData>")
+
+    row = ["<row r=\"1\" ht=\"30\" customHeight=\"1\">"]
+    merges = []
+    i = 0
+    for column_group in constants.column_mapping:
+        group_style = styles.header(column_group["size"] if "size" in column_group else 18)
+        for k in range(len(column_group["items"])):
+            row.append(cell_xml(f"{letters[i + k]}1", column_group["name"] if k == 0 else None, group_style))
+        merges.append(f"{letters[i]}1:{letters[i + len(column_group['items']) - 1]}1")
+        i += len(column_group["items"])
+    row.append("</row>")
+    stream.write("".join(row))
+    stream.write("<row r=\"2\" ht=\"30\" customHeight=\"1\">" + "".join(cell_xml(f"{letters[i]}2", subitem["name"], styles.header(subitem["size"] if "size" in subitem else 10)) for i, subitem in enumerate(subitems)) + "</row>")
+
+    cell_styles = {
+        (first_column, cell_height == 1): styles.cell(first_column, "center" if cell_height == 1 else "left")
+        for first_column in [True, False] for cell_height in [1, 2]
+    }
+    j = 3
+    for cells in iter_cells(data, col_refs):
+        height_factor = 0
+        row = []
+        for i, (val, cell_height, hyperlink) in enumerate(cells):
+            reference = f"{letters[i]}{j}"
+            color = fills.color(j - 3, i) if fills is not None else None
+            if color is None:
+                style = cell_styles[(i < first_columns, cell_height == 1)]
+            else:
+                style = styles.cell(i < first_columns, "center" if cell_height == 1 else "left", color)
+            row.append(cell_xml(reference, val, style))
+            if hyperlink is not None:
+                hyperlinks.write(json.dumps([reference, hyperlink]) + "\n")
+                hyperlink_count += 1
+            height_factor = min(max(height_factor, cell_height), 20)
+        stream.write(f"<row r=\"{j}\" ht=\"{height_factor * 16}\" customHeight=\"1\">" + "".join(row) + "</row>")
+        j += 1
+    stream.write("</sheetData>")
+
+    stream.write(f"<autoFilter ref=\"A2:{last_letter}2\"/>")
+    stream.write(f"<mergeCells count=\"{len(merges)}\">" + "".join(f"<mergeCell ref=\"{merge}\"/>" for merge in merges) + "</mergeCells>")
+
+    priority = 1
+    for i, subitem in enumerate(subitems if fills is None else []):
+        conditional_formatting_item = subitem.get("conditional-formatting", {})
+        column_letter = letters[i]
+        sqref = f"{column_letter}1:{column_letter}{j}"
+        if "fill-mapping" in conditional_formatting_item:
+            for filter_equality, filling_color in conditional_formatting_item["fill-mapping"].items():
+                formula = quote(f"${column_letter}1=\"{filter_equality}\"")
+                stream.write(
+                    f"<conditionalFormatting sqref=\"{sqref}\"><cfRule type=\"expression\" dxfId=\"{styles.dxf(filling_color)}\" priority=\"{priority}\">"
+                    f"<formula>{formula}</formula></cfRule></conditionalFormatting>"
+                )
+                priority += 1
+        if "fill-percentile" in conditional_formatting_item:
+            colors = conditional_formatting_item["fill-percentile"]
+            stream.write(
+                f"<conditionalFormatting sqref=\"{sqref}\"><cfRule type=\"colorScale\" priority=\"{priority}\"><colorScale>"
+                "<cfvo type=\"percentile\" val=\"0\"/><cfvo type=\"percentile\" val=\"50\"/><cfvo type=\"percentile\" val=\"100\"/>"
+                f"<color rgb=\"00{colors['start_color']}\"/><color rgb=\"00{colors['mid_color']}\"/><color rgb=\"00{colors['end_color']}\"/>"
+                "</colorScale></cfRule></conditionalFormatting>"
+            )
+            priority += 1
+
+    if hyperlink_count:
+        stream.write("<hyperlinks>")
+        for k, (reference, url) in enumerate(iter_hyperlinks(hyperlinks)):
+            stream.write(f"<hyperlink ref=\"{reference}\" r:id=\"rId{k + 1}\"/>")
+        stream.write("</hyperlinks>")
+    stream.write("<pageMargins left=\"0.75\" right=\"0.75\" top=\"1\" bottom=\"1\" header=\"0.5\" footer=\"0.5\"/>")
+    stream.write("</worksheet>")
+    stream.flush()
+    return hyperlink_count
+
+
+def write_table_sheet(stream, sheet, styles):
+    # plain table sheet (title, header, rows) appended after the main sheet
+    header_style = styles.header(None)
+    last_letter = get_column_letter(len(sheet["header"]))
+    rows = [sheet["header"]] + [[utils.remove_invalid_xml_chars(val) for val in row] for row in sheet["rows"]]
+    widths = [min(max(len(str(row[i])) for row in rows), 80) + 4 for i in range(len(sheet["header"]))]
+
+    stream.write(xml_declaration)
+    stream.write(f"<worksheet xmlns=\"{namespace_main}\" xmlns:r=\"{namespace_relationships}\">")
+    stream.write("<sheetViews><sheetView workbookViewId=\"0\"><pane ySplit=\"1\" topLeftCell=\"A2\" activePane=\"bottomLeft\" state=\"frozen\"/></sheetView></sheetViews>")
+    stream.write("<cols>" + "".join(f"<col min=\"{i + 1}\" max=\"{i + 1}\" width=\"{width}\" customWidth=\"1\"/>" for i, width in enumerate(widths)) + "</cols>")
+    stream.write("<sheetData>")
+    for j, row in enumerate(rows):
+        stream.write(f"<row r=\"{j + 1}\">" + "".join(cell_xml(f"{get_column_letter(i + 1)}{j + 1}", val, header_style if j == 0 else 0) for i, val in enumerate(row)) + "</row>")
+    stream.write("</sheetData>")
+    stream.write(f"<autoFilter ref=\"A1:{last_letter}1\"/>")
+    if sheet.get("links"):
+        # links to other sheets of the workbook: row index -> location of the first cell of the row
+        stream.write("<hyperlinks>" + "".join(f"<hyperlink ref=\"A{k + 2}\" location=\"{quote(location)}\"/>" for k, location in sheet["links"].items()) + "</hyperlinks>")
+    stream.write("<pageMargins left=\"0.75\" right=\"0.75\" top=\"1\" bottom=\"1\" header=\"0.5\" footer=\"0.5\"/>")
+    stream.write("</worksheet>")
+    stream.flush()
+
+
+def package_xml(titles):
+    sheet_count = len(titles)
+    content_types = (
+        xml_declaration
+        + "<Types xmlns=\"http://schemas.openxmlformats.org/package/2006/content-types\">"
+        + "<Default Extension=\"rels\" ContentType=\"application/vnd.openxmlformats-package.relationships+xml\"/>"
+        + "<Default Extension=\"xml\" ContentType=\"application/xml\"/>"
+        + "<Override PartName=\"/xl/workbook.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml\"/>"
+        + "<Override PartName=\"/xl/styles.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml\"/>"
+        + "".join(f"<Override PartName=\"/xl/worksheets/sheet{i + 1}.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>" for i in range(sheet_count))
+        + "</Types>"
+    )
+    root_relationships = (
+        xml_declaration
+        + f"<Relationships xmlns=\"{namespace_package_relationships}\">"
+        + f"<Relationship Id=\"rId1\" Type=\"{relationship_prefix}/officeDocument\" Target=\"xl/workbook.xml\"/>"
+        + "</Relationships>"
+    )
+    workbook = (
+        xml_declaration
+        + f"<workbook xmlns=\"{namespace_main}\" xmlns:r=\"{namespace_relationships}\">"
+        + "<bookViews><workbookView activeTab=\"0\"/></bookViews><sheets>"
+        + "".join(f"<sheet name=\"{quote(title)}\" sheetId=\"{i + 1}\" r:id=\"rId{i + 1}\"/>" for i, title in enumerate(titles))
+        + "</sheets><definedNames>"
+        + "".join(f"<definedName name=\"_xlnm._FilterDatabase\" localSheetId=\"{i}\" hidden=\"1\">{quote(filter_range)}</definedName>" for i, filter_range in enumerate(titles.values()))
+        + "</definedNames></workbook>"
+    )
+    workbook_relationships = (
+        xml_declaration
+        + f"<Relationships xmlns=\"{namespace_package_relationships}\">"
+        + "".join(f"<Relationship Id=\"rId{i + 1}\" Type=\"{relationship_prefix}/worksheet\" Target=\"worksheets/sheet{i + 1}.xml\"/>" for i in range(sheet_count))
+        + f"<Relationship Id=\"rId{sheet_count + 1}\" Type=\"{relationship_prefix}/styles\" Target=\"styles.xml\"/>"
+        + "</Relationships>"
+    )
+    return {
+        "[Content_Types].xml": content_types,
+        "_rels/.rels": root_relationships,
+        "xl/workbook.xml": workbook,
+        "xl/_rels/workbook.xml.rels": workbook_relationships
+    }
+
+
+def write_hyperlinks_relationships(stream, hyperlinks):
+    stream.write(xml_declaration)
+    stream.write(f"<Relationships xmlns=\"{namespace_package_relationships}\">")
+    for k, (reference, url) in enumerate(iter_hyperlinks(hyperlinks)):
+        stream.write(f"<Relationship Id=\"rId{k + 1}\" Type=\"{relationship_prefix}/hyperlink\" Target=\"{quote(url)}\" TargetMode=\"External\"/>")
+    stream.write("</Relationships>")
+    stream.flush()
+
+
+def write_workbook(file, data, extra_sheets=None, fills=None):
+    extra_sheets = extra_sheets or []
+    styles = build_style_table(extra_sheets)
+    last_letter = get_column_letter(sum(len(item["items"]) for item in constants.column_mapping))
+    title = constants.worksheet["title"]
+    titles = {title: f"'{title}'!$A$2:${last_letter}$2"}
+    for sheet in extra_sheets:
+        titles[sheet["title"]] = f"'{sheet['title']}'!$A$1:${get_column_letter(len(sheet['header']))}$1"
+
+    with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as archive, tempfile.TemporaryFile(mode="w+", encoding="utf-8") as hyperlinks:
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as stream:
+            hyperlink_count = write_assets_sheet(BufferedStream(stream), data, styles, constants.worksheet["color"], hyperlinks, fills=fills)
+        if hyperlink_count:
+            with archive.open("xl/worksheets/_rels/sheet1.xml.rels", "w", force_zip64=True) as stream:
+                write_hyperlinks_relationships(BufferedStream(stream), hyperlinks)
+        for i, sheet in enumerate(extra_sheets):
+            with archive.open(f"xl/worksheets/sheet{i + 2}.xml", "w", force_zip64=True) as stream:
+                write_table_sheet(BufferedStream(stream), sheet, styles)
+        archive.writestr("xl/styles.xml", styles.xml())
+        for name, content in package_xml(titles).items():
+            archive.writestr(name, content)
+
+
+def shard_title(value, titles):
+    # sheet name of a partition: at most 31 characters, none of []:*?/\ and unique whatever the case
+    title = re.sub(r"[\[\]:*?/\\]", " ", str(value)).strip()[:31] or constants.shard_index_sheet["unknown"]
+    existing = {name.lower() for name in titles}
+    candidate = title
+    k = 2
+    while candidate.lower() in existing:
+        candidate = f"{title[:31 - len(str(k)) - 1]} {k}"
+        k += 1
+    return candidate
+
+
+def write_shard(records, styles, directory):
+    # runs in a worker process: the sheet XML of a partition and its hyperlink relationships are written uncompressed to directory
+    # returns the paths of both files, None for the relationships of a sheet without hyperlinks
+    fd, sheet_path = tempfile.mkstemp(suffix=".xml", dir=directory)
+    with os.fdopen(fd, "wb") as stream, tempfile.TemporaryFile(mode="w+", encoding="utf-8") as hyperlinks:
+        hyperlink_count = write_assets_sheet(BufferedStream(stream), records, styles, constants.worksheet["color"], hyperlinks)
+        if not hyperlink_count:
+            return sheet_path, None
+        fd, relationships_path = tempfile.mkstemp(suffix=".rels", dir=directory)
+        with os.fdopen(fd, "wb") as relationships:
+            write_hyperlinks_relationships(BufferedStream(relationships), hyperlinks)
+    return sheet_path, relationships_path
+
+
+def write_sharded_workbook(file, data, key, extra_sheets=None, workers=None):
+    # one sheet per value of the record field key, preceded by an index sheet linking to them
+    # the sheets are generated in parallel worker processes, then compressed into the archive in order as they are ready
+    extra_sheets = extra_sheets or []
+    shards = {}
+    for record in data:
+        shards.setdefault(record.get(key) or constants.shard_index_sheet["unknown"], []).append(record)
+    shards = dict(sorted(shards.items(), key=lambda item: str(item[0])))
+
+    last_letter = get_column_letter(sum(len(item["items"]) for item in constants.column_mapping))
+    index_title = constants.shard_index_sheet["title"]
+    titles = {index_title: f"'{index_title}'!$A$1:$C$1"}
+    shard_titles = []
+    for value in shards:
+        title = shard_title(value, list(titles) + [sheet["title"] for sheet in extra_sheets])
+        titles[title] = f"'{title}'!$A$2:${last_letter}$2"
+        shard_titles.append(title)
+    for sheet in extra_sheets:
+        titles[sheet["title"]] = f"'{sheet['title']}'!$A$1:${get_column_letter(len(sheet['header']))}$1"
+    index_sheet = {
+        "title": index_title,
+        "header": constants.shard_index_sheet["header"],
+        "rows": [[title, len(records), sum(1 for record in records if record.get("favorite"))] for title, records in zip(shard_titles, shards.values())],
+        "links": {k: f"'{title}'!A1" for k, title in enumerate(shard_titles)}
+    }
+    styles = build_style_table([index_sheet])
+
+    with tempfile.TemporaryDirectory(prefix="arbitrage-shards-") as directory, concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_shard, records, styles, directory) for records in shards.values()]
+        with zipfile.ZipFile(file, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as stream:
+                write_table_sheet(BufferedStream(stream), index_sheet, styles)
+            for i, future in enumerate(futures):
+                sheet_path, relationships_path = future.result()
+                for path, name in [(sheet_path, f"xl/worksheets/sheet{i + 2}.xml"), (relationships_path, f"xl/worksheets/_rels/sheet{i + 2}.xml.rels")]:
+                    if path is None:
+                        continue
+                    with open(path, "rb") as source, archive.open(name, "w", force_zip64=True) as stream:
+                        shutil.copyfileobj(source, stream, stream_buffer_size)
+                    os.remove(path)
+            for i, sheet in enumerate(extra_sheets):
+                with archive.open(f"xl/worksheets/sheet{len(shards) + i + 2}.xml", "w", force_zip64=True) as stream:
+                    write_table_sheet(BufferedStream(stream), sheet, styles)
+            archive.writestr("xl/styles.xml", styles.xml())
+            for name, content in package_xml(titles).items():
+                archive.writestr(name, content)